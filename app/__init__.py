@@ -1,7 +1,11 @@
 import logging
 import os
 
+import structlog
 from structlog import wrap_logger
+from structlog.stdlib import filter_by_level
+
+from app.logs import DEFAULT_LOG_QUEUE_SIZE, BackgroundHandler
 
 
 __version__ = "1.4.2"
@@ -9,12 +13,23 @@ __service__ = "sdx-seft-publisher-service"
 
 LOGGING_FORMAT = "%(asctime)s.%(msecs)06dZ|%(levelname)s: sdx-seft-publisher-service: %(message)s"
 
-logging.basicConfig(format=LOGGING_FORMAT,
-                    datefmt="%Y-%m-%dT%H:%M:%S",
-                    level=os.getenv("LOGGING_LEVEL", "DEBUG"))
+LOG_QUEUE_SIZE = int(os.getenv("SEFT_LOG_QUEUE_SIZE", DEFAULT_LOG_QUEUE_SIZE))
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter(LOGGING_FORMAT, datefmt="%Y-%m-%dT%H:%M:%S"))
+# Records are written by a background thread, unless the queue size is 0
+log_handler = BackgroundHandler([stream_handler], LOG_QUEUE_SIZE) if LOG_QUEUE_SIZE else None
+
+logging.basicConfig(handlers=[log_handler or stream_handler],
+                    level=os.getenv("LOGGING_LEVEL", "INFO"))
+if log_handler in logging.getLogger().handlers:
+    log_handler.start()
 
 
 def create_and_wrap_logger(logger_name):
-    logger = wrap_logger(logging.getLogger(logger_name))
+    # Events below the logging level are dropped before they are rendered
+    logger = wrap_logger(
+        logging.getLogger(logger_name), processors=[filter_by_level] + structlog.get_config()["processors"]
+    )
     logger.info("START", version=__version__)
     return logger
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#   encoding: UTF-8
+
+"""Measures the throughput of whole transfer cycles.
+
+A local FTP server is filled with generated files, which a Task transfers
+to an in-process stand-in for RabbitMQ that confirms messages after a set
+delay. The service is configured by its usual environment variables, so
+runs with different settings or commits can be compared. Results are
+written as JSON.
+
+    python3 -m app.bench.run --files 500 --distribution lognormal --output bench.json
+"""
+
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import tornado.gen
+import tornado.ioloop
+
+from app.ftpclient import FTPWorker
+from app.main import Task
+from app.publisher import Delivery, DurableTopicPublisher, PublisherPool
+from app.test.broker import Broker
+from app.test.localserver import serve
+
+USER = "benchuser"
+PASSWORD = "benchpassword"
+
+
+class BenchPublisher(DurableTopicPublisher):
+    """Records the time at which each message is settled"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.settled = {}
+
+    def settle(self, msg_id, outcome):
+        self.settled[msg_id] = time.time()
+        super().settle(msg_id, outcome)
+
+
+class BenchTask(Task):
+    """Records when each file finished downloading and the id of its last message"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.published = {}
+
+    async def publish(self, part, payload):
+        msg_id = await super().publish(part, payload)
+        if msg_id is not None:
+            downloaded = part.job.ts.replace(tzinfo=datetime.timezone.utc).timestamp()
+            self.published[part.job.filename] = (downloaded, Delivery.parse(msg_id.split(",")[-1]))
+        return msg_id
+
+
+def serve_quietly(*args):
+    # The server reports each connection on standard output, which carries the results
+    sys.stdout = open(os.devnull, "w")
+    serve(*args)
+
+
+def file_sizes(count, distribution, minimum, maximum, rng):
+    if distribution == "fixed":
+        return [maximum] * count
+    if distribution == "uniform":
+        return [rng.randint(minimum, maximum) for _ in range(count)]
+
+    # Log-normal, with most files small and a long tail up to the maximum
+    mu = math.log(max(minimum, 1) * 10)
+    sigma = max(math.log(maximum / (max(minimum, 1) * 10)) / 2.5, 0.1)
+    return [min(max(int(rng.lognormvariate(mu, sigma)), minimum), maximum) for _ in range(count)]
+
+
+def make_files(root, sizes, compressible, rng):
+    line = b"201912,49900001234,Q,1,1000\n"
+    for n, size in enumerate(sizes):
+        with open(os.path.join(root, "bench-{0:06d}.xls".format(n)), "wb") as file:
+            if rng.random() < compressible:
+                file.write((line * (size // len(line) + 1))[:size])
+            else:
+                file.write(rng.getrandbits(8 * size).to_bytes(size, "little"))
+
+
+def percentile(values, p):
+    """Returns the nearest-rank percentile of a list of values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    root = tempfile.mkdtemp(prefix="seft-bench-")
+    sizes = file_sizes(args.files, args.distribution, args.min_size, args.max_size, rng)
+    make_files(root, sizes, args.compressible, rng)
+
+    server = multiprocessing.Process(
+        target=serve_quietly, args=(root, USER, PASSWORD, "127.0.0.1", args.port, "."), daemon=True
+    )
+    server.start()
+    try:
+        wait_for_port("127.0.0.1", args.port)
+        os.environ.update(
+            SEFT_FTP_USER=USER, SEFT_FTP_PASS=PASSWORD, SEFT_FTP_HOST="127.0.0.1",
+            SEFT_FTP_PORT=str(args.port), SEFT_PUBLISHER_FTP_FOLDER="."
+        )
+        os.environ.setdefault("SEFT_LEDGER_PATH", ":memory:")
+
+        broker = Broker(ack_latency=args.ack_latency / 1000, multiple=args.multiple)
+        task = BenchTask(None, {})
+        channel = task.publisher.publishers[0]
+        task.publisher = PublisherPool(
+            channels=args.channels, publisher=BenchPublisher, window=channel.window,
+            window_bytes=channel.window_bytes, connection_factory=broker.connect, **Task.amqp_params({})
+        )
+        task.publisher.connect()
+
+        # Files are only fetched once a listing shows them unchanged
+        with FTPWorker(**Task.ftp_params({})) as ftp:
+            task.sources[0].watcher.update(ftp.listing())
+
+        cycles = 0
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+
+        async def transfer():
+            nonlocal cycles
+            while not task.publisher.publishing:
+                await tornado.gen.sleep(0.01)
+            while cycles < args.cycles and (os.listdir(root) or len(task.ledger)):
+                cycles += 1
+                await task.transfer_files()
+
+        tornado.ioloop.IOLoop.current().run_sync(transfer)
+        elapsed = time.time() - started
+        final = resource.getrusage(resource.RUSAGE_SELF)
+        if task.encoders is not None:
+            task.encoders.shutdown()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(root, ignore_errors=True)
+
+    settled = {}
+    for publisher in task.publisher.publishers:
+        settled.update(publisher.settled)
+    latencies = [
+        settled[msg_id] - downloaded for downloaded, msg_id in task.published.values() if msg_id in settled
+    ]
+    transferred = sum(sizes)
+    return {
+        "revision": revision(),
+        "python": sys.version.split()[0],
+        "settings": {
+            k: v for k, v in sorted(os.environ.items()) if k.startswith("SEFT_") and "PASS" not in k
+        },
+        "files": args.files,
+        "bytes": transferred,
+        "distribution": args.distribution,
+        "seed": args.seed,
+        "channels": args.channels,
+        "cycles": cycles,
+        "published": len(task.published),
+        "remaining": len(task.ledger),
+        "elapsed_s": round(elapsed, 3),
+        "files_per_s": round(args.files / elapsed, 2),
+        "mb_per_s": round(transferred / elapsed / 1e6, 3),
+        "latency_s": {
+            "p{0}".format(p): round(percentile(latencies, p) or 0, 4) for p in (50, 95, 99)
+        },
+        "peak_rss_kb": final.ru_maxrss,
+        "cpu_s": round(final.ru_utime + final.ru_stime - usage.ru_utime - usage.ru_stime, 3),
+        "cpu_children_s": round(children.ru_utime + children.ru_stime, 3),
+    }
+
+
+def parser(description="Benchmark for the SEFT Publisher service."):
+    p = argparse.ArgumentParser(description)
+    p.add_argument(
+        "--files", type=int, default=200,
+        help="Set the number of files to transfer.")
+    p.add_argument(
+        "--distribution", choices=["fixed", "uniform", "lognormal"], default="uniform",
+        help="Set the distribution of file sizes.")
+    p.add_argument(
+        "--min-size", type=int, default=1024,
+        help="Set the smallest file size in bytes.")
+    p.add_argument(
+        "--max-size", type=int, default=1024 * 1024,
+        help="Set the largest file size in bytes.")
+    p.add_argument(
+        "--compressible", type=float, default=0.0,
+        help="Set the fraction of files filled with compressible text rather than random bytes.")
+    p.add_argument(
+        "--seed", type=int, default=0,
+        help="Set the random seed for file sizes.")
+    p.add_argument(
+        "--ack-latency", type=float, default=5,
+        help="Set the delay before the broker stand-in confirms messages, in milliseconds.")
+    p.add_argument(
+        "--multiple", action="store_true",
+        help="Confirm messages which arrive together with a single multiple ack.")
+    p.add_argument(
+        "--channels", type=int, default=1,
+        help="Set the number of channels to publish on.")
+    p.add_argument(
+        "--cycles", type=int, default=20,
+        help="Set the most transfer cycles to run.")
+    p.add_argument(
+        "--port", type=int, default=2122,
+        help="Set a port for the local FTP server.")
+    p.add_argument(
+        "--output", default=None,
+        help="Set a file path for the JSON results. Defaults to standard output.")
+    return p
+
+
+def main(args):
+    results = run(args)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    p = parser()
+    args = p.parse_args()
+    rv = main(args)
+    sys.exit(rv)
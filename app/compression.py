@@ -0,0 +1,47 @@
+import lzma
+import zlib
+
+from app.spool import CHUNK_SIZE, Spool
+
+CODECS = {
+    "zlib": lambda: zlib.compressobj(6),
+    "lzma": lambda: lzma.LZMACompressor(preset=1),
+}
+DECOMPRESSORS = {
+    "zlib": zlib.decompress,
+    "lzma": lzma.decompress,
+}
+MAX_RATIO = 0.9
+
+
+def worth_compressing(sample, codec, max_ratio=MAX_RATIO):
+    """Estimates from a sample whether compression would pay off"""
+    if not sample:
+        return False
+    compressor = CODECS[codec]()
+    size = len(compressor.compress(sample)) + len(compressor.flush())
+    return size <= len(sample) * max_ratio
+
+
+def compress(spool, codec, max_ratio=MAX_RATIO):
+    """Compresses the content of a spool if a sample of its first block compresses well
+
+    Files which are already compressed, such as `.xlsx`, are left alone.
+
+    :param codec:  One of CODECS, or None to disable compression
+    :return: A tuple of the codec used, or None, and a Spool of the content.
+        The original spool is returned when it is not compressed.
+    """
+    if codec is None or not worth_compressing(next(spool.chunks(CHUNK_SIZE), b""), codec, max_ratio):
+        return None, spool
+
+    compressor = CODECS[codec]()
+    out = Spool(threshold=spool.threshold)
+    for chunk in spool.chunks(CHUNK_SIZE):
+        out.write(compressor.compress(chunk))
+    out.write(compressor.flush())
+    return codec, out
+
+
+def decompress(data, codec):
+    return DECOMPRESSORS[codec](data) if codec else data
@@ -0,0 +1,113 @@
+import logging
+import queue
+import threading
+
+from structlog import wrap_logger
+
+DEFAULT_DELETE_BATCH = 50
+DEFAULT_LINGER_S = 0.05
+
+STOP = object()
+
+
+# pylint: disable=broad-except
+class Deleter:
+    """Deletes confirmed files from the FTP server in the background.
+
+    Files are queued by :meth:`submit`, usually from the IOLoop as broker
+    confirmations arrive, and deleted by a worker thread. Files which are
+    queued close together are deleted as a batch on one pooled session.
+    A file is only queued once while its deletion is pending.
+
+    :param pool:  A SessionPool
+    :param on_deleted:  Called as ``on_deleted(filename, msg_id)`` from the
+        worker thread after each file is deleted
+    :param on_failed:  Optionally called likewise as ``on_failed(filename, msg_id)``
+        for each file which could not be deleted
+    :param batch:  Most files deleted on one session
+    :param linger:  Seconds to wait for more files before starting a batch
+    """
+
+    def __init__(self, pool, on_deleted, batch=DEFAULT_DELETE_BATCH, linger=DEFAULT_LINGER_S, on_failed=None):
+        self.logger = wrap_logger(logging.getLogger(__name__))
+        self.pool = pool
+        self.on_deleted = on_deleted
+        self.on_failed = on_failed
+        self.batch = max(1, batch)
+        self.linger = linger
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __contains__(self, filename):
+        with self._lock:
+            return filename in self._pending
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, filename, msg_id=None):
+        """Queues a file for deletion
+
+        :return: False if the file was already queued
+        """
+        with self._lock:
+            if filename in self._pending:
+                return False
+            self._pending.add(filename)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="deleter", daemon=True)
+                self._thread.start()
+        self._queue.put((filename, msg_id))
+        return True
+
+    def stop(self, timeout=None):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(STOP)
+            thread.join(timeout)
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is STOP:
+                return
+
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch:
+                try:
+                    item = self._queue.get(timeout=self.linger)
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                self.delete(batch)
+            except Exception:
+                self.logger.exception("Failed to delete batch of files")
+            if stop:
+                return
+
+    def delete(self, batch):
+        self.logger.info("Deleting files", count=len(batch))
+        with self.pool.session() as ftp:
+            for filename, msg_id in batch:
+                try:
+                    deleted = ftp is not None and ftp.delete(filename)
+                finally:
+                    with self._lock:
+                        self._pending.discard(filename)
+                if deleted:
+                    self.on_deleted(filename, msg_id)
+                else:
+                    # The file stays confirmed in the ledger and is queued again by the next run
+                    self.logger.warning("Failed to delete file", filename=filename, msg_id=msg_id)
+                    if self.on_failed is not None:
+                        self.on_failed(filename, msg_id)
@@ -0,0 +1,208 @@
+from collections import deque
+import concurrent.futures
+import contextlib
+import logging
+import os
+
+import yaml
+from sdc.crypto.key_store import KeyStore
+from structlog import wrap_logger
+
+from app.compression import compress
+from app.encryption import encrypt_file, encrypt_parts
+from app.publisher import Part
+from app.spool import CHUNK_SIZE, DEFAULT_SPOOL_THRESHOLD, Spool
+
+DEFAULT_KEYS_FILE = "./jwt-test-keys/keys.yml"
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+_key_store = None
+
+
+def encode(claims, spool, key_store, key_purpose, codec=None, chunk_size=0, digest=None):
+    """Compresses and encrypts the content of a spool
+
+    :param codec:  Compression codec to try, or None
+    :param chunk_size:  Content larger than this is split into parts, unless it is 0
+    :param digest:  Digest of the original file, sent with parts
+    :return: A generator of (index, count, encoding, Spool) tuples
+    """
+    encoding, content = compress(spool, codec)
+    if encoding:
+        claims = dict(claims, encoding=encoding)
+    with content:
+        if chunk_size and content.size > chunk_size:
+            parts = encrypt_parts(claims, content, key_store, key_purpose, chunk_size, digest=digest or spool.digest)
+            for index, count, payload in parts:
+                yield index, count, encoding, payload
+        else:
+            yield 0, 1, encoding, encrypt_file(claims, content, key_store, key_purpose)
+
+
+def load_key_store():
+    """Loads the key store of a worker process, once"""
+    global _key_store
+    if _key_store is None:
+        with open(os.getenv("SDX_SEFT_CONSUMER_KEYS_FILE", DEFAULT_KEYS_FILE)) as file:
+            _key_store = KeyStore(yaml.safe_load(file))
+    return _key_store
+
+
+def prepare_worker():
+    load_key_store()
+
+
+def encode_in_process(claims, source, key_purpose, codec=None, chunk_size=0, digest=None,
+                      threshold=DEFAULT_SPOOL_THRESHOLD):
+    """Runs :func:`encode` in a worker process
+
+    Parts are returned in memory until they add up to `threshold` bytes.
+    The rest are left in files, so that a large file is not pickled back
+    to the parent in one piece.
+
+    :param source:  The file content, or the path of a file spooled to disk
+    :return: A list of (index, count, encoding, token) tuples. Each token is
+        the content, or the path of a file to :meth:`Spool.adopt`.
+    """
+    spool = Spool(threshold=threshold)
+    if isinstance(source, bytes):
+        spool.write(source)
+    else:
+        with open(source, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                spool.write(chunk)
+
+    parts = []
+    held = 0
+    try:
+        with spool:
+            for index, count, encoding, payload in encode(
+                claims, spool, load_key_store(), key_purpose, codec, chunk_size, digest
+            ):
+                with payload:
+                    if payload.on_disk or held + payload.size > threshold:
+                        token = payload.detach()
+                    else:
+                        token = payload.getvalue()
+                        held += len(token)
+                parts.append((index, count, encoding, token))
+    except BaseException:
+        discard(parts)
+        raise
+    return parts
+
+
+def discard(parts):
+    """Removes the files of parts returned by :func:`encode_in_process`"""
+    for unused_index, unused_count, unused_encoding, token in parts:
+        if isinstance(token, str):
+            with contextlib.suppress(OSError):
+                os.unlink(token)
+
+
+class SerialEncoder:
+    """Encodes files one at a time in the calling thread.
+
+    :param key_store:  The KeyStore used to sign and encrypt
+    """
+
+    def __init__(self, key_store, **options):
+        self.key_store = key_store
+        self.options = options
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def submit(self, job, tx_id, claims, key_purpose):
+        """Encodes a file, yielding its Parts"""
+        with job.file:
+            parts = encode(claims, job.file, self.key_store, key_purpose, digest=job.file.digest, **self.options)
+            for index, count, encoding, payload in parts:
+                yield Part(job, tx_id, index, count, payload, encoding)
+
+    def flush(self):
+        return ()
+
+
+# pylint: disable=broad-except
+class ParallelEncoder:
+    """Encodes files in a pool of processes, keeping up to `depth` files in progress.
+
+    Files are emitted in the order they were submitted when `ordered` is
+    set, otherwise in the order they complete. Each file stays open until
+    it is encoded, since a worker may read it from disk.
+
+    :param executor:  A ProcessPoolExecutor
+    :param depth:  Number of files in progress before :meth:`submit` waits
+    :param ordered:  Emit files in order of submission
+    """
+
+    def __init__(self, executor, depth, ordered=True, **options):
+        self.executor = executor
+        self.depth = max(1, depth)
+        self.ordered = ordered
+        self.options = options
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        while self.pending:
+            job, unused_tx_id, future = self.pending.popleft()
+            if not future.cancel() and not future.exception():
+                discard(future.result())
+            job.file.close()
+        return False
+
+    def submit(self, job, tx_id, claims, key_purpose):
+        """Starts encoding a file, then yields any Parts which are ready"""
+        source = job.file.name if job.file.on_disk else job.file.getvalue()
+        future = self.executor.submit(
+            encode_in_process, claims, source, key_purpose,
+            digest=job.file.digest, threshold=job.file.threshold, **self.options
+        )
+        self.pending.append((job, tx_id, future))
+        yield from self.ready(wait=len(self.pending) >= self.depth)
+
+    def ready(self, wait=False):
+        if self.ordered:
+            while self.pending and (wait or self.pending[0][2].done()):
+                wait = False
+                yield from self.collect(self.pending.popleft())
+        else:
+            if wait:
+                concurrent.futures.wait([i[2] for i in self.pending], return_when=concurrent.futures.FIRST_COMPLETED)
+            for entry in [i for i in self.pending if i[2].done()]:
+                self.pending.remove(entry)
+                yield from self.collect(entry)
+
+    def flush(self):
+        """Yields the Parts of every file still in progress"""
+        while self.pending:
+            yield from self.ready(wait=True)
+
+    def collect(self, entry):
+        job, tx_id, future = entry
+        try:
+            parts = future.result()
+        except Exception:
+            logger.exception("Failed to encode file", filename=job.filename)
+            return
+        finally:
+            job.file.close()
+
+        # Every part is taken over first, so that no file is left behind if the caller stops early
+        payloads = []
+        for index, count, encoding, token in parts:
+            if isinstance(token, str):
+                payload = Spool.adopt(token, threshold=job.file.threshold)
+            else:
+                payload = Spool(threshold=job.file.threshold)
+                payload.write(token)
+            payloads.append(Part(job, tx_id, index, count, payload, encoding))
+        yield from payloads
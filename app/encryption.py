@@ -0,0 +1,145 @@
+import base64
+import json
+import os
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from sdc.crypto.encrypter import encrypt
+
+from app.spool import CHUNK_SIZE, Spool
+
+CEK_LENGTH = 32
+IV_LENGTH = 12
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def stream_b64(chunks, encode=b64encode):
+    """Base64 encodes a stream of chunks, yielding encoded chunks"""
+    carry = b""
+    for chunk in chunks:
+        data = carry + chunk if carry else chunk
+        n = len(data) - len(data) % 3
+        carry = data[n:]
+        if n:
+            yield encode(data[:n])
+    if carry:
+        yield encode(carry)
+
+
+def stream_claims(claims, field, chunks):
+    """Serialises claims to JSON with the named field streamed as standard base64"""
+    head = json.dumps(dict(claims, **{field: ""}), separators=(",", ":"))
+    # Split the document where the empty field value sits
+    marker = '"{0}":""'.format(field)
+    n = head.index(marker) + len(marker) - 1
+    yield head[:n].encode("ascii")
+    yield from stream_b64(chunks, encode=base64.standard_b64encode)
+    yield head[n:].encode("ascii")
+
+
+def stream_jwt(claims, field, chunks, key):
+    """Signs claims as an RS256 JWT, yielding the compact serialisation in chunks"""
+    header = {"alg": "RS256", "kid": key.kid, "typ": "jwt"}
+    private_key = serialization.load_pem_private_key(
+        key.value.encode("ascii"), password=None, backend=default_backend()
+    )
+    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+
+    def signing_input():
+        yield b64encode(json.dumps(header, separators=(",", ":")).encode("ascii"))
+        yield b"."
+        yield from stream_b64(stream_claims(claims, field, chunks))
+
+    for chunk in signing_input():
+        digest.update(chunk)
+        yield chunk
+
+    signature = private_key.sign(digest.finalize(), padding.PKCS1v15(), Prehashed(hashes.SHA256()))
+    yield b"."
+    yield b64encode(signature)
+
+
+def encrypt_stream(claims, field, chunks, key_store, key_purpose, out=None):
+    """Encrypts claims into a JWE token without holding the whole file in memory
+
+    The token is equivalent to one made by :func:`sdc.crypto.encrypter.encrypt`:
+    an RS256 JWT encrypted with RSA-OAEP and A256GCM. The value of `field` is read
+    from `chunks` and encoded as standard base64.
+
+    :param claims:  Claims other than `field`
+    :param field:  Name of the claim read from `chunks`
+    :param chunks:  An iterable of bytes
+    :param out:  A writable buffer for the token. Defaults to a new Spool.
+    :return: The buffer containing the token
+    """
+    out = Spool() if out is None else out
+    jwt_key = key_store.get_key_for_purpose_and_type(key_purpose, "private")
+    jwe_key = key_store.get_key_for_purpose_and_type(key_purpose, "public")
+    public_key = serialization.load_pem_public_key(
+        jwe_key.value.encode("ascii"), backend=default_backend()
+    )
+
+    protected = b64encode(json.dumps(
+        {"alg": "RSA-OAEP", "enc": "A256GCM", "kid": jwe_key.kid}, separators=(",", ":")
+    ).encode("ascii"))
+    cek = os.urandom(CEK_LENGTH)
+    iv = os.urandom(IV_LENGTH)
+    encrypted_key = public_key.encrypt(
+        cek,
+        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None)
+    )
+    encryptor = Cipher(algorithms.AES(cek), modes.GCM(iv), backend=default_backend()).encryptor()
+    encryptor.authenticate_additional_data(protected)
+
+    out.write(b".".join([protected, b64encode(encrypted_key), b64encode(iv), b""]))
+    ciphertext = (encryptor.update(chunk) for chunk in stream_jwt(claims, field, chunks, jwt_key))
+    for chunk in stream_b64(ciphertext):
+        out.write(chunk)
+    encryptor.finalize()
+    out.write(b".")
+    out.write(b64encode(encryptor.tag))
+    return out
+
+
+def encrypt_file(claims, spool, key_store, key_purpose):
+    """Encrypts claims with the content of a spool as the `file` claim
+
+    Files held in memory are encrypted by sdc-cryptography. Files which
+    have been spooled to disk are streamed through :func:`encrypt_stream`.
+
+    :return: A Spool containing the JWE token
+    """
+    if not spool.on_disk:
+        data = dict(claims, file=base64.standard_b64encode(spool.getvalue()).decode("ascii"))
+        out = Spool()
+        out.write(encrypt(data, key_store, key_purpose).encode("ascii"))
+        return out
+
+    out = Spool(threshold=spool.threshold)
+    return encrypt_stream(claims, "file", spool.chunks(CHUNK_SIZE), key_store, key_purpose, out=out)
+
+
+def encrypt_parts(claims, spool, key_store, key_purpose, part_size, digest=None):
+    """Encrypts the content of a spool as a series of tokens of at most `part_size` bytes of file each
+
+    Every token carries the `part` index counting from zero, the number of
+    `parts` and the SHA-256 `digest` of the whole file, so that a consumer
+    can reassemble and verify the file.
+
+    :param digest:  The digest to send, if the spool holds an encoded form of the file
+    :return: A generator of (index, count, Spool) tuples
+    """
+    count = max(1, -(-spool.size // part_size))
+    for index in range(count):
+        start = index * part_size
+        part_claims = dict(claims, part=index, parts=count, digest=digest or spool.digest)
+        out = Spool(threshold=spool.threshold)
+        chunks = spool.chunks(CHUNK_SIZE, start=start, length=part_size)
+        yield index, count, encrypt_stream(part_claims, "file", chunks, key_store, key_purpose, out=out)
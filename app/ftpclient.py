@@ -1,12 +1,82 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import datetime
-from ftplib import FTP
-from io import BytesIO
+from ftplib import FTP, error_perm, error_temp
+import io
 import logging
 from os import path
+import queue
+import re
+import threading
+import time
+import weakref
 
 from structlog import wrap_logger
 
 from app.publisher import Job
+from app.spool import CHUNK_SIZE, DEFAULT_SPOOL_THRESHOLD, Spool
+
+DEFAULT_HOST_CONNECTIONS = 8
+DEFAULT_POOL_SIZE = 3
+DEFAULT_KEEPALIVE_S = 60
+DEFAULT_CLAIM_LEASE_S = 30 * 60
+DEFAULT_RESUME_ATTEMPTS = 3
+
+Entry = namedtuple("Entry", ["name", "size", "modify", "type"])
+
+DOS_LIST_LINE = re.compile(r"^(\d{2}-\d{2}-\d{2,4}\s+\d{1,2}:\d{2}[AP]M)\s+(<DIR>|\d+)\s+(.+)$")
+
+
+def parse_list_line(line):
+    """Parses a line of LIST output in Unix or DOS format
+
+    :return: An Entry, or None if the line is not recognised
+    """
+    match = DOS_LIST_LINE.match(line)
+    if match:
+        modify, size, name = match.groups()
+        if size == "<DIR>":
+            return Entry(name, None, modify, "dir")
+        return Entry(name, int(size), modify, "file")
+
+    parts = line.split(None, 8)
+    if len(parts) == 9 and parts[0][:1] in ("-", "d", "l"):
+        kind = {"-": "file", "d": "dir"}.get(parts[0][0], "link")
+        return Entry(parts[8], int(parts[4]) if parts[4].isdigit() else None, " ".join(parts[5:8]), kind)
+
+    return None
+
+
+class ListingWatcher:
+    """Compares successive directory listings to find files which have finished uploading
+
+    A file is stable once it has been listed with the same size and
+    modification time by two consecutive polls. Files which are still
+    changing are held back.
+    """
+
+    def __init__(self):
+        self.previous = {}
+
+    def update(self, entries):
+        """Records a new listing
+
+        :param entries:  An iterable of Entry
+        :return: A tuple of the stable files and the number held back
+        """
+        current = {e.name: e for e in entries if e.type == "file"}
+        stable = [e for e in current.values() if self.previous.get(e.name) == e]
+        self.previous = current
+        return stable, len(current) - len(stable)
+
+    def get(self, name):
+        """The Entry of a file in the last listing, or None"""
+        return self.previous.get(name)
+
+    def sizes(self):
+        """The sizes of the files in the last listing, by name"""
+        return {name: entry.size for name, entry in self.previous.items() if entry.size is not None}
 
 
 # pylint: disable=broad-except
@@ -17,67 +87,415 @@ class FTPWorker:
         p = path.join(*str_path.split('\\'))
         return path.basename(path.normpath(p))
 
-    def __init__(self, user, password, host, port, working_directory, timeout=30):
+    host_limits = {}
+    host_limits_lock = threading.Lock()
+
+    # Errors after which the session is reconnected and the command tried again
+    TRANSIENT_ERRORS = (error_temp, EOFError, OSError)
+
+    LEASE_SUFFIX = ".lease"
+
+    # Replies from servers which do not implement REST
+    REST_UNSUPPORTED = ("500", "501", "502", "504")
+
+    def __init__(
+        self, user, password, host, port, working_directory, timeout=30,
+        connections=1, host_connections=DEFAULT_HOST_CONNECTIONS, spool_threshold=DEFAULT_SPOOL_THRESHOLD,
+        claim_directory=None, replica=None, resume_attempts=DEFAULT_RESUME_ATTEMPTS
+    ):
         self.logger = wrap_logger(logging.getLogger(__name__))
         self.user, self.password = user, password
         self.host, self.port = host, port
         self.timeout = timeout
         self.working_directory = self.get_wd(working_directory)
+        self.connections = connections
+        self.host_connections = host_connections
+        self.spool_threshold = spool_threshold
+        self.claim_directory = claim_directory or None
+        self.replica = replica
+        self.resume_attempts = resume_attempts
+        # Until the server refuses REST
+        self.resumable = True
         self.ftp = FTP()
+        self.connected = False
+        self._slot = None
 
     def __enter__(self):
+        return self.connect()
+
+    @property
+    def slots(self):
+        """The semaphore which limits concurrent sessions to this host"""
+        key = (self.host, self.port)
+        with self.host_limits_lock:
+            if key not in self.host_limits:
+                self.host_limits[key] = threading.BoundedSemaphore(self.host_connections)
+            return self.host_limits[key]
+
+    def clone(self):
+        """Creates an unconnected worker with the same parameters"""
+        return FTPWorker(
+            self.user, self.password, self.host, self.port, self.working_directory,
+            timeout=self.timeout, host_connections=self.host_connections,
+            spool_threshold=self.spool_threshold, claim_directory=self.claim_directory, replica=self.replica,
+            resume_attempts=self.resume_attempts
+        )
+
+    def connect(self, wait=True):
+        """Connects, logs in and changes to the working directory
+
+        :param wait:  Whether to wait for a free session slot if the host limit has been reached
+        """
+        slots = self.slots
+        acquired = slots.acquire(timeout=self.timeout) if wait else slots.acquire(blocking=False)
+        if not acquired:
+            self.logger.warning("Too many FTP sessions open", host=self.host, limit=self.host_connections)
+            return None
+        self._slot = slots
+
         try:
             self.ftp.connect(self.host, self.port, timeout=self.timeout)
         except Exception:
             self.logger.exception("Failed to connect to FTP server")
+            self.release()
             return None
 
         try:
             self.ftp.login(user=self.user, passwd=self.password)
             self.ftp.cwd(self.working_directory)
+            if self.claim_directory:
+                for directory in (self.claim_directory, self.claim_path):
+                    with contextlib.suppress(error_perm):
+                        # Fails if the directory already exists
+                        self.ftp.mkd(directory)
         except Exception:
             self.logger.exception("Failed to login/cwd to FTP server")
+            self.release()
             return None
 
+        self.connected = True
         return self
 
+    def reconnect(self):
+        """Drops the current connection, if any, and connects again"""
+        try:
+            self.ftp.close()
+        except Exception:
+            pass
+        self.release()
+        self.ftp = FTP()
+        return self.connect()
+
+    def retrying(self, func, *args, **kwargs):
+        """Runs an FTP command, reconnecting and trying again once if the session was lost"""
+        try:
+            return func(*args, **kwargs)
+        except self.TRANSIENT_ERRORS as e:
+            self.logger.warning("FTP session lost, reconnecting", error=str(e))
+            if self.reconnect() is None:
+                raise
+            return func(*args, **kwargs)
+
+    def release(self):
+        self.connected = False
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
     @property
     def filenames(self):
         """Gets list of filenames in directory using NLST"""
         try:
-            return self.ftp.nlst()
+            return [name for name in self.retrying(lambda: self.ftp.nlst()) if name != self.claim_directory]
         except Exception:
             self.logger.exception("Error getting filenames")
             return []
 
+    def listing(self):
+        """Lists files in directory with their size and modification time
+
+        Uses MLSD where the server supports it, otherwise parses the output of LIST.
+
+        :return: A list of Entry
+        """
+        try:
+            return [
+                Entry(name, int(facts["size"]) if "size" in facts else None, facts.get("modify"), facts.get("type"))
+                for name, facts in self.retrying(lambda: list(self.ftp.mlsd(facts=["type", "size", "modify"])))
+            ]
+        except error_perm:
+            self.logger.info("MLSD not supported, falling back to LIST")
+        except Exception:
+            self.logger.exception("Error getting listing")
+            return []
+
+        lines = []
+
+        def list_lines():
+            del lines[:]
+            self.ftp.retrlines("LIST", lines.append)
+
+        try:
+            self.retrying(list_lines)
+        except Exception:
+            self.logger.exception("Error getting listing")
+            return []
+        return [e for e in (parse_list_line(line) for line in lines) if e is not None]
+
     def check(self):
         """Checks connection is alive using NOOP command"""
         with self as connected:
+            return connected is not None and connected.noop()
+
+    def noop(self):
+        """Sends NOOP on this session, reconnecting if the server has dropped it"""
+        try:
+            self.retrying(lambda: self.ftp.voidcmd("NOOP"))
+        except Exception:
+            self.logger.exception("Failed NOOP command")
+            return False
+        else:
+            return True
+
+    @property
+    def claim_path(self):
+        """The directory holding the files claimed by this replica"""
+        return "{0}/{1}".format(self.claim_directory, self.replica)
+
+    def remote_path(self, filename):
+        """The path of a file to retrieve or delete, which is in the claim directory once claimed"""
+        return "{0}/{1}".format(self.claim_path, filename) if self.claim_directory else filename
+
+    def claim(self, filename):
+        """Claims a file for this replica by moving it into the replica's claim directory
+
+        The server renames files atomically, so each file is claimed by one
+        replica only.
+
+        :return: True if this replica holds the file
+        """
+        try:
+            self.retrying(lambda: self.ftp.rename(filename, self.remote_path(filename)))
+        except error_perm:
+            self.logger.info("File was claimed by another replica", filename=filename)
+            return False
+        except Exception:
+            self.logger.exception("Failed to claim file", filename=filename)
+            return False
+        return True
+
+    def claimed(self):
+        """Lists the files claimed by this replica, including those claimed before a restart"""
+        try:
+            return [path.basename(name) for name in self.retrying(lambda: self.ftp.nlst(self.claim_path))]
+        except Exception:
+            self.logger.exception("Error getting claimed files")
+            return []
+
+    def renew_lease(self):
+        """Records the time in this replica's lease file, so that its claims are not taken from it"""
+        lease = "{0}/{1}{2}".format(self.claim_directory, self.replica, self.LEASE_SUFFIX)
+        stamp = str(time.time()).encode("ascii")
+        try:
+            self.retrying(lambda: self.ftp.storbinary("STOR {0}".format(lease), io.BytesIO(stamp)))
+        except Exception:
+            self.logger.exception("Failed to renew lease", replica=self.replica)
+            return False
+        return True
+
+    def reclaim(self, lease):
+        """Returns the files claimed by replicas whose lease has expired to the working directory
+
+        Replicas are expected to keep their clocks in step.
+
+        :param lease:  Seconds after which a lease which has not been renewed expires
+        :return: The number of files returned
+        """
+        def renewed(name):
+            buf = io.BytesIO()
+            self.ftp.retrbinary("RETR {0}/{1}".format(self.claim_directory, name), buf.write)
+            try:
+                return float(buf.getvalue())
+            except ValueError:
+                return 0
+
+        count = 0
+        try:
+            names = [path.basename(name) for name in self.retrying(lambda: self.ftp.nlst(self.claim_directory))]
+            for name in names:
+                replica = name[:-len(self.LEASE_SUFFIX)]
+                if not name.endswith(self.LEASE_SUFFIX) or replica == self.replica:
+                    continue
+                if time.time() - self.retrying(renewed, name) < lease:
+                    continue
+
+                self.logger.warning("Reclaiming files from replica with an expired lease", replica=replica)
+                directory = "{0}/{1}".format(self.claim_directory, replica)
+                for filename in [path.basename(n) for n in self.retrying(lambda: self.ftp.nlst(directory))]:
+                    try:
+                        self.ftp.rename("{0}/{1}".format(directory, filename), filename)
+                        count += 1
+                    except error_perm:
+                        # Another replica returned it first
+                        pass
+                with contextlib.suppress(error_perm):
+                    self.ftp.delete("{0}/{1}".format(self.claim_directory, name))
+        except Exception:
+            self.logger.exception("Failed to reclaim files")
+        return count
+
+    def size(self, filename):
+        """Gets the size of a file with the SIZE command
+
+        :return: The size in bytes, or None if the server does not say
+        """
+        try:
+            return self.ftp.size(self.remote_path(filename))
+        except Exception:
+            return None
+
+    def retrieve(self, filename, size=None):
+        """Gets a single file from FTP server using RETR command
+
+        If the transfer is cut off, the session reconnects and carries on
+        from the end of the data received so far with REST, up to
+        `resume_attempts` times. The partial data is kept on disk meanwhile.
+        Servers which do not accept REST send the file again from the start.
+        A resumed file is checked against the size from SIZE, if the
+        expected size is not given.
+
+        :param filename:  The name of the file to retrieve
+        :param size:  The expected size, eg: from the listing
+        :return: A Job with the file content in a Spool, or None if the file could not be retrieved
+        """
+        buf = Spool(threshold=self.spool_threshold)
+        attempts = 0
+        while True:
             try:
-                connected.ftp.voidcmd("NOOP")
-            except AttributeError:
-                return False
+                self.ftp.retrbinary(
+                    "RETR {0}".format(self.remote_path(filename)), callback=buf.write, blocksize=CHUNK_SIZE,
+                    rest=buf.size or None
+                )
+                break
+            except error_perm as e:
+                if not buf.size or str(e)[:3] not in self.REST_UNSUPPORTED:
+                    self.logger.exception("Failed to get file", filename=filename)
+                    buf.close()
+                    return None
+                self.logger.warning("Server does not support REST, downloading again", filename=filename)
+                self.resumable = False
+                buf.close()
+                buf = Spool(threshold=self.spool_threshold)
+            except self.TRANSIENT_ERRORS as e:
+                attempts += 1
+                if attempts > self.resume_attempts:
+                    self.logger.exception("Failed to get file", filename=filename)
+                    buf.close()
+                    return None
+                self.logger.warning(
+                    "Transfer interrupted, reconnecting", filename=filename, received=buf.size, error=str(e)
+                )
+                if not self.resumable:
+                    buf.close()
+                    buf = Spool(threshold=self.spool_threshold)
+                elif buf.size:
+                    # The data received so far is kept on disk while the session reconnects
+                    buf.rollover()
+                if self.reconnect() is None:
+                    buf.close()
+                    return None
             except Exception:
-                self.logger.exception("Failed NOOP command")
-                return False
-            else:
-                return True
+                self.logger.exception("Failed to get file", filename=filename)
+                buf.close()
+                return None
+
+        if size is None and attempts:
+            size = self.size(filename)
+        if size is not None and buf.size != size:
+            self.logger.error("Downloaded file is the wrong size", filename=filename, size=buf.size, expected=size)
+            buf.close()
+            return None
+        return Job(datetime.datetime.utcnow(), filename, buf)
 
-    def get(self, filenames):
+    def get(self, filenames, connections=None, sizes=None):
         """Gets files from FTP server using RETR command
 
+        :param filenames:  List of filenames to retrieve from FTP server. Files
+            which fail to download are left in the list.
+        :param connections:  Number of FTP sessions to spread the files over.
+            Defaults to the number this worker was configured with.
+        :param sizes:  Optional dict of the expected size of each file
+        """
+        connections = connections or self.connections
+        sizes = sizes or {}
+        if connections > 1:
+            yield from self.get_concurrent(filenames, connections, sizes)
+            return
+
+        for fp in list(filenames):
+            job = self.retrieve(fp, sizes.get(fp))
+            if job is not None:
+                filenames.remove(fp)
+                yield job
+
+    def get_concurrent(self, filenames, connections, sizes=None):
+        """Gets files over several FTP sessions at once
+
+        This session retrieves files alongside up to `connections - 1` extra
+        sessions, but no more than there are files. Jobs are yielded in the order they finish. Files which fail
+        to download are left in `filenames`.
+
         :param filenames:  List of filenames to retrieve from FTP server
+        :param connections:  Maximum number of FTP sessions to use
+        :param sizes:  Optional dict of the expected size of each file
         """
-        while filenames:
-            fp = filenames[0]
-            buf = BytesIO()
+        sizes = sizes or {}
+        pending = queue.Queue()
+        for fp in filenames:
+            pending.put(fp)
+
+        # Bounded so that sessions wait for the consumer rather than buffer files
+        results = queue.Queue(maxsize=connections)
+        stop = threading.Event()
+
+        def work(session, owned):
+            connected = not owned or session.connect(wait=False) is not None
             try:
-                self.ftp.retrbinary("RETR {0}".format(fp), callback=buf.write)
-            except Exception:
-                self.logger.exception("Failed to get file")
-            else:
-                yield Job(datetime.datetime.utcnow(), fp, buf.getvalue())
-                filenames.remove(fp)
+                while connected and not stop.is_set():
+                    try:
+                        fp = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    results.put((fp, session.retrieve(fp, sizes.get(fp))))
+            finally:
+                if owned and connected:
+                    session.close()
+                results.put(None)
+
+        extra = min(connections, len(filenames)) - 1
+        sessions = [(self, False)] + [(self.clone(), True) for _ in range(extra)]
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            for session, owned in sessions:
+                executor.submit(work, session, owned)
+
+            running = len(sessions)
+            try:
+                while running:
+                    item = results.get()
+                    if item is None:
+                        running -= 1
+                        continue
+
+                    fp, job = item
+                    if job is not None:
+                        filenames.remove(fp)
+                        yield job
+            finally:
+                # Unblock the sessions if the caller stops early
+                stop.set()
+                while running:
+                    if results.get() is None:
+                        running -= 1
 
     def delete(self, filename):
         """Deletes file from FTP server
@@ -85,15 +503,153 @@ class FTPWorker:
         :param filename:  The name of the file to be deleted
         """
         try:
-            self.ftp.delete(filename)
+            self.retrying(lambda: self.ftp.delete(self.remote_path(filename)))
             return True
         except Exception:
             self.logger.exception("Failed to delete file")
             return False
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def close(self):
         try:
             self.ftp.quit()
         except Exception:
             self.logger.exception("Error during connection closure")
+        finally:
+            self.release()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
         return False
+
+
+# pylint: disable=broad-except
+class SessionPool:
+    """Keeps FTP sessions open between transfer cycles and health checks.
+
+    Up to `size` idle sessions are kept, and :meth:`keepalive` sends NOOP on
+    those idle for longer than `keepalive` seconds so the server does not
+    drop them. The outcome of the most recent connection or command is kept
+    in `healthy`, so a health check need not open a session of its own.
+
+    Idle sessions hold their slot of the host limit, so pools for the same
+    host keep no more than the limit between them. When a pool needs a
+    session and the host has none to spare, the longest idle session of
+    any of the host's pools is closed to make room, as soon as there is one.
+
+    :param keepalive:  Seconds a session may be idle before it is sent NOOP
+    :param params:  Arguments for each FTPWorker
+    """
+
+    # The pools of each host
+    hosts = {}
+    hosts_lock = threading.Lock()
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, keepalive=DEFAULT_KEEPALIVE_S, **params):
+        self.logger = wrap_logger(logging.getLogger(__name__))
+        self.size = size
+        self.keepalive_s = keepalive
+        self.params = params
+        self.healthy = None
+        self.checked = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self.host = (params.get("host"), params.get("port"))
+        with self.hosts_lock:
+            self.hosts.setdefault(self.host, weakref.WeakSet()).add(self)
+
+    def neighbours(self):
+        """The pools for this pool's host, including this one"""
+        with self.hosts_lock:
+            return list(self.hosts.get(self.host, ()))
+
+    def record(self, healthy):
+        self.healthy = healthy
+        self.checked = time.time()
+
+    def acquire(self):
+        """Returns a connected session, reusing an idle one if possible, or None"""
+        with self._lock:
+            worker = self._idle.pop()[0] if self._idle else None
+        if worker is None:
+            worker = FTPWorker(**self.params)
+            self.make_room(worker)
+            worker = worker.connect()
+            self.record(worker is not None)
+        return worker
+
+    def make_room(self, worker):
+        """Waits for the host to have a slot for a new session, closing idle sessions of its pools to free one"""
+        deadline = time.monotonic() + worker.timeout
+        while time.monotonic() < deadline:
+            if worker.slots.acquire(timeout=0.05):
+                worker.slots.release()
+                return
+            self.evict()
+
+    def evict(self):
+        """Closes the longest idle session of the host's pools, freeing its slot
+
+        :return: True if a session was closed
+        """
+        oldest = None
+        for pool in self.neighbours():
+            with pool._lock:
+                if pool._idle and (oldest is None or pool._idle[0][1] < oldest[1]):
+                    oldest = (pool, pool._idle[0][1])
+        if oldest is None:
+            return False
+        pool = oldest[0]
+        with pool._lock:
+            worker = pool._idle.pop(0)[0] if pool._idle else None
+        if worker is None:
+            return False
+        worker.close()
+        return True
+
+    def release(self, worker):
+        """Returns a session to the pool, or closes it if the pool is full or the session is broken"""
+        if worker is None:
+            return
+        # The session reconnects if the server drops it, so it is only broken if that failed
+        self.record(worker.connected)
+        with self._lock:
+            if worker.connected and len(self._idle) < self.size:
+                self._idle.append((worker, time.monotonic()))
+                return
+        if worker.connected:
+            worker.close()
+        else:
+            worker.release()
+
+    @contextlib.contextmanager
+    def session(self):
+        """A session for the duration of a with block. Yields None if no session could be opened."""
+        worker = self.acquire()
+        try:
+            yield worker
+        finally:
+            self.release(worker)
+
+    def keepalive(self):
+        """Sends NOOP on sessions which have been idle for a while"""
+        now = time.monotonic()
+        with self._lock:
+            due = [worker for worker, used in self._idle if now - used >= self.keepalive_s]
+            self._idle = [(worker, used) for worker, used in self._idle if now - used < self.keepalive_s]
+        for worker in due:
+            healthy = worker.noop()
+            self.record(healthy)
+            self.release(worker)
+
+    def check(self):
+        """Checks the server with NOOP on a pooled session"""
+        with self.session() as worker:
+            healthy = worker is not None and worker.noop()
+        self.record(healthy)
+        return healthy
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker, _ in idle:
+            worker.close()
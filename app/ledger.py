@@ -0,0 +1,337 @@
+import base64
+from collections import namedtuple
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from structlog import wrap_logger
+
+DEFAULT_LEDGER_PATH = "seft-ledger.db"
+DEFAULT_RETENTION_S = 7 * 24 * 60 * 60  # 1 week
+DEFAULT_DEDUPE_TTL_S = 24 * 60 * 60  # 1 day
+DEFAULT_DEDUPE_MAX = 100000
+
+Record = namedtuple(
+    "Record", ["filename", "size", "digest", "msg_id", "published", "updated", "state", "failures", "modify"]
+)
+
+COLUMNS = ", ".join(Record._fields)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    size INTEGER,
+    digest TEXT,
+    msg_id,
+    published REAL,
+    updated REAL,
+    state TEXT NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    modify TEXT
+);
+CREATE TABLE IF NOT EXISTS digests (
+    source TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    seen REAL NOT NULL,
+    PRIMARY KEY (source, digest)
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS files_state ON files (state, published);
+CREATE INDEX IF NOT EXISTS files_published ON files (published, filename);
+CREATE INDEX IF NOT EXISTS digests_seen ON digests (seen);
+"""
+
+
+class Ledger:
+    """Records the publication of files in an SQLite database.
+
+    The ledger outlives the process, so that files which were published
+    before a restart are not published again. Entries which have been
+    deleted from the FTP server are kept for the retention period, then
+    removed by :meth:`compact`.
+
+    The SHA-256 digests of published files are indexed by source, so that
+    a file with the same content as one published recently from the same
+    source can be found by :meth:`original`. Digests are kept for `dedupe_ttl` seconds after they
+    were last seen, and only the `dedupe_max` most recently seen are kept.
+
+    :param path:  Path to the database file, or ``:memory:``
+    :param retention:  Seconds to keep entries after they are deleted
+    :param dedupe_ttl:  Seconds to keep digests, or 0 to keep none
+    :param dedupe_max:  Most digests kept
+    """
+
+    PUBLISHED = "published"
+    CONFIRMED = "confirmed"
+    DELETED = "deleted"
+    # Skipped, as a file with the same content was published
+    DUPLICATE = "duplicate"
+    # Not a state of its own, but confirmed files which could not be deleted
+    DELETE_FAILED = "delete_failed"
+
+    LIVE = (PUBLISHED, CONFIRMED)
+    # Files still on the FTP server, which are not published again unless they change
+    CURRENT = LIVE + (DUPLICATE,)
+    STATES = (PUBLISHED, CONFIRMED, DELETED, DELETE_FAILED, DUPLICATE)
+
+    def __init__(
+        self, path=DEFAULT_LEDGER_PATH, retention=DEFAULT_RETENTION_S,
+        dedupe_ttl=DEFAULT_DEDUPE_TTL_S, dedupe_max=DEFAULT_DEDUPE_MAX
+    ):
+        self.logger = wrap_logger(logging.getLogger(__name__))
+        self.path = path
+        self.retention = retention
+        self.dedupe_ttl = dedupe_ttl
+        self.dedupe_max = dedupe_max
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        # Ledgers written by earlier versions
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(files)")]
+        if "failures" not in columns:
+            self._db.execute("ALTER TABLE files ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+        if "modify" not in columns:
+            self._db.execute("ALTER TABLE files ADD COLUMN modify TEXT")
+        if "source" not in [row[1] for row in self._db.execute("PRAGMA table_info(digests)")]:
+            # Digests were once shared by all sources. They only serve to skip recent copies, so they are dropped.
+            self._db.execute("DROP TABLE digests")
+            self._db.executescript(SCHEMA)
+        self._db.executescript(INDEXES)
+
+    def _execute(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def __contains__(self, filename):
+        return bool(self._execute(
+            "SELECT 1 FROM files WHERE filename = ? AND state IN (?, ?)", filename, *self.LIVE
+        ))
+
+    def __iter__(self):
+        return (row[0] for row in self._execute(
+            "SELECT filename FROM files WHERE state IN (?, ?) ORDER BY published", *self.LIVE
+        ))
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM files WHERE state IN (?, ?)", *self.LIVE)[0][0]
+
+    def items(self):
+        """Returns (filename, msg_id) pairs for files not yet deleted, oldest first"""
+        return self._execute(
+            "SELECT filename, msg_id FROM files WHERE state IN (?, ?) ORDER BY published", *self.LIVE
+        )
+
+    def get(self, filename):
+        """Returns the Record of a file, or None if it is not in the ledger"""
+        rows = self._execute("SELECT {0} FROM files WHERE filename = ?".format(COLUMNS), filename)
+        return Record(*rows[0]) if rows else None
+
+    def page(self, states=(), published_before=None, published_after=None, cursor=None, limit=100):
+        """Returns Records in the order they were published, a page at a time
+
+        :param states:  Only return files in these states. DELETE_FAILED
+            selects confirmed files whose deletion has failed.
+        :param published_before:  Only return files published before this time
+        :param published_after:  Only return files published after this time
+        :param cursor:  Continue after the record this cursor was made from, see :meth:`cursor`
+        :return: A list of at most `limit` Records
+        """
+        where, args = [], []
+        if states:
+            clauses = []
+            for state in states:
+                if state == self.DELETE_FAILED:
+                    clauses.append("(state = ? AND failures > 0)")
+                    args.append(self.CONFIRMED)
+                else:
+                    clauses.append("state = ?")
+                    args.append(state)
+            where.append("({0})".format(" OR ".join(clauses)))
+        if published_before is not None:
+            where.append("published < ?")
+            args.append(published_before)
+        if published_after is not None:
+            where.append("published > ?")
+            args.append(published_after)
+        if cursor is not None:
+            published, filename = self.parse_cursor(cursor)
+            where.append("(published > ? OR (published = ? AND filename > ?))")
+            args.extend([published, published, filename])
+
+        rows = self._execute(
+            "SELECT {0} FROM files {1} ORDER BY published, filename LIMIT ?".format(
+                COLUMNS, "WHERE " + " AND ".join(where) if where else ""
+            ),
+            *args, limit
+        )
+        return [Record(*row) for row in rows]
+
+    @staticmethod
+    def cursor(record):
+        """Makes an opaque cursor which continues a page after this record"""
+        text = json.dumps([record.published, record.filename])
+        return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """:raises ValueError: If the cursor was not made by :meth:`cursor`"""
+        try:
+            published, filename = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+            return float(published), str(filename)
+        except (TypeError, UnicodeError, ValueError) as e:
+            raise ValueError("Invalid cursor") from e
+
+    def state(self, filename):
+        rows = self._execute("SELECT state FROM files WHERE filename = ?", filename)
+        return rows[0][0] if rows else None
+
+    def publish(self, filename, msg_id, size=None, digest=None, modify=None, source=""):
+        """Records a published file
+
+        :param modify:  The modification time of the file in the listing, if known
+        :param source:  The name of the file's source, under which its digest is indexed
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (filename, size, digest, msg_id, published, updated, state, modify) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, size, digest, msg_id, now, now, self.PUBLISHED, modify)
+            )
+            if digest is not None and self.dedupe_ttl:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO digests (source, digest, filename, seen) VALUES (?, ?, ?, ?)",
+                    (source, digest, filename, now)
+                )
+
+    def original(self, digest, source="", now=None):
+        """Finds the file published from a source with this content within the TTL, and marks the digest as seen
+
+        :return: The filename, or None
+        """
+        if digest is None or not self.dedupe_ttl:
+            return None
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT filename FROM digests WHERE source = ? AND digest = ? AND seen >= ?",
+                (source, digest, now - self.dedupe_ttl)
+            ).fetchall()
+            if rows:
+                self._db.execute("UPDATE digests SET seen = ? WHERE source = ? AND digest = ?", (now, source, digest))
+        return rows[0][0] if rows else None
+
+    def duplicate(self, filename, size=None, digest=None, modify=None):
+        """Records a file which was not published, as its content had been"""
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO files (filename, size, digest, msg_id, published, updated, state, modify) "
+            "VALUES (?, ?, ?, NULL, ?, ?, ?, ?)",
+            filename, size, digest, now, now, self.DUPLICATE, modify
+        )
+
+    def touch(self, filename):
+        """Marks a duplicate as seen on the FTP server, so that it is not compacted"""
+        self._execute(
+            "UPDATE files SET updated = ? WHERE filename = ? AND state = ?", time.time(), filename, self.DUPLICATE
+        )
+
+    def confirm(self, filename, msg_id=None):
+        """Marks a published file as confirmed. A file which has been deleted since stays deleted.
+
+        :param msg_id:  Only confirm the file if it was last published as this message
+        :return: True if the file was confirmed
+        """
+        sql = "UPDATE files SET state = ?, updated = ? WHERE filename = ? AND state = ?"
+        args = [self.CONFIRMED, time.time(), filename, self.PUBLISHED]
+        if msg_id is not None:
+            sql += " AND msg_id = ?"
+            args.append(msg_id)
+        with self._lock:
+            return self._db.execute(sql, args).rowcount > 0
+
+    def delete(self, filename):
+        self._update(filename, self.DELETED)
+
+    def delete_failed(self, filename):
+        """Counts a failed attempt to delete a confirmed file"""
+        self._execute(
+            "UPDATE files SET failures = failures + 1, updated = ? WHERE filename = ? AND state = ?",
+            time.time(), filename, self.CONFIRMED
+        )
+
+    def discard(self, filename, msg_id=None):
+        """Removes a file from the ledger, so that it will be published again
+
+        :param msg_id:  Only remove the file if it was last published as this message
+        """
+        sql, args = "DELETE FROM files WHERE filename = ?", [filename]
+        if msg_id is not None:
+            sql += " AND msg_id = ?"
+            args.append(msg_id)
+        with self._lock:
+            if self._db.execute(sql, args).rowcount:
+                self._db.execute("DELETE FROM digests WHERE filename = ?", (filename,))
+
+    def _update(self, filename, state):
+        self._execute("UPDATE files SET state = ?, updated = ? WHERE filename = ?", state, time.time(), filename)
+
+    def pending_deletes(self):
+        """Returns the names of files which are confirmed but not yet deleted"""
+        return [row[0] for row in self._execute(
+            "SELECT filename FROM files WHERE state = ? ORDER BY published", self.CONFIRMED
+        )]
+
+    def recover(self):
+        """Prepares entries left by an earlier process
+
+        Message ids are only meaningful to the connection which published
+        them, so they are cleared. Files which were published but never
+        confirmed may not have reached the broker, so they are removed from
+        the ledger and published again.
+
+        :return: The names of files which are confirmed but not yet deleted
+        """
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM digests WHERE filename IN (SELECT filename FROM files WHERE state = ?)",
+                (self.PUBLISHED,)
+            )
+            unconfirmed = self._db.execute("DELETE FROM files WHERE state = ?", (self.PUBLISHED,)).rowcount
+            self._db.execute("UPDATE files SET msg_id = NULL WHERE state = ?", (self.CONFIRMED,))
+        pending = self.pending_deletes()
+        self.logger.info(
+            "Recovered ledger", path=self.path, pending_deletes=len(pending), republish=unconfirmed
+        )
+        return pending
+
+    def compact(self, now=None):
+        """Removes deleted entries, and duplicates not seen, older than the retention period, and evicts digests
+
+        :return: The number of entries removed
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            removed = self._db.execute(
+                "DELETE FROM files WHERE state IN (?, ?) AND updated < ?",
+                (self.DELETED, self.DUPLICATE, now - self.retention)
+            ).rowcount
+            evicted = self._db.execute("DELETE FROM digests WHERE seen < ?", (now - self.dedupe_ttl,)).rowcount
+            # The least recently seen beyond the limit
+            evicted += self._db.execute(
+                "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests ORDER BY seen DESC LIMIT -1 OFFSET ?)",
+                (self.dedupe_max,)
+            ).rowcount
+            if removed or evicted:
+                self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,117 @@
+import atexit
+import contextlib
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DEFAULT_SUMMARY_EVERY = 1000
+DEFAULT_SUMMARY_S = 10
+
+
+class Writer(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # Waits for room, as the queue may be full
+        self.queue.put(self._sentinel)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Passes records to a thread which formats and writes them
+
+    The queue is bounded, so that logging cannot hold up the caller or use
+    unbounded memory when the writer falls behind. Records which do not fit
+    are dropped and counted. A forked process has no writer thread, so it
+    writes its records itself.
+    """
+
+    def __init__(self, handlers, size=DEFAULT_LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize=size))
+        self.handlers = handlers
+        self.pid = os.getpid()
+        self.dropped = 0
+        self.writer = Writer(self.queue, *handlers, respect_handler_level=True)
+        self.running = False
+
+    def prepare(self, record):
+        # Only the message is formatted here. The writer formats the rest.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        if os.getpid() != self.pid:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        super().emit(record)
+
+    def start(self):
+        if not self.running:
+            self.writer.start()
+            self.running = True
+            atexit.register(self.stop)
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Stops the writer for the duration of a with block, while processes are forked
+
+        A process forked while the writer holds a handler's lock inherits
+        the lock held, and blocks the first time it logs. Records logged
+        meanwhile wait in the queue.
+        """
+        running = self.running
+        self.stop()
+        try:
+            yield
+        finally:
+            if running:
+                self.start()
+
+    def stop(self):
+        """Writes out the records in the queue and stops the writer"""
+        if self.running:
+            self.running = False
+            atexit.unregister(self.stop)
+            self.writer.stop()
+
+
+class Summary:
+    """Logs a frequent event as an occasional summary line
+
+    A line is logged on every `every` events, or on the first event more
+    than `interval` seconds after the last line. Arguments are passed to the
+    logger as they are, so events which are not logged cost a count and a
+    clock reading.
+    """
+
+    def __init__(self, log, every=DEFAULT_SUMMARY_EVERY, interval=DEFAULT_SUMMARY_S, clock=time.monotonic):
+        self.log = log
+        self.every = every
+        self.interval = interval
+        self.clock = clock
+        self.count = 0
+        self.logged = None
+
+    def __call__(self, msg, *args):
+        """Counts an event, and logs `msg` with `args` if a summary is due
+
+        :return: True if the line was logged
+        """
+        self.count += 1
+        now = self.clock()
+        if self.count < self.every and self.logged is not None and now - self.logged < self.interval:
+            return False
+        self.log.info(msg, *args)
+        self.count = 0
+        self.logged = now
+        return True
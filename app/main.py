@@ -1,26 +1,46 @@
 #!/usr/bin/env python3
 
 import argparse
-import base64
+import contextlib
+import functools
 import json
 import os.path
+import socket
 import sys
+import time
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 import uuid
 import yaml
 
-from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tornado.httpclient import AsyncHTTPClient, HTTPError
-from sdc.crypto.encrypter import encrypt
 from sdc.crypto.key_store import KeyStore, validate_required_keys
 
+import app
 from app import create_and_wrap_logger
-from app.ftpclient import FTPWorker
-from app.publisher import DurableTopicPublisher
+from app.compression import CODECS
+from app.deleter import DEFAULT_DELETE_BATCH, Deleter
+from app.encoder import DEFAULT_KEYS_FILE, ParallelEncoder, SerialEncoder, prepare_worker
+from app.ftpclient import DEFAULT_CLAIM_LEASE_S, DEFAULT_HOST_CONNECTIONS, DEFAULT_KEEPALIVE_S, DEFAULT_POOL_SIZE
+from app.ftpclient import DEFAULT_RESUME_ATTEMPTS, SessionPool
+from app.ledger import DEFAULT_DEDUPE_MAX, DEFAULT_DEDUPE_TTL_S, DEFAULT_LEDGER_PATH, DEFAULT_RETENTION_S, Ledger
+from app.logs import DEFAULT_SUMMARY_EVERY, DEFAULT_SUMMARY_S
+from app.metrics import Registry
+from app.pipeline import Pipeline, Stage, run_on_loop
+from app.publisher import DEFAULT_CHANNELS, DEFAULT_RETRIES, DEFAULT_RETRY_MEMORY, DEFAULT_WINDOW
+from app.publisher import DEFAULT_WINDOW_BYTES, Delivery, PublisherPool
+from app.scheduler import AdaptiveScheduler
+from app.sources import load_sources, split_key, weighted_round_robin
+from app.spool import DEFAULT_SPOOL_THRESHOLD
 
 DEFAULT_FTP_INTERVAL_MS = 10 * 60 * 1000  # 10 minutes
+DEFAULT_FTP_MIN_INTERVAL_MS = 5 * 1000  # 5 seconds
+DEFAULT_PIPELINE_QUEUE_SIZE = 4
+DEFAULT_FTP_CONNECTIONS = 4
+DEFAULT_HEALTH_TTL_S = 60
 
 logger = create_and_wrap_logger(__name__)
 
@@ -31,39 +51,108 @@ class HealthCheckService(tornado.web.RequestHandler):
         self.task = task
 
     def get(self):
-        rabbit_health = False
-        if self.task.rabbit_check.done():
-            try:
-                self.task.rabbit_check.result()
-            except (HTTPError, Exception):
-                # HTTPError is raised for non-200 responses
-                # Also possible IOError, etc
-                pass
-            else:
-                rabbit_health = True
+        self.write(self.task.health())
 
-        ftp_health = self.task.ftp_check.done() and self.task.ftp_check.result()
 
-        self.write({
-            "status": rabbit_health and ftp_health,
-            "dependencies": {
-                "rabbitmq": rabbit_health,
-                "ftp": ftp_health
-            }
-        })
+class MetricsService(tornado.web.RequestHandler):
+
+    def initialize(self, task):
+        self.task = task
+
+    def get(self):
+        self.set_header("Content-Type", Registry.CONTENT_TYPE)
+        self.write(self.task.metrics.render())
 
 
 class StatusService(tornado.web.RequestHandler):
+    """Lists files in the ledger in the order they were published
+
+    Accepts `state` (repeatable), `min_age` and `max_age` in seconds,
+    `limit` and the `cursor` returned with the previous page. Records are
+    read from the ledger in batches on the executor and streamed out.
+    """
+
+    BATCH = 100
+    MAX_LIMIT = 1000
 
     def initialize(self, task):
-        self.recent = {n: v for n, v in enumerate(task.recent)}
+        self.task = task
 
-    def get(self):
-        self.write(self.recent)
+    async def get(self):
+        now = time.time()
+        try:
+            states = self.get_arguments("state")
+            if not set(states) <= set(Ledger.STATES):
+                raise ValueError("Unknown state")
+            limit = min(int(self.get_argument("limit", self.BATCH)), self.MAX_LIMIT)
+            if limit < 1:
+                raise ValueError("Limit must be positive")
+            min_age, max_age = self.get_argument("min_age", None), self.get_argument("max_age", None)
+            query = {
+                "states": states,
+                "published_before": None if min_age is None else now - float(min_age),
+                "published_after": None if max_age is None else now - float(max_age),
+                "cursor": self.get_argument("cursor", None),
+            }
+            if query["cursor"] is not None:
+                Ledger.parse_cursor(query["cursor"])
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"error": str(e)})
+            return
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write('{"files": [')
+        loop = tornado.ioloop.IOLoop.current()
+        sent = 0
+        while sent < limit:
+            records = await loop.run_in_executor(
+                self.task.executor, functools.partial(
+                    self.task.ledger.page, limit=min(self.BATCH, limit - sent), **query
+                )
+            )
+            for record in records:
+                self.write((", " if sent else "") + json.dumps({
+                    "filename": record.filename,
+                    "state": record.state,
+                    "msg_id": record.msg_id,
+                    "size": record.size,
+                    "age": round(now - record.published, 3),
+                    "delete_failures": record.failures,
+                }))
+                sent += 1
+            if records:
+                query["cursor"] = Ledger.cursor(records[-1])
+            if len(records) < self.BATCH:
+                break
+            await self.flush()
+
+        cursor = query["cursor"] if sent == limit else None
+        self.write('], "next": {0}}}'.format(json.dumps(cursor)))
+
+
+class TransferService(tornado.web.RequestHandler):
+
+    def initialize(self, task):
+        self.task = task
+
+    def post(self):
+        if self.task.scheduler is None:
+            self.set_status(503)
+            self.write({"status": "not scheduled"})
+            return
+
+        self.task.scheduler.trigger()
+        self.set_status(202)
+        self.write({"status": "triggered"})
+
+
+def differs(listed, recorded):
+    """Whether a fact about a listed file differs from the ledger, where both are known"""
+    return None not in (listed, recorded) and listed != recorded
 
 
 class Task:
-    recent = OrderedDict([])
 
     @staticmethod
     def amqp_params(services):
@@ -78,6 +167,8 @@ class Task:
                 password=os.getenv("SEFT_RABBITMQ_DEFAULT_PASS", "guest"),
                 vhost="%2f"
             )
+        # The nodes of a cluster, which the publisher's channels are spread across
+        urls = [url.strip() for url in os.getenv("SEFT_RABBITMQ_URLS", "").split(",") if url.strip()]
         check = "http://{user}:{password}@{hostname}:{port}/api/healthchecks/node".format(
             user=os.getenv("SEFT_RABBITMQ_MONITORING_USER", "monitor"),
             password=os.getenv("SEFT_RABBITMQ_MONITORING_PASS", "monitor"),
@@ -86,7 +177,7 @@ class Task:
         )
 
         return {
-            "amqp_url": uri,
+            "amqp_url": urls or uri,
             "queue_name": queue,
             "check": check
         }
@@ -98,93 +189,551 @@ class Task:
             "password": os.getenv("SEFT_FTP_PASS", "ons"),
             "host": os.getenv("SEFT_FTP_HOST", "127.0.0.1"),
             "port": int(os.getenv("SEFT_FTP_PORT", 2021)),
-            "working_directory": os.getenv("SEFT_PUBLISHER_FTP_FOLDER", "/")
+            "working_directory": os.getenv("SEFT_PUBLISHER_FTP_FOLDER", "/"),
+            "connections": int(os.getenv("SEFT_FTP_CONNECTIONS", DEFAULT_FTP_CONNECTIONS)),
+            "host_connections": int(os.getenv("SEFT_FTP_HOST_CONNECTIONS", DEFAULT_HOST_CONNECTIONS)),
+            "spool_threshold": int(os.getenv("SEFT_SPOOL_THRESHOLD", DEFAULT_SPOOL_THRESHOLD)),
+            "resume_attempts": int(os.getenv("SEFT_FTP_RESUME_ATTEMPTS", DEFAULT_RESUME_ATTEMPTS)),
+            "claim_directory": os.getenv("SEFT_CLAIM_DIRECTORY", ""),
+            "replica": os.getenv("SEFT_REPLICA_ID", socket.gethostname()),
         }
 
     def __init__(self, args, services):
         self.args = args
         self.services = services
-        self.publisher = DurableTopicPublisher(**self.amqp_params(services))
+        self.sources = load_sources(
+            os.getenv("SEFT_SOURCES"), self.ftp_params(services),
+            pool_size=int(os.getenv("SEFT_FTP_POOL_SIZE", DEFAULT_POOL_SIZE)),
+            keepalive=int(os.getenv("SEFT_FTP_KEEPALIVE_S", DEFAULT_KEEPALIVE_S))
+        )
+        self.by_name = {source.name: source for source in self.sources}
+        # The download stage has a worker for each of the FTP sessions used at once
+        self.download_workers = max(source.pool.params.get("connections", 1) for source in self.sources)
+        self.publisher = PublisherPool(
+            channels=int(os.getenv("SEFT_PUBLISH_CHANNELS", DEFAULT_CHANNELS)),
+            window=int(os.getenv("SEFT_PUBLISH_WINDOW", DEFAULT_WINDOW)),
+            window_bytes=int(os.getenv("SEFT_PUBLISH_WINDOW_BYTES", DEFAULT_WINDOW_BYTES)),
+            bindings=[(source.queue, source.routing_key) for source in self.sources if source.queue],
+            retry_memory=int(os.getenv("SEFT_RETRY_MEMORY_BYTES", DEFAULT_RETRY_MEMORY)),
+            retries=int(os.getenv("SEFT_PUBLISH_RETRIES", DEFAULT_RETRIES)),
+            log_every=int(os.getenv("SEFT_LOG_SUMMARY_EVERY", DEFAULT_SUMMARY_EVERY)),
+            log_interval=int(os.getenv("SEFT_LOG_SUMMARY_S", DEFAULT_SUMMARY_S)),
+            **self.amqp_params(services)
+        )
         self.executor = ThreadPoolExecutor(max_workers=4)
+        # Ledger writes for the IOLoop are made in order on one thread, so that it never waits on the disk or compaction
+        self.ledger_writer = ThreadPoolExecutor(max_workers=1)
+        # Sources are listed at the same time, so a slow server does not delay the others
+        self.listers = ThreadPoolExecutor(max_workers=len(self.sources))
+        self.http_client = None
         self.rabbit_check = None
+        self.rabbit_health = None
+        self.rabbit_checked = None
         self.ftp_check = None
+        self.health_ttl = int(os.getenv("SEFT_HEALTH_TTL_S", DEFAULT_HEALTH_TTL_S))
         self.transfer = False
+        self.loop = None
+        self.pipeline = None
+        self.scheduler = None
+        self.counts = Counter()
+        self.listing = os.getenv("SEFT_FTP_LISTING", "mlsd").lower()
+        self.claim_lease = int(os.getenv("SEFT_CLAIM_LEASE_S", DEFAULT_CLAIM_LEASE_S))
+        # By default, as many files as the download workers and the queue after them hold
+        self.claim_batch = int(os.getenv("SEFT_CLAIM_BATCH", 0)) or self.download_workers * int(
+            os.getenv("SEFT_PIPELINE_QUEUE_SIZE", DEFAULT_PIPELINE_QUEUE_SIZE)
+        )
+        self.chunk_size = int(os.getenv("SEFT_CHUNK_SIZE", 0))
+        self.unfinished = {}
+        self.compression = os.getenv("SEFT_COMPRESSION", "none").lower()
+        self.compression = self.compression if self.compression in CODECS else None
+        self.ordered = os.getenv("SEFT_PUBLISH_ORDER", "strict").lower() != "completion"
+        self.processes = int(os.getenv("SEFT_ENCRYPT_PROCESSES", 0))
+        self.encoders = None
+        if self.processes:
+            # The workers are forked, so they are started before the transfer threads,
+            # and while the log writer is stopped, so no thread holds a lock they inherit
+            with contextlib.ExitStack() as stack:
+                if app.log_handler is not None:
+                    stack.enter_context(app.log_handler.paused())
+                self.encoders = ProcessPoolExecutor(max_workers=self.processes)
+                self.encoders.submit(prepare_worker).result()
         self.key_purpose = 'outbound'
 
-        keys_file_location = os.getenv('SDX_SEFT_CONSUMER_KEYS_FILE', './jwt-test-keys/keys.yml')
+        keys_file_location = os.getenv('SDX_SEFT_CONSUMER_KEYS_FILE', DEFAULT_KEYS_FILE)
         with open(keys_file_location) as file:
             self.secrets_from_file = yaml.safe_load(file)
 
         validate_required_keys(self.secrets_from_file, self.key_purpose)
         self.key_store = KeyStore(self.secrets_from_file)
 
+        self.ledger = Ledger(
+            os.getenv("SEFT_LEDGER_PATH", DEFAULT_LEDGER_PATH),
+            retention=int(os.getenv("SEFT_LEDGER_RETENTION_S", DEFAULT_RETENTION_S)),
+            dedupe_ttl=int(os.getenv("SEFT_DEDUPE_TTL_S", DEFAULT_DEDUPE_TTL_S)),
+            dedupe_max=int(os.getenv("SEFT_DEDUPE_MAX", DEFAULT_DEDUPE_MAX))
+        )
+        self.delete_duplicates = os.getenv("SEFT_DEDUPE_DELETE", "false").lower() == "true"
+        # Digests of the files downloaded by this run, by source, as they are not in the ledger until published
+        self.downloaded = {}
+        self.ledger.recover()
+        for source in self.sources:
+            source.deleter = Deleter(
+                source.pool, functools.partial(self.on_deleted, source),
+                batch=int(os.getenv("SEFT_DELETE_BATCH", DEFAULT_DELETE_BATCH)),
+                on_failed=functools.partial(self.on_delete_failed, source)
+            )
+
+        self.metrics = Registry()
+        self.stage_seconds = self.metrics.histogram(
+            "seft_stage_seconds", "Time spent on each item by a stage of the transfer pipeline", labels=("stage",)
+        )
+        self.cycle_seconds = self.metrics.histogram("seft_cycle_seconds", "Duration of transfer cycles")
+        self.cycle_skips = self.metrics.counter(
+            "seft_cycle_skips_total", "Transfer cycles which did not run", labels=("reason",)
+        )
+        self.files_total = self.metrics.counter("seft_files_total", "Files processed", labels=("event",))
+        self.bytes_total = self.metrics.counter("seft_bytes_total", "Bytes of files processed", labels=("event",))
+        self.metrics.gauge(
+            "seft_inflight_messages", "Published messages awaiting confirmation",
+            func=lambda: self.publisher.inflight
+        )
+        self.metrics.counter(
+            "seft_acked_total", "Messages acked by the broker", func=lambda: self.publisher.tracker.acked
+        )
+        self.metrics.counter(
+            "seft_nacked_total", "Messages nacked by the broker", func=lambda: self.publisher.tracker.nacked
+        )
+        self.metrics.gauge("seft_ledger_files", "Published files not yet deleted", func=lambda: len(self.ledger))
+        self.metrics.counter(
+            "seft_log_dropped_total", "Log records dropped as the log writer fell behind",
+            func=lambda: app.log_handler.dropped if app.log_handler else 0
+        )
+
     def check_services(self, ftp_params=None, rabbit_url=""):
-        ftp_params = ftp_params or self.ftp_params(self.services)
-        http_client = AsyncHTTPClient()
-        params = self.amqp_params(self.services)
-        self.rabbit_check = http_client.fetch(rabbit_url or params["check"])
+        """Probes the RabbitMQ management API and the FTP servers"""
+        self.check_rabbit(rabbit_url)
+        # The check reuses pooled sessions unless other parameters are given
+        pools = [SessionPool(size=0, **ftp_params)] if ftp_params else [source.pool for source in self.sources]
+        self.check_ftp(pools)
+
+    def check_rabbit(self, url=""):
+        if self.http_client is None:
+            self.http_client = AsyncHTTPClient()
+        self.rabbit_check = self.http_client.fetch(url or self.amqp_params(self.services)["check"])
+        tornado.ioloop.IOLoop.current().add_future(self.rabbit_check, self.on_rabbit_checked)
+
+    def on_rabbit_checked(self, future):
+        try:
+            future.result()
+        except (HTTPError, Exception):
+            # HTTPError is raised for non-200 responses
+            # Also possible IOError, etc
+            logger.warning("RabbitMQ health check failed", exc_info=True)
+            self.rabbit_health = False
+        else:
+            self.rabbit_health = True
+        self.rabbit_checked = time.monotonic()
+
+    def check_ftp(self, pools):
+        self.ftp_check = self.executor.submit(lambda: all([pool.check() for pool in pools]))
+
+    def refresh_health(self):
+        """Probes services which have not been heard from within the TTL. The probes run in the background."""
+        now = time.monotonic()
+        if self.publisher.connected and (self.rabbit_check is None or self.rabbit_check.done()):
+            # Confirmations show the broker is alive, but not that a failed check has cleared
+            heard = [self.rabbit_checked]
+            if self.rabbit_health is not False:
+                heard.append(self.publisher.activity)
+            heard = max((t for t in heard if t is not None), default=None)
+            if heard is None or now - heard > self.health_ttl:
+                self.check_rabbit()
+
+        if self.ftp_check is None or self.ftp_check.done():
+            # Transfers and keepalives report on the FTP sessions between checks
+            stale = [
+                source.pool for source in self.sources
+                if source.pool.checked is None or time.time() - source.pool.checked > self.health_ttl
+            ]
+            if stale:
+                self.check_ftp(stale)
+
+    def health(self):
+        """Reports on RabbitMQ and FTP from the state of the publisher and FTP sessions. Runs on the IOLoop."""
+        self.refresh_health()
+        rabbit_health = self.publisher.connected and not self.publisher.blocked and self.rabbit_health is not False
+        ftp_health = all(source.pool.healthy for source in self.sources)
+        return {
+            "status": rabbit_health and ftp_health,
+            "dependencies": {
+                "rabbitmq": rabbit_health,
+                "ftp": ftp_health
+            }
+        }
+
+    def keep_ftp_alive(self):
+        def keepalive():
+            for source in self.sources:
+                source.pool.keepalive()
+                if source.pool.params.get("claim_directory"):
+                    # Between transfers, so that long idle intervals do not let the lease expire
+                    with source.pool.session() as active:
+                        if active is not None:
+                            active.renew_lease()
+        return tornado.ioloop.IOLoop.current().run_in_executor(self.executor, keepalive)
+
+    def list_source(self, source, started):
+        """Lists the files of a source which are to be published
+
+        :return: The filenames, and the number of files held back as they are still changing
+        """
+        held = 0
+        with source.pool.session() as active:
+            if active is None:
+                logger.warning("Could not list files", source=source.name)
+                return [], held
+
+            claimed = []
+            if active.claim_directory:
+                active.renew_lease()
+                reclaimed = active.reclaim(self.claim_lease)
+                if reclaimed:
+                    logger.info("Reclaimed files from other replicas", source=source.name, count=reclaimed)
+                # Files claimed before a restart are published along with new ones
+                claimed = active.claimed()
+
+            if self.listing == "nlst":
+                candidates = [(filename, None, None) for filename in active.filenames]
+            else:
+                stable, held = source.watcher.update(active.listing())
+                if held:
+                    logger.info("Holding back files which are still changing", source=source.name, count=held)
+                candidates = [(entry.name, entry.size, entry.modify) for entry in stable]
+
+            filenames = [
+                filename for filename, size, modify in candidates
+                if self.is_unpublished(source, filename, size, started, modify)
+            ]
+            if active.claim_directory:
+                claimed = [filename for filename in claimed if self.is_unpublished(source, filename, None, started)]
+                filenames = self.claim(active, filenames, self.claim_batch - len(claimed)) + claimed
+        return filenames, held
+
+    @staticmethod
+    def claim(active, filenames, limit):
+        """Claims up to `limit` files, leaving the rest for other replicas
+
+        :return: The names of the files claimed
+        """
+        claimed = []
+        for filename in filenames:
+            if len(claimed) >= limit:
+                break
+            if active.claim(filename):
+                claimed.append(filename)
+        return claimed
+
+    def is_unpublished(self, source, filename, size, started, modify=None):
+        record = self.ledger.get(source.key(filename))
+        # The delete stage may remove a listed file before it is checked here
+        if record is None or (record.state == Ledger.DELETED and record.updated < started):
+            logger.debug("Found a file to publish", source=source.name, filename=filename)
+            return True
+        elif record.state in Ledger.CURRENT and (differs(size, record.size) or differs(modify, record.modify)):
+            logger.info("Found a file which changed since it was published", source=source.name, filename=filename)
+            return True
+        elif record.state == Ledger.DUPLICATE and record.updated < time.time() - self.ledger.retention / 2:
+            # Kept while the copy is on the server, or it would be published once the entry is compacted
+            self.ledger.touch(record.filename)
+        return False
+
+    def list_files(self, unused_context, unused_trigger):
+        """Lists every source, then shares out their files in weighted turns"""
+        logger.info("Looking for files...")
+        started = time.time()
+        listings = [
+            (source, self.listers.submit(self.list_source, source, started)) for source in self.sources
+        ]
+        batches = []
+        for source, listing in listings:
+            try:
+                filenames, held = listing.result()
+            except Exception:
+                logger.exception("Failed to list files", source=source.name)
+            else:
+                batches.append((source, filenames))
+                self.counts["held"] += held
+        yield from weighted_round_robin(batches)
+
+    def download_files(self, unused_context, batch):
+        source, filenames = batch
+        # The session goes back to the pool after each batch, so that sources on the same host can share them
+        with source.pool.session() as active:
+            if active is None:
+                return
+            # Downloads are checked against the sizes in the listing
+            for job in active.get(filenames, connections=1, sizes=source.watcher.sizes()):
+                self.files_total.inc("downloaded")
+                self.bytes_total.inc("downloaded", amount=job.file.size)
+                key = source.key(job.filename)
+                entry = source.watcher.get(job.filename)
+                job = job._replace(source=source.name, modify=entry.modify if entry else None)
+                original = self.find_original(source, key, job.file.digest)
+                if original is None:
+                    yield job
+                else:
+                    self.skip_duplicate(key, job, original)
+
+    def find_original(self, source, filename, digest):
+        """Finds a file with the same content which was published recently or is being published by this run
+
+        Only files from the same source are compared, as other sources may
+        send their files to other consumers.
+
+        :return: The ledger key of the other file, or None
+        """
+        if not self.ledger.dedupe_ttl:
+            return None
+        original = self.downloaded.setdefault((source.name, digest), filename)
+        if original == filename:
+            original = self.ledger.original(digest, source=source.name)
+        return None if original == filename else original
+
+    def skip_duplicate(self, filename, job, original):
+        """Skips a file whose content has been published
+
+        Once the other file is confirmed, the duplicate is recorded in the
+        ledger so that it is not downloaded again, and may be deleted.
+        Until then, it is looked at again by the next run.
+        """
+        job.file.close()
+        self.counts["duplicates"] += 1
+        self.files_total.inc("duplicate")
+        logger.info("Skipping file with the same content as another", filename=filename, original=original)
+        if self.ledger.state(original) in (Ledger.CONFIRMED, Ledger.DELETED):
+            self.ledger.duplicate(filename, size=job.file.size, digest=job.file.digest, modify=job.modify)
+            if self.delete_duplicates:
+                self.submit_delete(filename, None)
+
+    def make_encoder(self):
+        options = {"codec": self.compression, "chunk_size": self.chunk_size}
+        if self.encoders is None:
+            return SerialEncoder(self.key_store, **options)
+        return ParallelEncoder(self.encoders, depth=2 * self.processes, ordered=self.ordered, **options)
+
+    def encode_file(self, encoder, job):
+        claims = {"ts": job.ts.isoformat(), "filename": job.filename}
+        return encoder.submit(job, str(uuid.uuid4()), claims, self.key_purpose)
+
+    def flush_encoder(self, encoder):
+        return encoder.flush()
+
+    async def publish(self, part, payload):
+        """Publishes a payload. Runs on the IOLoop, which owns the publisher.
+
+        Waits while the publisher's window of unconfirmed messages is full.
+        A file sent in parts is entered in the ledger once its last part is
+        published. If any part fails, the rest are skipped and the whole
+        file is published again by a later run. The part's spool goes to the
+        publisher, which keeps it until the message is confirmed.
+
+        :return: The comma separated message ids of the file, or None
+        """
+        job = part.job
+        key = self.source_of(job).key(job.filename)
+        msg_ids, confirmations = self.unfinished.pop(key, (None, None)) if part.index else ([], [])
+        if msg_ids is None:
+            part.payload.close()
+            return None
+
+        headers = {"tx_id": part.tx_id}
+        if part.count > 1:
+            headers.update(part=part.index, parts=part.count, digest=job.file.digest)
+        if part.encoding:
+            headers["encoding"] = part.encoding
+        msg_id, confirmation = await self.publisher.publish(
+            payload, headers=headers, routing_key=self.source_of(job).routing_key, spool=part.payload
+        )
+        if msg_id is None:
+            logger.warning("Failed to publish file", filename=key, part=part.index)
+            if msg_ids:
+                # The parts already published never reach the ledger, which would have their deliveries forgotten
+                self.loop.add_future(
+                    tornado.gen.multi(confirmations), functools.partial(self.forget_parts, ",".join(msg_ids))
+                )
+            return None
+
+        msg_ids.append(str(msg_id))
+        confirmations.append(confirmation)
+        if part.index + 1 < part.count:
+            self.unfinished[key] = (msg_ids, confirmations)
+            return None
+
+        msg_id = ",".join(msg_ids)
+        await self.loop.run_in_executor(self.ledger_writer, functools.partial(
+            self.ledger.publish,
+            key, msg_id, size=job.file.size, digest=job.file.digest, modify=job.modify, source=self.source_of(job).name
+        ))
+        self.loop.add_future(
+            tornado.gen.multi(confirmations), functools.partial(self.on_confirmed, key, msg_id)
+        )
+        self.counts["published"] += 1
+        self.files_total.inc("published")
+        self.bytes_total.inc("published", amount=job.file.size)
+        logger.info("Published file", filename=key, tx_id=part.tx_id, parts=part.count)
+        return msg_id
+
+    def forget_parts(self, msg_id, unused_future):
+        """Forgets the deliveries of a file's parts once confirmed, should the rest have failed. Runs on the IOLoop."""
+        self.publisher.tracker.forget(*Delivery.parse_all(msg_id))
+
+    def publish_file(self, unused_context, part):
+        if self.publisher.retry_full(part.payload.size):
+            # The publisher keeps the spool until the message is confirmed, so it is moved to disk here, off the IOLoop
+            part.payload.rollover()
+        msg_id = run_on_loop(self.loop, self.publish, part, part.payload.getvalue())
+        if msg_id is not None:
+            yield self.source_of(part.job).key(part.job.filename), msg_id
+
+    def source_of(self, job):
+        return self.by_name.get(job.source, self.sources[0])
+
+    def find_deleter(self, filename):
+        """Finds the deleter for a file in the ledger
+
+        :return: The source's deleter and the filename on its server, or None
+            and the filename if the file is from a source no longer configured
+        """
+        name, path = split_key(filename)
+        source = self.by_name.get(name)
+        if source is None:
+            return None, filename
+        return source.deleter, path
+
+    def submit_delete(self, filename, msg_id):
+        deleter, path = self.find_deleter(filename)
+        if deleter is None:
+            logger.warning("Not deleting file from unknown source", filename=filename, msg_id=msg_id)
+            return False
+        return deleter.submit(path, msg_id)
+
+    async def on_confirmed(self, filename, msg_id, future):
+        """Settles a file once the broker has acked or nacked all its messages. Runs on the IOLoop."""
+        await self.loop.run_in_executor(self.ledger_writer, self.settle_file, filename, msg_id, future.result())
+
+    def settle_file(self, filename, msg_id, outcomes):
+        """Queues a file for deletion if all its messages were acked. Runs on the ledger writer's thread.
+
+        A file which has been published again since, as it changed, is left
+        to the confirmation of its latest messages.
+        """
+        if all(outcomes):
+            if self.ledger.confirm(filename, msg_id):
+                self.submit_delete(filename, msg_id)
+                return
+            logger.info("File was published again before it was confirmed", filename=filename, msg_id=msg_id)
+        elif False in outcomes:
+            logger.warning("Delivery was nacked, file will be published again",
+                           filename=filename, msg_id=msg_id)
+            self.ledger.discard(filename, msg_id)
+        self.loop.add_callback(self.publisher.tracker.forget, *Delivery.parse_all(msg_id))
+
+    def on_deleted(self, source, path, msg_id):
+        """Records the deletion of a file. Runs on the deleter's thread."""
+        filename = source.key(path)
+        self.ledger.delete(filename)
+        self.counts["deleted"] += 1
+        self.files_total.inc("deleted")
+        self.loop.add_callback(self.publisher.tracker.forget, *Delivery.parse_all(msg_id))
+        logger.info("Succssfully deleted file", filename=filename, msg_id=msg_id)
+
+    def on_delete_failed(self, source, path, unused_msg_id):
+        """Records a failed deletion, which is tried again by the next run. Runs on the deleter's thread."""
+        self.ledger.delete_failed(source.key(path))
+        self.files_total.inc("delete_failed")
+
+    def delete_file(self, unused_context, item):
+        """Queues files confirmed by earlier runs for deletion, should their deletion have failed"""
+        filename, msg_id = item
+        logger.debug("Recently published file found", filename=filename, msg_id=msg_id)
+        # The deliveries might not be confirmed yet as the publisher waits for the broker
+        deliveries = Delivery.parse_all(msg_id)
+        outcomes = [self.publisher.tracker.outcome(delivery) for delivery in deliveries]
+        if deliveries and all(outcomes):
+            self.ledger.confirm(filename, msg_id)
+        elif False in outcomes:
+            logger.warning("Delivery was nacked, file will be published again",
+                           filename=filename, msg_id=msg_id)
+            self.ledger.discard(filename, msg_id)
+            self.loop.add_callback(self.publisher.tracker.forget, *deliveries)
+            return ()
+
+        record = self.ledger.get(filename)
+        if record is not None and record.state == Ledger.CONFIRMED and record.msg_id == msg_id:
+            if self.submit_delete(filename, msg_id):
+                logger.debug("Deleting file as it has its delivery confirmed",
+                             filename=filename, msg_id=msg_id)
+        else:
+            deleter, path = self.find_deleter(filename)
+            if deleter is None or path not in deleter:
+                logger.debug("Not deleting file as it hasn't had its delivery confirmed",
+                             filename=filename, msg_id=msg_id)
+        return ()
+
+    def make_pipeline(self):
+        return Pipeline(
+            Stage("list", self.list_files),
+            Stage("download", self.download_files, workers=self.download_workers),
+            Stage("encode", self.encode_file, context=self.make_encoder, flush=self.flush_encoder),
+            Stage("publish", self.publish_file),
+            Stage("delete", self.delete_file),
+            maxsize=int(os.getenv("SEFT_PIPELINE_QUEUE_SIZE", DEFAULT_PIPELINE_QUEUE_SIZE)),
+            timer=self.stage_seconds.observe
+        )
 
-        ftp = FTPWorker(**ftp_params)
-        self.ftp_check = self.executor.submit(ftp.check)
+    async def transfer_files(self):
+        """Runs one transfer cycle
 
-    def transfer_files(self):
+        :return: True if any file was published or deleted
+        """
         if not self.publisher.publishing:
             logger.warning("Publisher is not ready.")
-            return
+            self.cycle_skips.inc("not_ready")
+            return False
 
         if self.transfer:
             logger.warning("Cancelling overlapped task.")
-            return
+            self.cycle_skips.inc("overlap")
+            return False
         else:
             self.transfer = True
 
+        started = time.monotonic()
         try:
-            logger.info("Looking for files...")
-            worker = FTPWorker(**self.ftp_params(self.services))
-            with worker as active:
-                if not active:
-                    return
-
-                for job in active.get(active.filenames):
-                    if job.filename not in self.recent:
-                        logger.info("Found a file to publish", filename=job.filename)
-                        data = job._asdict()
-                        data["file"] = base64.standard_b64encode(job.file).decode("ascii")
-                        data["ts"] = job.ts.isoformat()
-                        payload = encrypt(data, self.key_store, self.key_purpose)
-                        tx_id = str(uuid.uuid4())
-
-                        msg_id = self.publisher.publish_message(payload, headers={'tx_id': tx_id})
-                        if msg_id is None:
-                            logger.warning("Failed to publish file", filename=job.filename)
-                        else:
-                            self.recent[job.filename] = msg_id
-                            logger.info("Published file", filename=job.filename, tx_id=tx_id)
-
-                logger.info("Finished publishing files, checking if any files need to be deleted")
-                for filename, msg_id in self.recent.items():
-                    logger.info("Recently published file found", filename=filename, msg_id=msg_id)
-                    # The file might not be in confirmed_deliveries as the publisher waits for the delivery
-                    # confirmation adding it to the list
-                    if msg_id in self.publisher.confirmed_deliveries:
-                        logger.info("Deleting file as it has its delivery confirmed",
-                                    filename=filename, msg_id=msg_id)
-                        file_deleted = active.delete(filename)
-                        if file_deleted:
-                            del self.recent[filename]
-                            logger.info("Succssfully deleted file", filename=filename, msg_id=msg_id)
-                    else:
-                        logger.info("Not deleting file as it hasn't had its delivery confirmed",
-                                    filename=filename, msg_id=msg_id)
+            self.loop = tornado.ioloop.IOLoop.current()
+            self.pipeline = self.pipeline or self.make_pipeline()
+            self.counts = Counter()
+            self.downloaded = {}
+            # Files published by earlier runs are checked for deletion alongside this run
+            seeds = {"delete": self.ledger.items()}
+            await self.loop.run_in_executor(self.executor, self.pipeline.run, [None], seeds)
+            await self.loop.run_in_executor(self.executor, self.ledger.compact)
+            if self.counts["held"] and self.scheduler is not None:
+                # Look again soon for files which are still being uploaded
+                self.scheduler.reset()
+            return bool(self.counts["published"] or self.counts["deleted"])
         finally:
             self.transfer = False
-            logger.info("Finished looking for files.")
+            self.cycle_seconds.observe(time.monotonic() - started)
+            logger.info("Finished looking for files.", **self.counts)
 
 
 def make_app(task):
     return tornado.web.Application([
         ("/healthcheck", HealthCheckService, {"task": task}),
+        ("/metrics", MetricsService, {"task": task}),
         ("/recent", StatusService, {"task": task}),
+        ("/transfer", TransferService, {"task": task}),
     ])
 
 
@@ -211,22 +760,25 @@ def main(args):
     app.listen(args.port)
 
     # Create the scheduled task
-    transfer_ms = int(os.getenv("SEFT_FTP_INTERVAL_MS", DEFAULT_FTP_INTERVAL_MS))
-    transfer = tornado.ioloop.PeriodicCallback(task.transfer_files, transfer_ms)
-    transfer.start()
+    task.scheduler = AdaptiveScheduler(
+        task.transfer_files,
+        interval=int(os.getenv("SEFT_FTP_MIN_INTERVAL_MS", DEFAULT_FTP_MIN_INTERVAL_MS)) / 1000,
+        ceiling=int(os.getenv("SEFT_FTP_INTERVAL_MS", DEFAULT_FTP_INTERVAL_MS)) / 1000
+    )
     logger.info("Transfer scheduled.")
 
-    check_ms = 5 * 60 * 1000  # 5 minutes
-    check = tornado.ioloop.PeriodicCallback(
-        task.check_services,
-        check_ms,
+    # Later checks only run when a health request finds the state is stale
+    tornado.ioloop.IOLoop.current().add_callback(task.refresh_health)
+
+    keepalive = tornado.ioloop.PeriodicCallback(
+        task.keep_ftp_alive,
+        min(source.pool.keepalive_s for source in task.sources) * 1000 / 2,
     )
-    check.start()
-    logger.info("Check scheduled.")
+    keepalive.start()
 
     # Perform the first transfer immediately
     loop = tornado.ioloop.IOLoop.current()
-    loop.call_later(6, task.transfer_files)
+    loop.call_later(6, task.scheduler.start)
     task.publisher.run()
     return 0
 
@@ -0,0 +1,123 @@
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs
+    ) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric, optionally split by labels.
+
+    Updates take a lock, which costs far less than the work they measure.
+
+    :param func:  Optional callable which returns the current value when the
+        metric is rendered, for values which are kept elsewhere
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=(), func=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        if self.func is not None:
+            yield self.name, "", self.func()
+            return
+
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, format_labels(self.labels, labels), value
+
+    def render(self):
+        yield "# HELP {0} {1}".format(self.name, self.description)
+        yield "# TYPE {0} {1}".format(self.name, self.kind)
+        for name, labels, value in self.samples():
+            yield "{0}{1} {2}".format(name, labels, format_value(value))
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total = self._values.get(labels) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[labels] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, (list(v[0]), v[1])) for k, v in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = (("le", bound if bound == "+Inf" else format_value(float(bound))),)
+                yield self.name + "_bucket", format_labels(self.labels, labels, le), cumulative
+            yield self.name + "_sum", format_labels(self.labels, labels), total
+            yield self.name + "_count", format_labels(self.labels, labels), cumulative
+
+
+class Registry:
+    """A set of metrics rendered together in the Prometheus text format"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=(), func=None):
+        return self.register(Counter(name, description, labels, func))
+
+    def gauge(self, name, description, labels=(), func=None):
+        return self.register(Gauge(name, description, labels, func))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
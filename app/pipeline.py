@@ -0,0 +1,160 @@
+import concurrent.futures
+import inspect
+import logging
+import queue
+import threading
+import time
+
+from structlog import wrap_logger
+
+DONE = object()
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+def run_on_loop(loop, func, *args, **kwargs):
+    """Runs a callable on the IOLoop thread and blocks the calling thread for its result.
+
+    If the callable returns an awaitable, the result is that of the awaitable.
+    """
+    future = concurrent.futures.Future()
+
+    async def call():
+        try:
+            rv = func(*args, **kwargs)
+            if inspect.isawaitable(rv):
+                rv = await rv
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(rv)
+
+    loop.add_callback(call)
+    return future.result()
+
+
+class NullContext:
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+# pylint: disable=broad-except
+class Stage:
+    """A step of the transfer pipeline, run by its own pool of worker threads.
+
+    :param name: Stage name, used in log output.
+    :param func: Called as ``func(context, item)``. Returns an iterable of
+        items for the next stage.
+    :param workers: Number of worker threads.
+    :param context: Optional factory for a context manager entered once by
+        each worker for its lifetime, eg: an FTP session. If the context
+        enters as a false value, the worker discards its input.
+    :param flush: Optional callable run as ``flush(context)`` by the last
+        worker to finish. Returns an iterable of items for the next stage.
+    :param timer: Optional callable run as ``timer(seconds, name)`` with the
+        time spent on each item, not counting waits for the next stage.
+    """
+
+    def __init__(self, name, func, workers=1, context=None, flush=None, timer=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.context = context or NullContext
+        self.flush = flush
+        self.timer = timer
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def start(self, inbox, outbox):
+        self._running = self.workers
+        return [self.executor.submit(self.work, inbox, outbox) for _ in range(self.workers)]
+
+    def work(self, inbox, outbox):
+        with self.context() as ctx:
+            if self.context is not NullContext and not ctx:
+                logger.warning("Stage has no context, discarding input", stage=self.name)
+
+            while True:
+                item = inbox.get()
+                if item is DONE:
+                    # Let sibling workers see the end of input too
+                    inbox.put(DONE)
+                    break
+
+                if self.context is not NullContext and not ctx:
+                    continue
+
+                self.emit(outbox, self.func, ctx, item)
+
+            with self._lock:
+                self._running -= 1
+                last = self._running == 0
+
+            if last:
+                if self.flush is not None and (self.context is NullContext or ctx):
+                    self.emit(outbox, self.flush, ctx)
+                if outbox is not None:
+                    outbox.put(DONE)
+
+    def emit(self, outbox, func, *args):
+        elapsed = 0
+        started = time.monotonic()
+        try:
+            for result in func(*args) or ():
+                elapsed += time.monotonic() - started
+                if outbox is not None:
+                    outbox.put(result)
+                started = time.monotonic()
+        except Exception:
+            logger.exception("Stage failed to process item", stage=self.name)
+        finally:
+            if self.timer is not None:
+                self.timer(elapsed + time.monotonic() - started, self.name)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class Pipeline:
+    """A chain of stages joined by bounded queues.
+
+    A slow stage fills the queue in front of it, which blocks the stages
+    upstream rather than buffering a whole backlog in memory.
+
+    :param timer: Optional timer for stages which do not have their own.
+    """
+
+    def __init__(self, *stages, maxsize=4, timer=None):
+        self.stages = stages
+        self.maxsize = maxsize
+        for stage in stages:
+            stage.timer = stage.timer or timer
+
+    def run(self, items, seeds=None):
+        """Runs the pipeline to completion. This call blocks.
+
+        :param items: Items to feed to the first stage.
+        :param seeds: Optional mapping of stage name to extra items for that stage.
+        """
+        seeds = seeds or {}
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages]
+        futures = []
+        for n, stage in enumerate(self.stages):
+            outbox = queues[n + 1] if n + 1 < len(queues) else None
+            futures.extend(stage.start(queues[n], outbox))
+
+        for stage, inbox in zip(self.stages, queues):
+            for item in seeds.get(stage.name, ()):
+                inbox.put(item)
+
+        for item in items:
+            queues[0].put(item)
+        queues[0].put(DONE)
+
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
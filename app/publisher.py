@@ -1,64 +1,368 @@
 from collections import namedtuple
+import itertools
 import logging
+import random
+import time
 
 import pika
 import pika.adapters
+import tornado.concurrent
+import tornado.ioloop
+import tornado.locks
+
+from app.logs import DEFAULT_SUMMARY_EVERY, DEFAULT_SUMMARY_S, Summary
+from app.spool import Spool
+
+DEFAULT_WINDOW = 64
+DEFAULT_WINDOW_BYTES = 64 * 1024 * 1024
+DEFAULT_RETRY_MEMORY = 16 * 1024 * 1024
+DEFAULT_RETRIES = 3
+DEFAULT_CHANNELS = 1
+
+Job = namedtuple("Job", ["ts", "filename", "file", "source", "modify"])
+Job.__new__.__defaults__ = (None, None)
+Part = namedtuple("Part", ["job", "tx_id", "index", "count", "payload", "encoding"])
+
+
+class Delivery(namedtuple("Delivery", ["epoch", "tag"])):
+    """Identifies a published message by its channel epoch and delivery tag."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return "{0}.{1}".format(self.epoch, self.tag)
+
+    @classmethod
+    def parse(cls, text):
+        epoch, tag = text.split(".")
+        return cls(int(epoch), int(tag))
+
+    @classmethod
+    def parse_all(cls, text):
+        """Parses the comma separated ids of a file published in parts"""
+        return [cls.parse(i) for i in text.split(",")] if text else []
+
+
+class ConfirmationTracker:
+    """Records broker confirmations of published messages.
+
+    Delivery tags restart on every channel, so each channel is given a new
+    epoch. A multiple confirmation settles every outstanding tag up to its
+    own. Each tag is settled once, so tracking costs O(1) per message.
+    Outcomes are kept until they are forgotten. Trackers which share an
+    iterator of `epochs` give out Deliveries which are unique among them.
+    """
+
+    def __init__(self, epochs=None):
+        self.epochs = epochs or itertools.count(1)
+        self.epoch = 0
+        self.acked = 0
+        self.nacked = 0
+        self._published = 0
+        self._floor = 0  # every tag up to here is settled
+        self._settled = set()  # settled tags above the floor
+        self._outcomes = {}
+
+    def __len__(self):
+        return len(self._outcomes)
+
+    @property
+    def unconfirmed(self):
+        """The number of messages awaiting confirmation in this epoch"""
+        return self._published - self._floor - len(self._settled)
+
+    def start(self):
+        """Begins a new epoch, eg: when confirmations are enabled on a new channel"""
+        self.epoch = next(self.epochs)
+        self._published = 0
+        self._floor = 0
+        self._settled = set()
+
+    def publish(self):
+        """Allocates the Delivery for the next message published in this epoch"""
+        self._published += 1
+        return Delivery(self.epoch, self._published)
+
+    def confirm(self, tag, ack, multiple=False):
+        """Settles one tag, or every outstanding tag up to it
+
+        :return: A list of the Deliveries settled
+        """
+        settled = []
+        for t in range(self._floor + 1 if multiple else tag, tag + 1):
+            if t not in self._settled and t > self._floor:
+                delivery = Delivery(self.epoch, t)
+                self._settled.add(t)
+                self._outcomes[delivery] = ack
+                settled.append(delivery)
+
+        while self._floor + 1 in self._settled:
+            self._floor += 1
+            self._settled.remove(self._floor)
+
+        if ack:
+            self.acked += len(settled)
+        else:
+            self.nacked += len(settled)
+        return settled
+
+    def outcome(self, msg_id):
+        """Returns True if the message was acked, False if nacked, or None if not yet confirmed"""
+        return self._outcomes.get(msg_id)
+
+    def record(self, msg_id, outcome):
+        """Records the outcome of a message which was confirmed under another Delivery"""
+        self._outcomes[msg_id] = outcome
+
+    def forget(self, *msg_ids):
+        for msg_id in msg_ids:
+            self._outcomes.pop(msg_id, None)
+
+
+class TrackerGroup:
+    """Presents the confirmation trackers of several channels as one"""
+
+    def __init__(self, trackers):
+        self.trackers = trackers
+
+    def __len__(self):
+        return sum(len(tracker) for tracker in self.trackers)
+
+    @property
+    def acked(self):
+        return sum(tracker.acked for tracker in self.trackers)
+
+    @property
+    def nacked(self):
+        return sum(tracker.nacked for tracker in self.trackers)
+
+    @property
+    def unconfirmed(self):
+        return sum(tracker.unconfirmed for tracker in self.trackers)
+
+    def outcome(self, msg_id):
+        for tracker in self.trackers:
+            outcome = tracker.outcome(msg_id)
+            if outcome is not None:
+                return outcome
+        return None
 
-Job = namedtuple("Job", ["ts", "filename", "file"])
+    def forget(self, *msg_ids):
+        for tracker in self.trackers:
+            tracker.forget(*msg_ids)
+
+
+class Topology:
+    """The queues bound to the exchange, each with its routing key
+
+    Publishers which share a Topology declare it once between them: the
+    first channel to open declares it while the others wait. It is declared
+    again if the broker reports the exchange is missing.
+    """
+
+    def __init__(self, bindings):
+        self.bindings = []
+        self.bindings.extend(b for b in bindings if b not in self.bindings)
+        self.declared = False
+        self.declaring = None
+        self.waiting = []
+
+    def open(self, publisher):
+        """Starts a publisher whose channel has opened, once the topology is declared"""
+        if self.declared:
+            publisher.start_publishing()
+        elif self.declaring is None:
+            self.declaring = publisher
+            publisher.setup_exchange(publisher.EXCHANGE)
+        else:
+            self.waiting.append(publisher)
+
+    def done(self, publisher):
+        self.declared = True
+        self.declaring = None
+        waiting, self.waiting = self.waiting, []
+        for p in [publisher] + waiting:
+            p.start_publishing()
+
+    def closed(self, publisher):
+        if publisher in self.waiting:
+            self.waiting.remove(publisher)
+        if self.declaring is publisher:
+            # Another channel takes over
+            self.declaring = None
+            if self.waiting:
+                self.open(self.waiting.pop(0))
+
+
+class RetryBuffer:
+    """Keeps the payloads of unconfirmed messages, so that they can be published again.
+
+    A payload is kept as the :class:`~app.spool.Spool` it was read from,
+    without copying, and the spool is closed once the message is settled.
+    Nothing is written to disk here, as the buffer is used on the IOLoop:
+    callers move a spool to disk beforehand when the buffer is :meth:`full`.
+
+    :param memory:  Bytes of payloads to keep in memory
+    """
+
+    def __init__(self, memory=DEFAULT_RETRY_MEMORY):
+        self.memory = memory
+        self.in_memory = 0
+        self._payloads = {}
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def full(self, size):
+        """Whether a payload of `size` bytes would take the buffer past its memory"""
+        return self.in_memory + size > self.memory
+
+    def add(self, msg_id, message, spool=None):
+        """Keeps a message, or the spool holding it, which the buffer then owns"""
+        size = 0 if spool is not None and spool.on_disk else len(message)
+        self.in_memory += size
+        self._payloads[msg_id] = (message if spool is None else spool, size)
+
+    def get(self, msg_id):
+        payload, unused_size = self._payloads[msg_id]
+        return payload if isinstance(payload, bytes) else payload.getvalue()
+
+    def pop(self, msg_id):
+        payload, size = self._payloads.pop(msg_id, (None, 0))
+        self.in_memory -= size
+        if isinstance(payload, Spool):
+            payload.close()
+
+
+class Pending:
+    """A message awaiting confirmation, which keeps its first msg_id when it is published again"""
+
+    __slots__ = ("msg_id", "confirmation", "size", "content_type", "headers", "routing_key", "attempts")
+
+    def __init__(self, msg_id, size, content_type=None, headers=None, routing_key=None):
+        self.msg_id = msg_id
+        self.confirmation = tornado.concurrent.Future()
+        self.size = size
+        self.content_type = content_type
+        self.headers = headers
+        self.routing_key = routing_key
+        self.attempts = 1
+
+
+def tornado_connection(parameters, on_open_callback, on_open_error_callback=None):
+    """Opens a pika connection on the Tornado IOLoop. The default connection factory."""
+    return pika.adapters.TornadoConnection(
+        parameters,
+        on_open_callback,
+        on_open_error_callback=on_open_error_callback,
+        stop_ioloop_on_close=False
+    )
 
 
 class DurableTopicPublisher:
 
     EXCHANGE = 'message'
     PUBLISH_INTERVAL = 1
+    # Reconnection waits grow exponentially from this many seconds, with jitter
+    RECONNECT_DELAY = 1
+    MAX_RECONNECT_DELAY = 60
     ROUTING_KEY = "JWT"
 
-    def __init__(self, amqp_url, queue_name, log=None, **kwargs):
+    def __init__(
+        self, amqp_url, queue_name, log=None,
+        window=DEFAULT_WINDOW, window_bytes=DEFAULT_WINDOW_BYTES, connection_factory=tornado_connection,
+        bindings=(), retry_memory=DEFAULT_RETRY_MEMORY, retries=DEFAULT_RETRIES, topology=None, epochs=None,
+        log_every=DEFAULT_SUMMARY_EVERY, log_interval=DEFAULT_SUMMARY_S, **kwargs
+    ):
         self.logger = log or logging.getLogger("sdx.seft")
-        self.confirmed_deliveries = []
+        # Confirmations are logged in summary, as there can be thousands a second
+        self.summary = Summary(self.logger, every=log_every, interval=log_interval)
+        self.connection_factory = connection_factory
+        self.tracker = ConfirmationTracker(epochs)
+        self.window = window
+        self.window_bytes = window_bytes
+        self.inflight_bytes = 0
+        # Pending messages by the Delivery they were last published as
+        self._inflight = {}
+        self.buffer = RetryBuffer(retry_memory)
+        self.retries = retries
+        self._reconnects = 0
+        self._window_open = tornado.locks.Condition()
 
         self._connection = None
         self._channel = None
-        self._acked = 0
-        self._nacked = 0
         self._message_number = 0
         self._stopping = False
-        self._url = amqp_url
+        # Reconnections move on to the next URL, eg: another node of a cluster
+        self._urls = [amqp_url] if isinstance(amqp_url, str) else list(amqp_url)
         self.queue_name = queue_name
+        self.topology = topology or Topology([(queue_name, self.ROUTING_KEY)] + list(bindings))
+        self._unbound = []
         self._closing = False
         self.publishing = False
+        self.blocked = False
+        # When the broker was last heard from, by the monotonic clock
+        self.activity = None
 
     def connect(self):
+        url = self._urls[self._reconnects % len(self._urls)]
         self.logger.info("Connecting...")
-        return pika.adapters.TornadoConnection(
-            pika.URLParameters(self._url),
-            self.on_connection_open,
-            stop_ioloop_on_close=False
+        return self.connection_factory(
+            pika.URLParameters(url), self.on_connection_open, on_open_error_callback=self.on_connection_error
         )
 
+    def on_connection_error(self, unused_connection, error):
+        self.logger.warning("Failed to connect: %s", error)
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        """Reconnects after an exponential backoff with jitter, so that replicas do not reconnect in step"""
+        ceiling = min(self.MAX_RECONNECT_DELAY, self.RECONNECT_DELAY * 2 ** self._reconnects)
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        self._reconnects += 1
+        self.logger.warning("Reconnecting in %.1f seconds", delay)
+        tornado.ioloop.IOLoop.current().call_later(delay, self.reconnect)
+
     def on_connection_open(self, unused_connection):
         self.logger.info("Connection opened")
+        self.activity = time.monotonic()
         self.add_on_connection_close_callback()
+        self.add_on_connection_blocked_callbacks()
         self.open_channel()
 
     def add_on_connection_close_callback(self):
         self.logger.info("Adding connection close callback")
         self._connection.add_on_close_callback(self.on_connection_closed)
 
+    def add_on_connection_blocked_callbacks(self):
+        self._connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        self._connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+
+    def on_connection_blocked(self, unused_frame):
+        """The broker is short of resources and has stopped accepting messages"""
+        self.logger.warning("Connection blocked by the broker")
+        self.blocked = True
+
+    def on_connection_unblocked(self, unused_frame):
+        self.logger.info("Connection unblocked by the broker")
+        self.blocked = False
+        self.activity = time.monotonic()
+        self._window_open.notify_all()
+
     def on_connection_closed(self, unused_connection, reply_code, reply_text):
         self._channel = None
+        self.publishing = False
+        self.topology.closed(self)
+        self.blocked = False
+        self._window_open.notify_all()
         if self._closing:
+            self.abandon_inflight()
             self._connection.ioloop.stop()
         else:
-            self.logger.warning(
-                "Connection closed, reopening in 5 seconds: (%s) %s",
-                reply_code, reply_text
-            )
-            self._connection.add_timeout(5, self.reconnect)
+            self.logger.warning("Connection closed: (%s) %s", reply_code, reply_text)
+            self.schedule_reconnect()
 
     def reconnect(self):
-        self._acked = 0
-        self._nacked = 0
         self._message_number = 0
 
         # Create a new connection
@@ -70,9 +374,10 @@ class DurableTopicPublisher:
 
     def on_channel_open(self, channel):
         self.logger.info("Channel opened")
+        self.activity = time.monotonic()
         self._channel = channel
         self.add_on_channel_close_callback()
-        self.setup_exchange(self.EXCHANGE)
+        self.topology.open(self)
 
     def add_on_channel_close_callback(self):
         self.logger.info("Adding channel close callback")
@@ -80,7 +385,14 @@ class DurableTopicPublisher:
 
     def on_channel_closed(self, unused_channel, reply_code, reply_text):
         self.logger.warning("Channel was closed: (%s) %s", reply_code, reply_text)
+        self._channel = None
+        self.publishing = False
+        if reply_code == 404:
+            # The exchange or a queue has gone, eg: the broker was reset
+            self.topology.declared = False
+        self.topology.closed(self)
         if not self._closing:
+            # Unconfirmed messages are kept, and published again on the next channel
             self._connection.close()
 
     def setup_exchange(self, exchange_name):
@@ -91,50 +403,53 @@ class DurableTopicPublisher:
 
     def on_exchange_declareok(self, unused_frame):
         self.logger.info("Exchange declared")
-        self.setup_queue(self.queue_name)
+        self._unbound = list(self.topology.bindings)
+        self.setup_queue(self._unbound[0][0])
 
     def setup_queue(self, queue_name):
         self.logger.info("Declaring queue %s", queue_name)
         self._channel.queue_declare(self.on_queue_declareok, queue_name, durable=True)
 
     def on_queue_declareok(self, unused_method_frame):
+        queue_name, routing_key = self._unbound[0]
         self.logger.info(
             "Binding %s to %s with %s",
-            self.EXCHANGE, self.queue_name, self.ROUTING_KEY
+            self.EXCHANGE, queue_name, routing_key
         )
-        self._channel.queue_bind(self.on_bindok, self.queue_name,
-                                 self.EXCHANGE, self.ROUTING_KEY)
+        self._channel.queue_bind(self.on_bindok, queue_name,
+                                 self.EXCHANGE, routing_key)
 
     def on_bindok(self, unused_frame):
         self.logger.info("Queue bound")
-        self.start_publishing()
+        self._unbound.pop(0)
+        if self._unbound:
+            self.setup_queue(self._unbound[0][0])
+        else:
+            self.topology.done(self)
 
     def start_publishing(self):
         self.logger.info("Issuing consumer related RPC commands")
+        self.tracker.start()
         self.enable_delivery_confirmations()
         self.publishing = True
+        self._reconnects = 0
+        self.replay()
 
     def enable_delivery_confirmations(self):
         self.logger.info("Issuing Confirm.Select RPC command")
         self._channel.confirm_delivery(self.on_delivery_confirmation)
 
     def on_delivery_confirmation(self, method_frame):
-        confirmation_type = method_frame.method.NAME.split(".")[1].lower()
-        self.logger.info(
-            "Received %s for delivery tag: %i",
-            confirmation_type,
-            method_frame.method.delivery_tag
-        )
-        if confirmation_type == "ack":
-            self._acked += 1
-        elif confirmation_type == "nack":
-            self._nacked += 1
-        self.confirmed_deliveries.append(method_frame.method.delivery_tag)
-        self.logger.info(
-            "Published %i messages, %i have been confirmed, "
+        self.activity = time.monotonic()
+        method = method_frame.method
+        ack = method.NAME == "Basic.Ack"
+        for msg_id in self.tracker.confirm(method.delivery_tag, ack, method.multiple):
+            self.settle(msg_id, ack)
+        self.summary(
+            "Published %i messages, %i are unconfirmed, "
             "%i were acked and %i were nacked",
-            self._message_number, len(self.confirmed_deliveries),
-            self._acked, self._nacked
+            self._message_number, self.tracker.unconfirmed,
+            self.tracker.acked, self.tracker.nacked
         )
 
     def schedule_next_message(self):
@@ -147,7 +462,7 @@ class DurableTopicPublisher:
         self._connection.add_timeout(self.PUBLISH_INTERVAL,
                                      self.publish_message)
 
-    def publish_message(self, message, content_type=None, headers=None):
+    def publish_message(self, message, content_type=None, headers=None, routing_key=None):
         if self._channel is None or self._stopping:
             return None
 
@@ -156,12 +471,117 @@ class DurableTopicPublisher:
         )
 
         self._channel.basic_publish(
-            self.EXCHANGE, self.ROUTING_KEY, message, properties,
+            self.EXCHANGE, routing_key or self.ROUTING_KEY, message, properties,
             mandatory=True, immediate=False
         )
         self._message_number += 1
-        self.logger.info("Published message # %i", self._message_number)
-        return self._message_number
+        return self.tracker.publish()
+
+    @property
+    def connected(self):
+        """Whether the connection and channel are open and ready for publishing
+
+        The connection closes if the broker misses heartbeats, so this is
+        also a sign the broker is alive.
+        """
+        connection, channel = self._connection, self._channel
+        if not self.publishing or connection is None or channel is None:
+            return False
+        return bool(connection.is_open and channel.is_open)
+
+    @property
+    def inflight(self):
+        """The number of messages published with :meth:`publish` and awaiting confirmation"""
+        return len(self._inflight)
+
+    def window_full(self, size):
+        if self.blocked:
+            return True
+        if not self._inflight:
+            # Always admit one message, however large
+            return False
+        return len(self._inflight) >= self.window or self.inflight_bytes + size > self.window_bytes
+
+    async def publish(self, message, content_type=None, headers=None, routing_key=None, spool=None):
+        """Publishes a message once there is room in the in-flight window
+
+        The window limits the number and total size of messages awaiting
+        confirmation, so that publishing keeps pace with the broker. Nothing is
+        published while the broker has blocked the connection.
+
+        :param routing_key:  Routes the message other than by the default routing key
+        :param spool:  The spool holding the message, which is kept for
+            publishing it again instead of a copy, and closed once the message
+            is settled or if it could not be published
+        :return: A tuple of the msg_id and a Future resolved with True on ack,
+            False on nack or None if the publisher stopped first. Messages are
+            published again after a nack or on a new channel, keeping their
+            msg_id. Both are None if the message could not be published.
+        """
+        while self.window_full(len(message)):
+            await self._window_open.wait()
+
+        msg_id = self.publish_message(message, content_type=content_type, headers=headers, routing_key=routing_key)
+        if msg_id is None:
+            if spool is not None:
+                spool.close()
+            return None, None
+
+        pending = Pending(msg_id, len(message), content_type, headers, routing_key)
+        self.buffer.add(msg_id, message, spool=spool)
+        self._inflight[msg_id] = pending
+        self.inflight_bytes += pending.size
+        return msg_id, pending.confirmation
+
+    def republish(self, pending, delivery):
+        """Publishes a pending message again. It stays pending under its old Delivery if the channel is closed."""
+        msg_id = self.publish_message(
+            self.buffer.get(pending.msg_id), content_type=pending.content_type,
+            headers=pending.headers, routing_key=pending.routing_key
+        )
+        self._inflight[delivery if msg_id is None else msg_id] = pending
+
+    def replay(self):
+        """Publishes again the messages which were unconfirmed when the last channel closed"""
+        stale = sorted(self._inflight.items(), key=lambda item: item[1].msg_id)
+        if stale:
+            self.logger.warning("Publishing %i unconfirmed messages again", len(stale))
+        self._inflight = {}
+        for delivery, pending in stale:
+            self.republish(pending, delivery)
+
+    def settle(self, msg_id, outcome):
+        """Resolves the confirmation of an in-flight message and opens the window
+
+        A nacked message is published again, up to `retries` times in all.
+        """
+        pending = self._inflight.pop(msg_id, None)
+        if pending is None:
+            return
+        if outcome is False and pending.attempts < self.retries and not self._stopping:
+            self.logger.warning("Message %s was nacked, publishing it again", pending.msg_id)
+            pending.attempts += 1
+            self.tracker.forget(msg_id)
+            self.republish(pending, msg_id)
+            return
+
+        self.buffer.pop(pending.msg_id)
+        self.inflight_bytes -= pending.size
+        if msg_id != pending.msg_id:
+            # Callers know the message by the Delivery it was first published as
+            self.tracker.forget(msg_id)
+            if outcome is not None:
+                self.tracker.record(pending.msg_id, outcome)
+        if not pending.confirmation.done():
+            pending.confirmation.set_result(outcome)
+        self._window_open.notify_all()
+
+    def abandon_inflight(self):
+        """Resolves in-flight messages which can no longer be confirmed"""
+        if self._inflight:
+            self.logger.warning("Abandoning %i unconfirmed messages", len(self._inflight))
+        for msg_id in list(self._inflight):
+            self.settle(msg_id, None)
 
     def close_channel(self):
         self.logger.info("Closing the channel")
@@ -184,3 +604,88 @@ class DurableTopicPublisher:
         self.logger.info("Closing connection")
         self._closing = True
         self._connection.close()
+
+
+class PublisherPool:
+    """Spreads messages over several channels, each on its own connection
+
+    The connections are made to the URLs in turn, so that the channels can
+    be spread over the nodes of a cluster. Each channel has its own window
+    and tracks its own confirmations. The channels share epochs, so message
+    ids are unique across the pool. The exchange and queues are declared by
+    the first channel to open. Messages on different channels may reach
+    their queues out of order.
+
+    :param amqp_url:  A URL, or a list of the URLs of cluster nodes
+    :param channels:  The number of channels
+    :param publisher:  The class of each channel's publisher
+    """
+
+    def __init__(
+        self, amqp_url, queue_name, channels=DEFAULT_CHANNELS, bindings=(),
+        retry_memory=DEFAULT_RETRY_MEMORY, publisher=DurableTopicPublisher, **kwargs
+    ):
+        urls = [amqp_url] if isinstance(amqp_url, str) else list(amqp_url)
+        channels = max(1, channels)
+        topology = Topology([(queue_name, publisher.ROUTING_KEY)] + list(bindings))
+        epochs = itertools.count(1)
+        self.publishers = [
+            publisher(
+                # Each channel fails over to the other nodes
+                urls[n % len(urls):] + urls[:n % len(urls)], queue_name,
+                retry_memory=retry_memory // channels, topology=topology, epochs=epochs, **kwargs
+            )
+            for n in range(channels)
+        ]
+        self.topology = topology
+        self.tracker = TrackerGroup([publisher.tracker for publisher in self.publishers])
+
+    @property
+    def publishing(self):
+        return any(publisher.publishing for publisher in self.publishers)
+
+    @property
+    def connected(self):
+        """Whether any channel is ready for publishing"""
+        return any(publisher.connected for publisher in self.publishers)
+
+    @property
+    def blocked(self):
+        """Whether the broker has blocked every channel which is publishing"""
+        return not any(publisher.publishing and not publisher.blocked for publisher in self.publishers)
+
+    @property
+    def activity(self):
+        return max((p.activity for p in self.publishers if p.activity is not None), default=None)
+
+    @property
+    def inflight(self):
+        return sum(publisher.inflight for publisher in self.publishers)
+
+    def retry_full(self, size):
+        """Whether a message of `size` bytes would take the channels' retry buffers past their memory"""
+        buffers = [publisher.buffer for publisher in self.publishers]
+        return sum(buffer.in_memory for buffer in buffers) + size > sum(buffer.memory for buffer in buffers)
+
+    def choose(self, size):
+        """Picks the publishing channel with room in its window and the fewest bytes in flight"""
+        ready = [publisher for publisher in self.publishers if publisher.publishing] or self.publishers
+        return min(ready, key=lambda publisher: (publisher.window_full(size), publisher.inflight_bytes))
+
+    async def publish(self, message, content_type=None, headers=None, routing_key=None, spool=None):
+        """Publishes a message on the least busy channel. See :meth:`DurableTopicPublisher.publish`."""
+        return await self.choose(len(message)).publish(
+            message, content_type=content_type, headers=headers, routing_key=routing_key, spool=spool
+        )
+
+    def connect(self):
+        for publisher in self.publishers:
+            publisher._connection = publisher.connect()
+
+    def run(self):
+        self.connect()
+        tornado.ioloop.IOLoop.current().start()
+
+    def stop(self):
+        for publisher in self.publishers:
+            publisher.stop()
@@ -0,0 +1,75 @@
+import datetime
+import logging
+
+import tornado.ioloop
+import tornado.locks
+import tornado.util
+from structlog import wrap_logger
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+# pylint: disable=broad-except
+class AdaptiveScheduler:
+    """Runs a coroutine function repeatedly, more often while it finds work.
+
+    The function returns a true value when a run made progress, in which
+    case the next run starts straight away. Otherwise the delay before the
+    next run doubles, from `interval` up to `ceiling`. A call to
+    :meth:`trigger` starts the next run early. Runs never overlap.
+
+    :param func:  A coroutine function
+    :param interval:  Shortest delay between idle runs, in seconds
+    :param ceiling:  Longest delay between idle runs, in seconds
+    """
+
+    def __init__(self, func, interval, ceiling):
+        self.func = func
+        self.interval = interval
+        self.ceiling = max(interval, ceiling)
+        self.delay = 0
+        self.running = False
+        self._wake = tornado.locks.Event()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def trigger(self):
+        """Starts the next run as soon as the current one, if any, finishes"""
+        self._wake.set()
+
+    def reset(self):
+        """Restarts the backoff, so that an idle run is followed by the shortest delay"""
+        self.delay = 0
+
+    def backoff(self, busy):
+        if busy:
+            self.delay = 0
+        else:
+            self.delay = min(max(self.delay * 2, self.interval), self.ceiling)
+        return self.delay
+
+    async def run(self):
+        while self.running:
+            self._wake.clear()
+            try:
+                busy = await self.func()
+            except Exception:
+                logger.exception("Scheduled run failed")
+                busy = False
+
+            delay = self.backoff(busy)
+            if delay and self.running:
+                logger.info("Next run scheduled", delay=delay)
+                try:
+                    await self._wake.wait(timeout=datetime.timedelta(seconds=delay))
+                except tornado.util.TimeoutError:
+                    pass
+                else:
+                    logger.info("Run triggered")
@@ -0,0 +1,109 @@
+import json
+import logging
+import posixpath
+
+from structlog import wrap_logger
+
+from app.ftpclient import DEFAULT_KEEPALIVE_S, DEFAULT_POOL_SIZE, ListingWatcher, SessionPool
+
+logger = wrap_logger(logging.getLogger(__name__))
+
+
+class Source:
+    """An FTP directory which files are published from.
+
+    Each source has its own pool of FTP sessions. Its files are entered in
+    the ledger under the source name, so that sources may hold files with
+    the same names.
+
+    :param name:  A name unique among sources. The only source may have an empty name.
+    :param ftp_params:  Arguments for the source's FTPWorkers
+    :param routing_key:  Routing key for the source's messages, or None for the default
+    :param queue:  A queue to declare and bind to the routing key, if any. The
+        routing key defaults to the queue name.
+    :param weight:  Share of each round of downloads taken by this source
+    """
+
+    def __init__(
+        self, name, ftp_params, routing_key=None, queue=None, weight=1,
+        pool_size=DEFAULT_POOL_SIZE, keepalive=DEFAULT_KEEPALIVE_S
+    ):
+        self.name = name
+        self.queue = queue
+        self.routing_key = routing_key or queue
+        self.weight = max(1, int(weight))
+        # Big enough to keep the sessions of every download worker between cycles
+        size = max(pool_size, ftp_params.get("connections", 1))
+        self.pool = SessionPool(size=size, keepalive=keepalive, **ftp_params)
+        self.watcher = ListingWatcher()
+        self.deleter = None
+
+    def __repr__(self):
+        return "<Source {0!r}>".format(self.name)
+
+    def key(self, filename):
+        """The name of a file of this source in the ledger"""
+        return "{0}/{1}".format(self.name, filename) if self.name else filename
+
+
+def split_key(key):
+    """Splits a ledger key into the source name and filename"""
+    name, _, filename = key.rpartition("/")
+    return name, filename
+
+
+def load_sources(text, ftp_params, **kwargs):
+    """Creates sources from a JSON list of objects
+
+    Each object may have the keys `name`, `host`, `port`, `user`,
+    `password`, `directory`, `routing_key`, `queue` and `weight`. Values which
+    are not given are taken from `ftp_params`. With no text, there is a
+    single source with an empty name. A source which is not named, among
+    several, is named after the last part of its directory.
+
+    :raises ValueError: If the text is not valid or names are not unique
+    """
+    if not text:
+        return [Source("", ftp_params, **kwargs)]
+
+    entries = json.loads(text)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Sources must be a non-empty list")
+
+    sources = []
+    for entry in entries:
+        params = dict(ftp_params)
+        for key in ("host", "user", "password"):
+            params[key] = entry.get(key, params[key])
+        params["port"] = int(entry.get("port", params["port"]))
+        params["working_directory"] = entry.get("directory", params["working_directory"])
+        default = "" if len(entries) == 1 else posixpath.basename(params["working_directory"].rstrip("/"))
+        name = entry.get("name", default)
+        sources.append(Source(
+            name, params, routing_key=entry.get("routing_key"), queue=entry.get("queue"),
+            weight=entry.get("weight", 1), **kwargs
+        ))
+
+    names = [source.name for source in sources]
+    if len(set(names)) != len(names) or any("/" in name for name in names):
+        raise ValueError("Source names must be unique and must not contain '/'")
+    if len(names) > 1 and not all(names):
+        raise ValueError("Sources must be named, or have directories other than the root")
+    return sources
+
+
+def weighted_round_robin(batches):
+    """Interleaves the files of several sources
+
+    Each round takes up to `weight` files from each source in turn, so that
+    a source with a long backlog does not hold up the others.
+
+    :param batches:  A list of (source, filenames) pairs
+    :return: A generator of (source, filenames) pairs
+    """
+    batches = [(source, list(filenames)) for source, filenames in batches]
+    while any(filenames for _, filenames in batches):
+        for source, filenames in batches:
+            if filenames:
+                yield source, filenames[:source.weight]
+                del filenames[:source.weight]
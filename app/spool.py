@@ -0,0 +1,110 @@
+import hashlib
+import io
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_SPOOL_THRESHOLD = 8 * 1024 * 1024
+
+
+class Spool:
+    """A buffer which is held in memory until it grows past a threshold, then moves to a temporary file.
+
+    Content is read back in chunks so that callers need not hold a whole
+    file in memory. A SHA-256 digest of the content is kept as it is written.
+
+    :param threshold:  Size in bytes above which the content is moved to disk
+    """
+
+    def __init__(self, threshold=DEFAULT_SPOOL_THRESHOLD):
+        self.threshold = threshold
+        self.size = 0
+        self.on_disk = False
+        self._file = io.BytesIO()
+        self._hash = hashlib.sha256()
+        self._unlinked = False
+
+    @classmethod
+    def adopt(cls, path, threshold=DEFAULT_SPOOL_THRESHOLD):
+        """Takes over a file left by :meth:`detach`, eg: in another process
+
+        The file is unlinked once it is open, so it goes when the spool is
+        closed, and the spool has no name.
+        """
+        spool = cls(threshold)
+        spool._file = open(path, "rb")
+        os.unlink(path)
+        spool.on_disk = True
+        spool._unlinked = True
+        for data in iter(lambda: spool._file.read(CHUNK_SIZE), b""):
+            spool._hash.update(data)
+            spool.size += len(data)
+        return spool
+
+    @property
+    def name(self):
+        """The path of the backing file, or None while held in memory or once the file is unlinked"""
+        return self._file.name if self.on_disk and not self._unlinked else None
+
+    @property
+    def digest(self):
+        """The hex SHA-256 digest of the content written so far"""
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        if not self.on_disk and self.size + len(data) > self.threshold:
+            self.rollover()
+        self._file.seek(0, io.SEEK_END)
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def rollover(self):
+        """Moves the content to a temporary file"""
+        if self.on_disk:
+            return
+        buf = self._file
+        self._file = tempfile.NamedTemporaryFile(prefix="seft-")
+        self._file.write(buf.getbuffer())
+        buf.close()
+        self.on_disk = True
+
+    def chunks(self, size=CHUNK_SIZE, start=0, length=None):
+        """Iterates over the content, or `length` bytes of it from offset `start`"""
+        self._file.seek(start)
+        remaining = self.size - start if length is None else length
+        while remaining > 0:
+            data = self._file.read(min(size, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+    def getvalue(self):
+        """Returns the whole content as bytes"""
+        if not self.on_disk:
+            return self._file.getvalue()
+        self._file.seek(0)
+        return self._file.read()
+
+    def detach(self):
+        """Closes the spool, leaving the content in a file for :meth:`adopt`
+
+        :return: The path of the file, which the caller must remove
+        """
+        self.rollover()
+        path = self._file.name + ".detached"
+        os.link(self._file.name, path)
+        self.close()
+        return path
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
@@ -0,0 +1,232 @@
+from collections import namedtuple
+import itertools
+
+import pika.exceptions
+import pika.frame
+import pika.spec
+import tornado.ioloop
+
+Message = namedtuple("Message", ["exchange", "routing_key", "body", "properties"])
+
+
+def topic_matches(pattern, routing_key):
+    """Matches a routing key against a topic binding, where `*` is one word and `#` is any number"""
+    def match(words, keys):
+        if not words:
+            return not keys
+        if words[0] == "#":
+            return any(match(words[1:], keys[n:]) for n in range(len(keys) + 1))
+        return bool(keys) and words[0] in ("*", keys[0]) and match(words[1:], keys[1:])
+
+    return match(pattern.split("."), routing_key.split("."))
+
+
+class Broker:
+    """An in-process stand-in for RabbitMQ, for testing and benchmarking publishers.
+
+    It speaks the part of pika's asynchronous API that the publisher uses:
+    exchange and queue declaration and binding, publisher confirms, blocked
+    connections and connection loss. Its :meth:`connect` method is used as
+    a publisher's connection factory. Everything runs on the current IOLoop.
+
+    :param ack_latency:  Seconds before messages are confirmed
+    :param nack:  Optional callable run as ``nack(message)``, which returns
+        True for messages which the broker should nack
+    :param multiple:  Confirm messages which are waiting together with one
+        multiple ack or nack, as RabbitMQ does under load
+    """
+
+    def __init__(self, ack_latency=0, nack=None, multiple=False):
+        self.ack_latency = ack_latency
+        self.nack = nack
+        self.multiple = multiple
+        self.exchanges = {}
+        self.queues = {}
+        self.bindings = []
+        self.declarations = 0
+        self.connections = []
+        self.blocked = False
+        self.refusing = False
+        self.published_while_blocked = 0
+        self.acked = 0
+        self.nacked = 0
+
+    def connect(self, unused_parameters, on_open_callback, on_open_error_callback=None):
+        if self.refusing:
+            connection = Connection(self, None)
+            connection.is_open = False
+            connection.ioloop.add_callback(on_open_error_callback, connection, "Connection refused")
+            return connection
+        connection = Connection(self, on_open_callback)
+        self.connections.append(connection)
+        return connection
+
+    def route(self, message):
+        if message.exchange not in self.exchanges:
+            return False
+        for queue, exchange, pattern in self.bindings:
+            if exchange == message.exchange and topic_matches(pattern, message.routing_key):
+                self.queues[queue].append(message)
+        return True
+
+    @property
+    def messages(self):
+        """All messages in all queues"""
+        return list(itertools.chain.from_iterable(self.queues.values()))
+
+    def block(self, reason="low on memory"):
+        """Blocks publishing connections, as when the broker reaches a resource alarm"""
+        self.blocked = True
+        for connection in list(self.connections):
+            connection.notify(connection.blocked_callbacks, pika.spec.Connection.Blocked(reason))
+
+    def unblock(self):
+        self.blocked = False
+        for connection in list(self.connections):
+            connection.notify(connection.unblocked_callbacks, pika.spec.Connection.Unblocked())
+
+    def drop(self, reply_code=320, reply_text="CONNECTION_FORCED - broker forced connection closure"):
+        """Closes every connection, discarding unconfirmed messages. Set `refusing` to refuse new ones."""
+        for connection in list(self.connections):
+            connection.close(reply_code, reply_text)
+
+
+class Connection:
+
+    def __init__(self, broker, on_open_callback):
+        self.broker = broker
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.is_open = True
+        self.channels = []
+        self.close_callbacks = []
+        self.blocked_callbacks = []
+        self.unblocked_callbacks = []
+        if on_open_callback is not None:
+            self.ioloop.add_callback(on_open_callback, self)
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def add_on_connection_blocked_callback(self, callback):
+        self.blocked_callbacks.append(callback)
+
+    def add_on_connection_unblocked_callback(self, callback):
+        self.unblocked_callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        return self.ioloop.call_later(deadline, callback)
+
+    def notify(self, callbacks, method):
+        for callback in callbacks:
+            callback(pika.frame.Method(0, method))
+
+    def channel(self, on_open_callback):
+        channel = Channel(self, len(self.channels) + 1)
+        self.channels.append(channel)
+        self.ioloop.add_callback(on_open_callback, channel)
+        return channel
+
+    def close(self, reply_code=200, reply_text="Normal shutdown"):
+        if not self.is_open:
+            return
+        self.is_open = False
+        if self in self.broker.connections:
+            self.broker.connections.remove(self)
+        for channel in self.channels:
+            channel.close(reply_code, reply_text)
+        for callback in self.close_callbacks:
+            self.ioloop.add_callback(callback, self, reply_code, reply_text)
+
+
+class Channel:
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.is_open = True
+        self.close_callbacks = []
+        self.confirm_callback = None
+        self.delivery_tag = 0
+        self.unconfirmed = []
+        self._flush = None
+
+    def reply(self, callback, method):
+        if callback is not None:
+            self.connection.ioloop.add_callback(callback, pika.frame.Method(self.channel_number, method))
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def exchange_declare(self, callback=None, exchange=None, exchange_type="direct", **kwargs):
+        self.broker.exchanges.setdefault(exchange, exchange_type)
+        self.broker.declarations += 1
+        self.reply(callback, pika.spec.Exchange.DeclareOk())
+
+    def queue_declare(self, callback, queue="", **kwargs):
+        messages = self.broker.queues.setdefault(queue, [])
+        self.reply(callback, pika.spec.Queue.DeclareOk(queue, len(messages), 0))
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None, **kwargs):
+        binding = (queue, exchange, routing_key or queue)
+        if binding not in self.broker.bindings:
+            self.broker.bindings.append(binding)
+        self.reply(callback, pika.spec.Queue.BindOk())
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self.confirm_callback = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
+        if not self.is_open:
+            raise pika.exceptions.ChannelClosed()
+        if self.broker.blocked:
+            self.broker.published_while_blocked += 1
+
+        message = Message(exchange, routing_key, body, properties)
+        if self.confirm_callback is None:
+            self.broker.route(message)
+            return
+
+        self.delivery_tag += 1
+        self.unconfirmed.append((self.delivery_tag, message))
+        if self._flush is None:
+            self._flush = self.connection.ioloop.call_later(self.broker.ack_latency, self.confirm)
+
+    def confirm(self):
+        """Routes waiting messages and confirms them"""
+        self._flush = None
+        outcomes = []
+        for tag, message in self.unconfirmed:
+            ack = not (self.broker.nack and self.broker.nack(message)) and self.broker.route(message)
+            outcomes.append((tag, ack))
+        self.unconfirmed = []
+
+        if self.broker.multiple:
+            # One confirmation for each run of messages with the same outcome
+            runs = [list(run) for _, run in itertools.groupby(outcomes, key=lambda i: i[1])]
+            frames = [(run[-1][0], run[0][1], len(run) > 1) for run in runs]
+        else:
+            frames = [(tag, ack, False) for tag, ack in outcomes]
+
+        for tag, ack, multiple in frames:
+            if not self.is_open:
+                return
+            if ack:
+                method = pika.spec.Basic.Ack(delivery_tag=tag, multiple=multiple)
+            else:
+                method = pika.spec.Basic.Nack(delivery_tag=tag, multiple=multiple, requeue=False)
+            self.confirm_callback(pika.frame.Method(self.channel_number, method))
+
+        self.broker.acked += sum(1 for _, ack in outcomes if ack)
+        self.broker.nacked += sum(1 for _, ack in outcomes if not ack)
+
+    def close(self, reply_code=200, reply_text="Normal shutdown"):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self.unconfirmed = []
+        if self._flush is not None:
+            self.connection.ioloop.remove_timeout(self._flush)
+            self._flush = None
+        for callback in self.close_callbacks:
+            self.connection.ioloop.add_callback(callback, self, reply_code, reply_text)
@@ -0,0 +1,42 @@
+import base64
+import hashlib
+
+from app.compression import decompress
+
+
+class ReassemblyError(Exception):
+    pass
+
+
+class Reassembler(object):
+    """Joins the decrypted claims of a file which was published in parts.
+
+    Parts may arrive in any order. Each part carries its index, the number of
+    parts and the SHA-256 digest of the whole file, which is checked once
+    every part has arrived. Content which was compressed before encryption
+    is decompressed according to its `encoding` claim.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, data):
+        """Adds the decrypted claims of one message
+
+        :return: The whole file content once every part has arrived, otherwise None
+        """
+        content = base64.standard_b64decode(data["file"])
+        if "parts" not in data:
+            return decompress(content, data.get("encoding"))
+
+        key = (data["filename"], data["digest"])
+        parts = self.pending.setdefault(key, {})
+        parts[data["part"]] = content
+        if len(parts) < data["parts"]:
+            return None
+
+        del self.pending[key]
+        content = decompress(b"".join(parts[n] for n in range(data["parts"])), data.get("encoding"))
+        if hashlib.sha256(content).hexdigest() != data["digest"]:
+            raise ReassemblyError("Digest mismatch for {0}".format(data["filename"]))
+        return content
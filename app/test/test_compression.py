@@ -0,0 +1,32 @@
+import os
+import unittest
+
+from app.compression import compress, decompress, worth_compressing
+from app.spool import Spool
+
+
+class CompressionTests(unittest.TestCase):
+
+    def spool(self, content):
+        spool = Spool(threshold=4096)
+        spool.write(content)
+        return spool
+
+    def test_worth_compressing(self):
+        self.assertTrue(worth_compressing(b"a,b,c\n" * 1000, "zlib"))
+        self.assertFalse(worth_compressing(os.urandom(6000), "zlib"))
+        self.assertFalse(worth_compressing(b"", "zlib"))
+
+    def test_compress_round_trip(self):
+        content = b"period,ru_ref,value\n" + b"201912,49900001234,1000\n" * 5000
+        for codec in ("zlib", "lzma"):
+            with self.subTest(codec=codec), self.spool(content) as spool:
+                encoding, compressed = compress(spool, codec)
+                self.assertEqual(codec, encoding)
+                self.assertLess(compressed.size, spool.size / 5)
+                self.assertEqual(content, decompress(compressed.getvalue(), encoding))
+
+    def test_incompressible_content_is_left_alone(self):
+        with self.spool(os.urandom(10000)) as spool:
+            self.assertEqual((None, spool), compress(spool, "zlib"))
+            self.assertEqual((None, spool), compress(spool, None))
@@ -0,0 +1,80 @@
+import contextlib
+import threading
+import unittest
+
+from app.deleter import Deleter
+
+
+class FTP:
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.deleted = []
+
+    def delete(self, filename):
+        if filename in self.fail:
+            return False
+        self.deleted.append(filename)
+        return True
+
+
+class Pool:
+
+    def __init__(self, ftp):
+        self.ftp = ftp
+        self.sessions = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    @contextlib.contextmanager
+    def session(self):
+        self.gate.wait()
+        self.sessions += 1
+        yield self.ftp
+
+
+class DeleterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.deleted = []
+        self.done = threading.Event()
+
+    def on_deleted(self, filename, msg_id):
+        self.deleted.append((filename, msg_id))
+        if len(self.deleted) == self.expected:
+            self.done.set()
+
+    def test_batches_queued_files(self):
+        pool = Pool(FTP(fail=["c.xls"]))
+        deleter = Deleter(pool, self.on_deleted, batch=3, linger=0.05)
+        self.expected = 4
+
+        pool.gate.clear()
+        self.assertTrue(deleter.submit("a.xls", "1.1"))
+        for n, filename in enumerate(["b.xls", "c.xls", "d.xls", "e.xls"], 2):
+            deleter.submit(filename, "1.{0}".format(n))
+        self.assertFalse(deleter.submit("b.xls", "1.2"))
+        self.assertIn("b.xls", deleter)
+        pool.gate.set()
+
+        self.assertTrue(self.done.wait(5))
+        deleter.stop(timeout=5)
+        self.assertEqual(
+            [("a.xls", "1.1"), ("b.xls", "1.2"), ("d.xls", "1.4"), ("e.xls", "1.5")], self.deleted
+        )
+        self.assertEqual(2, pool.sessions)
+        self.assertEqual(0, len(deleter))
+
+        # A file which failed can be queued again
+        self.assertTrue(deleter.submit("c.xls"))
+        deleter.stop(timeout=5)
+
+    def test_no_session(self):
+        pool = Pool(None)
+        failed = []
+        deleter = Deleter(pool, self.on_deleted, linger=0, on_failed=lambda *args: failed.append(args))
+        deleter.submit("a.xls", "1.1")
+        deleter.stop(timeout=5)
+        self.assertEqual([], self.deleted)
+        self.assertEqual([("a.xls", "1.1")], failed)
+        self.assertNotIn("a.xls", deleter)
@@ -0,0 +1,90 @@
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import os
+import unittest
+
+import yaml
+from sdc.crypto.key_store import KeyStore
+
+from app.encoder import ParallelEncoder, SerialEncoder
+from app.publisher import Job
+from app.spool import Spool
+from app.test.decrypter import Decrypter
+from app.test.reassembler import Reassembler
+from app.test.test_encryption import KEYS, read_key
+
+
+class EncoderTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(KEYS, "keys.yml")) as keys:
+            cls.key_store = KeyStore(yaml.safe_load(keys))
+        cls.decrypter = Decrypter(
+            read_key("sdc-sdx-outbound-signing-public-v1.pem"),
+            read_key("sdc-ras-outbound-encryption-private-v1.pem"),
+            None
+        )
+        cls.executor = ProcessPoolExecutor(max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def jobs(self, sizes):
+        rv = []
+        for n, size in enumerate(sizes):
+            spool = Spool(threshold=20000)
+            spool.write(os.urandom(size))
+            rv.append(Job(datetime.datetime.utcnow(), "{0}.xls".format(n), spool))
+        return rv
+
+    def encode(self, encoder, jobs):
+        contents = {job.filename: job.file.getvalue() for job in jobs}
+        parts = []
+        with encoder:
+            for job in jobs:
+                parts.extend(encoder.submit(job, job.filename, {"filename": job.filename}, "outbound"))
+            parts.extend(encoder.flush())
+
+        reassembler = Reassembler()
+        for part in parts:
+            self.assertEqual(part.job.filename, part.tx_id)
+            with part.payload:
+                data = self.decrypter.decrypt(part.payload.getvalue().decode("ascii"))
+            content = reassembler.add(data)
+            if content is not None:
+                self.assertEqual(contents.pop(data["filename"]), content)
+        self.assertEqual({}, contents)
+        return [part.job.filename for part in parts]
+
+    def test_serial(self):
+        names = self.encode(SerialEncoder(self.key_store, chunk_size=10000), self.jobs([30000, 100]))
+        self.assertEqual(["0.xls"] * 3 + ["1.xls"], names)
+
+    def test_parallel_keeps_order(self):
+        sizes = [60000, 100, 30000, 5, 1000]
+        encoder = ParallelEncoder(self.executor, depth=3, chunk_size=25000)
+        names = self.encode(encoder, self.jobs(sizes))
+        self.assertEqual(["0.xls"] * 3 + ["1.xls"] + ["2.xls"] * 2 + ["3.xls", "4.xls"], names)
+
+    def test_parallel_completion_order(self):
+        sizes = [60000, 100, 30000, 5, 1000]
+        encoder = ParallelEncoder(self.executor, depth=3, ordered=False)
+        names = self.encode(encoder, self.jobs(sizes))
+        self.assertEqual(sorted(names), ["{0}.xls".format(n) for n in range(5)])
+
+    def test_parallel_leaves_large_parts_on_disk(self):
+        job, = self.jobs([60000])
+        with ParallelEncoder(self.executor, depth=1, chunk_size=5000) as encoder:
+            parts = list(encoder.submit(job, job.filename, {"filename": job.filename}, "outbound"))
+        # Parts are held in memory up to the spool threshold, then handed over in files
+        on_disk = [part.payload.on_disk for part in parts]
+        self.assertEqual(12, len(on_disk))
+        self.assertEqual(sorted(on_disk), on_disk)
+        self.assertFalse(on_disk[0])
+        self.assertTrue(on_disk[-1])
+        for part in parts:
+            self.assertIsNone(part.payload.name)
+            self.assertTrue(part.payload.getvalue().startswith(b"eyJ"))
+            part.payload.close()
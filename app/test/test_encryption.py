@@ -0,0 +1,115 @@
+import base64
+import os.path
+import unittest
+
+import yaml
+from sdc.crypto.key_store import KeyStore
+
+from app.compression import compress
+from app.encryption import encrypt_file, encrypt_parts, encrypt_stream, stream_b64
+from app.spool import Spool
+from app.test.decrypter import Decrypter
+from app.test.reassembler import Reassembler
+
+KEYS = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "jwt-test-keys"))
+
+
+def read_key(name):
+    with open(os.path.join(KEYS, name)) as key:
+        return key.read()
+
+
+class EncryptionTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(KEYS, "keys.yml")) as keys:
+            cls.key_store = KeyStore(yaml.safe_load(keys))
+        cls.decrypter = Decrypter(
+            read_key("sdc-sdx-outbound-signing-public-v1.pem"),
+            read_key("sdc-ras-outbound-encryption-private-v1.pem"),
+            None
+        )
+
+    def spool(self, content, threshold):
+        spool = Spool(threshold=threshold)
+        for n in range(0, len(content), 1000):
+            spool.write(content[n:n + 1000])
+        return spool
+
+    def test_stream_b64_matches_whole_encoding(self):
+        content = os.urandom(10000)
+        for size in (1, 2, 3, 7, 64, 9999):
+            with self.subTest(size=size):
+                chunks = (content[n:n + size] for n in range(0, len(content), size))
+                self.assertEqual(
+                    b"".join(stream_b64(chunks, encode=base64.standard_b64encode)),
+                    base64.standard_b64encode(content)
+                )
+
+    def test_stream_round_trip(self):
+        content = os.urandom(100001)
+        claims = {"ts": "2020-01-01T00:00:00", "filename": "data\"file\".xls"}
+        token = encrypt_stream(
+            claims, "file", [content[:5], content[5:70000], content[70000:]], self.key_store, "outbound"
+        )
+        data = self.decrypter.decrypt(token.getvalue().decode("ascii"))
+        self.assertEqual(data["filename"], claims["filename"])
+        self.assertEqual(data["ts"], claims["ts"])
+        self.assertEqual(base64.standard_b64decode(data["file"]), content)
+
+    def test_encrypt_file_in_memory_and_on_disk(self):
+        content = os.urandom(50000)
+        for threshold in (len(content), 4096):
+            with self.subTest(threshold=threshold), self.spool(content, threshold) as spool:
+                self.assertEqual(spool.on_disk, threshold < len(content))
+                token = encrypt_file({"filename": "data.xls"}, spool, self.key_store, "outbound")
+                data = self.decrypter.decrypt(token.getvalue().decode("ascii"))
+                self.assertEqual(base64.standard_b64decode(data["file"]), content)
+
+    def test_parts_round_trip(self):
+        content = os.urandom(25000)
+        reassembler = Reassembler()
+        with self.spool(content, 4096) as spool:
+            parts = list(encrypt_parts({"filename": "data.xls"}, spool, self.key_store, "outbound", 10000))
+            self.assertEqual([(0, 3), (1, 3), (2, 3)], [(index, count) for index, count, _ in parts])
+            results = []
+            for index, count, token in reversed(parts):
+                data = self.decrypter.decrypt(token.getvalue().decode("ascii"))
+                self.assertEqual((index, count, spool.digest), (data["part"], data["parts"], data["digest"]))
+                results.append(reassembler.add(data))
+        self.assertEqual([None, None, content], results)
+        self.assertEqual({}, reassembler.pending)
+
+    def test_compressed_parts_round_trip(self):
+        content = b"201912,49900001234,1000\n" * 2000
+        reassembler = Reassembler()
+        with self.spool(content, 4096) as spool:
+            encoding, compressed = compress(spool, "zlib")
+            claims = {"filename": "data.csv", "encoding": encoding}
+            parts = encrypt_parts(claims, compressed, self.key_store, "outbound", 100, digest=spool.digest)
+            results = [reassembler.add(self.decrypter.decrypt(token.getvalue().decode("ascii")))
+                       for _, _, token in parts]
+        self.assertEqual(content, results[-1])
+
+
+class SpoolTests(unittest.TestCase):
+
+    def test_rollover(self):
+        with Spool(threshold=10) as spool:
+            spool.write(b"0123456789")
+            self.assertFalse(spool.on_disk)
+            self.assertIsNone(spool.name)
+            spool.write(b"a")
+            self.assertTrue(spool.on_disk)
+            self.assertTrue(os.path.exists(spool.name))
+            self.assertEqual(spool.size, 11)
+            self.assertEqual(b"".join(spool.chunks(3)), b"0123456789a")
+            spool.write(b"b")
+            self.assertEqual(spool.getvalue(), b"0123456789ab")
+
+    def test_chunks_range(self):
+        with Spool(threshold=4) as spool:
+            spool.write(b"0123456789")
+            self.assertEqual([b"345", b"67"], list(spool.chunks(3, start=3, length=5)))
+            self.assertEqual([b"89"], list(spool.chunks(3, start=8, length=5)))
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 #   encoding: UTF-8
 
+import ftplib
 import os
 import multiprocessing
 import random
 import shutil
+import socket
 import sys
 import tempfile
 import time
@@ -14,7 +16,7 @@ import unittest.mock
 # To run test in CF
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from ftpclient import FTPWorker
+from ftpclient import Entry, FTPWorker, ListingWatcher, SessionPool, parse_list_line
 
 try:
     from localserver import serve
@@ -74,6 +76,51 @@ class ExceptionTests(unittest.TestCase):
             self.assertFalse(broker.delete("data.xls"))
             delete_mock.assert_called_once_with("127.0.0.1", 2121, timeout=30)
 
+    @unittest.mock.patch("ftpclient.FTP.connect")
+    @unittest.mock.patch("ftpclient.FTP.login")
+    @unittest.mock.patch("ftpclient.FTP.cwd")
+    @unittest.mock.patch("ftpclient.FTP.quit")
+    def test_host_session_limit(self, quit_mock, cwd_mock, login_mock, connect_mock):
+        params = dict(self.params, port=2122, host_connections=1)
+        with FTPWorker(**params) as first:
+            self.assertTrue(first)
+            self.assertIsNone(FTPWorker(**params).connect(wait=False))
+        with FTPWorker(**params) as second:
+            self.assertTrue(second)
+
+
+class ListingTests(unittest.TestCase):
+
+    def test_parse_unix_list(self):
+        self.assertEqual(
+            Entry("data file.xls", 1234, "Jan 01 12:00", "file"),
+            parse_list_line("-rw-r--r--   1 owner    group        1234 Jan 01 12:00 data file.xls")
+        )
+        self.assertEqual("dir", parse_list_line("drwxr-xr-x   2 owner group 4096 Jan 01  2020 sub").type)
+
+    def test_parse_dos_list(self):
+        self.assertEqual(
+            Entry("data.xls", 1234, "01-31-20  09:05AM", "file"),
+            parse_list_line("01-31-20  09:05AM                 1234 data.xls")
+        )
+        self.assertEqual(
+            Entry("EDC_Templates", None, "01-31-2020  11:15PM", "dir"),
+            parse_list_line("01-31-2020  11:15PM       <DIR>          EDC_Templates")
+        )
+
+    def test_parse_unknown_list(self):
+        self.assertIsNone(parse_list_line("total 12"))
+
+    def test_watcher_holds_back_changing_files(self):
+        watcher = ListingWatcher()
+        a = Entry("a.xls", 10, "20200101120000", "file")
+        b = Entry("b.xls", 10, "20200101120000", "file")
+        sub = Entry("sub", None, "20200101120000", "dir")
+        self.assertEqual(([], 2), watcher.update([a, b, sub]))
+        b2 = b._replace(size=20, modify="20200101120001")
+        self.assertEqual(([a], 1), watcher.update([a, b2, sub]))
+        self.assertEqual(([a, b2], 0), watcher.update([a, b2]))
+
 
 class ServerTests(NeedsTemporaryDirectory, unittest.TestCase):
 
@@ -142,12 +189,208 @@ class ServerTests(NeedsTemporaryDirectory, unittest.TestCase):
         time.sleep(5)
         worker = FTPWorker(**self.params)
         with worker as active:
-            items = set(i.file for i in active.get(active.filenames))
+            items = set(i.file.getvalue() for i in active.get(active.filenames))
             self.assertEqual(len(self.files), len(items))
             self.assertEqual(set(self.files.values()), items)
 
         server.terminate()
 
+    def test_local_server_get_concurrent(self):
+        server = multiprocessing.Process(
+            target=serve,
+            args=(self.root,),
+            kwargs=self.params
+        )
+        server.start()
+        time.sleep(5)
+        worker = FTPWorker(**self.params)
+        with worker as active:
+            filenames = active.filenames
+            items = set(i.file.getvalue() for i in active.get(filenames, connections=4))
+            self.assertEqual(set(self.files.values()), items)
+            self.assertFalse(filenames)
+
+            # A single file is fetched without extra sessions
+            unused_fd, path = next(iter(self.files))
+            with unittest.mock.patch.object(FTPWorker, "clone") as clone:
+                items = [i.file.getvalue() for i in active.get([os.path.basename(path)], connections=4)]
+            self.assertEqual(1, len(items))
+            clone.assert_not_called()
+
+        server.terminate()
+
+    def test_local_server_listing(self):
+        server = multiprocessing.Process(
+            target=serve,
+            args=(self.root,),
+            kwargs=self.params
+        )
+        server.start()
+        time.sleep(5)
+        os.mkdir(os.path.join(self.root, "sub"))
+        worker = FTPWorker(**self.params)
+        with worker as active:
+            entries = {e.name: e for e in active.listing()}
+            with unittest.mock.patch("ftpclient.FTP.mlsd", side_effect=ftplib.error_perm("500 Unknown command")):
+                fallback = {e.name: e for e in active.listing()}
+
+        server.terminate()
+        for listing in (entries, fallback):
+            with self.subTest(listing=listing):
+                self.assertEqual("dir", listing.pop("sub").type)
+                self.assertEqual(
+                    {(os.path.basename(p), len(c), "file") for (fd, p), c in self.files.items()},
+                    {(e.name, e.size, e.type) for e in listing.values()}
+                )
+
+    def test_session_pool(self):
+        server = multiprocessing.Process(
+            target=serve,
+            args=(self.root,),
+            kwargs=self.params
+        )
+        server.start()
+        self.addCleanup(server.terminate)
+        time.sleep(5)
+        pool = SessionPool(size=1, keepalive=0, **self.params)
+        self.assertIsNone(pool.healthy)
+        with pool.session() as first:
+            self.assertTrue(first.connected)
+        with pool.session() as second:
+            self.assertIs(first, second)
+
+            # The server drops the session, which reconnects on the next command
+            second.ftp.sock.shutdown(socket.SHUT_RDWR)
+            self.assertEqual(12, len(second.filenames))
+            self.assertTrue(second.connected)
+
+        pool.keepalive()
+        self.assertTrue(pool.healthy)
+        self.assertTrue(pool.check())
+        with pool.session() as first, pool.session() as extra:
+            self.assertIsNot(first, extra)
+        # Sessions beyond the size of the pool are closed
+        self.assertEqual([extra], [worker for worker, _ in pool._idle])
+        self.assertFalse(first.connected)
+        pool.close()
+        self.assertEqual([], pool._idle)
+
+    def test_pools_share_host_limit(self):
+        # A port of its own, for a host limit of its own
+        params = dict(self.params, port=2125, host_connections=2, timeout=5)
+        server = multiprocessing.Process(target=serve, args=(self.root,), kwargs=dict(self.params, port=2125))
+        server.start()
+        self.addCleanup(server.terminate)
+        time.sleep(5)
+        north, south, east = [SessionPool(size=2, **dict(params, working_directory=".")) for _ in range(3)]
+        with north.session() as first, north.session() as second:
+            pass
+        self.assertEqual(2, len(north._idle))
+
+        # The idle sessions of one source make way for another on the same host, without waiting
+        started = time.monotonic()
+        with south.session() as active:
+            self.assertTrue(active.connected)
+        self.assertLess(time.monotonic() - started, 2)
+        # The longest idle session was closed
+        self.assertEqual([first], [worker for worker, _ in north._idle])
+        self.assertFalse(second.connected)
+
+        with east.session() as active:
+            self.assertTrue(active.connected)
+        self.assertEqual([], north._idle)
+        # The sessions kept idle across the host's pools are within its limit
+        self.assertEqual(2, len(south._idle) + len(east._idle))
+        for pool in (north, south, east):
+            pool.close()
+
+    def test_claims(self):
+        server = multiprocessing.Process(
+            target=serve,
+            args=(self.root,),
+            kwargs=self.params
+        )
+        server.start()
+        self.addCleanup(server.terminate)
+        time.sleep(5)
+        claims = dict(self.params, claim_directory=".claims")
+        with FTPWorker(replica="a", **claims) as a, FTPWorker(replica="b", **claims) as b:
+            filenames = a.filenames
+            self.assertEqual(12, len(filenames))
+            self.assertTrue(a.renew_lease())
+            self.assertTrue(b.renew_lease())
+
+            # Each file is claimed by one replica only
+            self.assertTrue(all(a.claim(filename) for filename in filenames[:4]))
+            self.assertFalse(b.claim(filenames[0]))
+            self.assertEqual(sorted(filenames[:4]), sorted(a.claimed()))
+            self.assertEqual(8, len(b.filenames))
+            self.assertEqual(1, len(list(a.get(filenames[:1]))))
+            self.assertTrue(a.delete(filenames[0]))
+
+            # Files held by a replica whose lease has expired are returned
+            self.assertEqual(0, b.reclaim(lease=60))
+            self.assertEqual(3, b.reclaim(lease=0))
+            self.assertEqual(11, len(b.filenames))
+            self.assertEqual([], a.claimed())
+            self.assertFalse(os.path.exists(os.path.join(self.root, ".claims", "a.lease")))
+
+    def test_resume_download(self):
+        server = multiprocessing.Process(
+            target=serve,
+            args=(self.root,),
+            kwargs=self.params
+        )
+        server.start()
+        self.addCleanup(server.terminate)
+        time.sleep(5)
+        content = {os.path.basename(p): c for (fd, p), c in self.files.items()}
+        filename = sorted(content)[0]
+        retrbinary = ftplib.FTP.retrbinary
+        offsets = []
+
+        def flaky(ftp, cmd, callback, blocksize=8192, rest=None, failures=1, refuse_rest=False, cut_at=1000):
+            offsets.append(rest)
+            if rest and refuse_rest:
+                raise ftplib.error_perm("502 Command not implemented")
+            if len(offsets) > failures:
+                return retrbinary(ftp, cmd, callback, blocksize, rest)
+
+            def cut(data):
+                callback(data[:cut_at])
+                raise ConnectionResetError("Connection reset by peer")
+            return retrbinary(ftp, cmd, cut, blocksize, rest)
+
+        with FTPWorker(**self.params) as worker:
+            # The transfer carries on from where it was cut off
+            with unittest.mock.patch("ftpclient.FTP.retrbinary", autospec=True, side_effect=flaky):
+                job = worker.retrieve(filename)
+            self.assertEqual([None, 1000], offsets)
+            self.assertEqual(content[filename], job.file.getvalue())
+            self.assertTrue(job.file.on_disk)
+
+            # Without REST the file is downloaded again
+            del offsets[:]
+            with unittest.mock.patch(
+                "ftpclient.FTP.retrbinary", autospec=True,
+                side_effect=lambda *args, **kwargs: flaky(*args, refuse_rest=True, **kwargs)
+            ):
+                job = worker.retrieve(filename, size=len(content[filename]))
+            self.assertEqual([None, 1000, None], offsets)
+            self.assertEqual(content[filename], job.file.getvalue())
+            self.assertFalse(worker.resumable)
+
+            # Downloads are checked against the expected size
+            self.assertIsNone(worker.retrieve(filename, size=1))
+            worker.resumable = True
+            del offsets[:]
+            with unittest.mock.patch(
+                "ftpclient.FTP.retrbinary", autospec=True,
+                side_effect=lambda *args, **kwargs: flaky(*args, failures=5, cut_at=10, **kwargs)
+            ):
+                self.assertIsNone(worker.retrieve(filename))
+            self.assertEqual([None, 10, 20, 30], offsets)
+
     def test_path_names(self):
         paths = [
             '\\\\EDC_Templates',
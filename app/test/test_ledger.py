@@ -0,0 +1,156 @@
+import os.path
+import sqlite3
+import unittest
+
+from app.ledger import Ledger
+from app.test.test_ftp import NeedsTemporaryDirectory
+
+
+class LedgerTests(NeedsTemporaryDirectory, unittest.TestCase):
+
+    def test_publish_confirm_delete(self):
+        ledger = Ledger(":memory:")
+        ledger.publish("a.xls", 1, size=10, digest="aa")
+        ledger.publish("b.xls", 2, size=20, digest="bb")
+        self.assertIn("a.xls", ledger)
+        self.assertEqual(["a.xls", "b.xls"], list(ledger))
+        self.assertEqual([("a.xls", 1), ("b.xls", 2)], ledger.items())
+
+        ledger.confirm("a.xls")
+        self.assertEqual(Ledger.CONFIRMED, ledger.state("a.xls"))
+        self.assertEqual(["a.xls"], ledger.pending_deletes())
+
+        ledger.delete("a.xls")
+        self.assertNotIn("a.xls", ledger)
+        self.assertEqual(Ledger.DELETED, ledger.get("a.xls").state)
+        self.assertEqual((20, "bb"), ledger.get("b.xls")[1:3])
+        self.assertIsNone(ledger.get("c.xls"))
+        self.assertEqual(1, len(ledger))
+        self.assertEqual([], ledger.pending_deletes())
+
+        # A late confirmation does not bring back a deleted file
+        ledger.confirm("a.xls")
+        self.assertEqual(Ledger.DELETED, ledger.state("a.xls"))
+
+    def test_confirm_latest_message(self):
+        ledger = Ledger(":memory:")
+        ledger.publish("a.xls", "1.1", digest="aa")
+        ledger.publish("a.xls", "1.2", digest="ab")
+        # The messages of an earlier version of the file neither confirm nor discard it
+        self.assertFalse(ledger.confirm("a.xls", "1.1"))
+        ledger.discard("a.xls", "1.1")
+        self.assertEqual(("1.2", Ledger.PUBLISHED), (ledger.get("a.xls").msg_id, ledger.state("a.xls")))
+        self.assertEqual("a.xls", ledger.original("ab"))
+        self.assertTrue(ledger.confirm("a.xls", "1.2"))
+        self.assertEqual(Ledger.CONFIRMED, ledger.state("a.xls"))
+
+    def test_recover_after_restart(self):
+        path = os.path.join(self.root, "ledger.db")
+        ledger = Ledger(path)
+        ledger.publish("a.xls", 1, digest="aa")
+        ledger.publish("b.xls", 2, digest="bb")
+        ledger.confirm("b.xls")
+        ledger.close()
+
+        ledger = Ledger(path)
+        self.assertEqual(["b.xls"], ledger.recover())
+        # The unconfirmed file is published again
+        self.assertNotIn("a.xls", ledger)
+        self.assertIsNone(ledger.original("aa"))
+        self.assertEqual("b.xls", ledger.original("bb"))
+        self.assertEqual([("b.xls", None)], ledger.items())
+
+    def test_compact(self):
+        ledger = Ledger(":memory:", retention=60)
+        ledger.publish("a.xls", 1)
+        ledger.publish("b.xls", 2)
+        ledger.delete("a.xls")
+        ledger.delete("b.xls")
+        self.assertEqual(0, ledger.compact())
+        self.assertEqual(Ledger.DELETED, ledger.state("a.xls"))
+        self.assertEqual(2, ledger.compact(now=ledger._execute("SELECT MAX(updated) FROM files")[0][0] + 61))
+        self.assertIsNone(ledger.state("a.xls"))
+
+    def test_page(self):
+        ledger = Ledger(":memory:")
+        for n in range(5):
+            ledger.publish("{0}.xls".format(n), "1.{0}".format(n))
+            ledger._execute("UPDATE files SET published = ? WHERE filename = ?", 100 + n, "{0}.xls".format(n))
+        ledger.confirm("1.xls")
+        ledger.confirm("2.xls")
+        ledger.delete_failed("2.xls")
+        ledger.delete("3.xls")
+
+        first = ledger.page(limit=2)
+        self.assertEqual(["0.xls", "1.xls"], [r.filename for r in first])
+        rest = ledger.page(cursor=Ledger.cursor(first[-1]))
+        self.assertEqual(["2.xls", "3.xls", "4.xls"], [r.filename for r in rest])
+        self.assertEqual(1, rest[0].failures)
+
+        self.assertEqual(["2.xls"], [r.filename for r in ledger.page(states=[Ledger.DELETE_FAILED])])
+        self.assertEqual(
+            ["1.xls", "2.xls", "3.xls"],
+            [r.filename for r in ledger.page(states=[Ledger.CONFIRMED, Ledger.DELETED])]
+        )
+        self.assertEqual(
+            ["1.xls", "2.xls"], [r.filename for r in ledger.page(published_after=100, published_before=103)]
+        )
+        self.assertRaises(ValueError, ledger.page, cursor="not a cursor")
+
+    def test_upgrade_schema(self):
+        path = os.path.join(self.root, "ledger.db")
+        db = sqlite3.connect(path)
+        db.execute(
+            "CREATE TABLE files (filename TEXT PRIMARY KEY, size INTEGER, digest TEXT, msg_id, "
+            "published REAL, updated REAL, state TEXT NOT NULL)"
+        )
+        db.execute("INSERT INTO files VALUES ('a.xls', 1, 'aa', NULL, 1, 1, 'confirmed')")
+        db.execute("CREATE TABLE digests (digest TEXT PRIMARY KEY, filename TEXT NOT NULL, seen REAL NOT NULL)")
+        db.execute("INSERT INTO digests VALUES ('aa', 'a.xls', 1)")
+        db.commit()
+        db.close()
+
+        ledger = Ledger(path)
+        self.assertEqual(0, ledger.get("a.xls").failures)
+        ledger.delete_failed("a.xls")
+        self.assertEqual(1, ledger.get("a.xls").failures)
+        self.assertIsNone(ledger.get("a.xls").modify)
+        ledger.publish("b.xls", 2, size=2, modify="20240101120000")
+        self.assertEqual("20240101120000", ledger.get("b.xls").modify)
+        self.assertIsNone(ledger.original("aa", now=1))
+
+    def test_dedupe_index(self):
+        ledger = Ledger(":memory:", dedupe_ttl=60)
+        ledger.publish("a.xls", 1, digest="aa")
+        now = ledger._execute("SELECT seen FROM digests WHERE digest = 'aa'")[0][0]
+        self.assertEqual("a.xls", ledger.original("aa", now=now + 30))
+        self.assertIsNone(ledger.original("bb"))
+        # Digests are only matched within a source
+        self.assertIsNone(ledger.original("aa", source="south", now=now + 30))
+        ledger.publish("south/c.xls", 3, digest="aa", source="south")
+        self.assertEqual("south/c.xls", ledger.original("aa", source="south", now=now + 30))
+        self.assertEqual("a.xls", ledger.original("aa", now=now + 30))
+        # Finding a digest renews it
+        self.assertEqual("a.xls", ledger.original("aa", now=now + 80))
+        self.assertIsNone(ledger.original("aa", now=now + 150))
+
+        ledger.duplicate("b.xls", size=10, digest="aa")
+        self.assertEqual(Ledger.DUPLICATE, ledger.state("b.xls"))
+        self.assertNotIn("b.xls", ledger)
+
+        ledger.discard("a.xls")
+        self.assertIsNone(ledger.original("aa", now=now + 30))
+        self.assertIsNone(Ledger(":memory:", dedupe_ttl=0).original("aa"))
+
+    def test_dedupe_eviction(self):
+        ledger = Ledger(":memory:", dedupe_ttl=60, dedupe_max=2)
+        for n, digest in enumerate(["aa", "bb", "cc"]):
+            ledger.publish("{0}.xls".format(digest), n, digest=digest)
+            ledger._execute("UPDATE digests SET seen = ? WHERE digest = ?", 100 + n, digest)
+        ledger.original("aa", now=110)
+
+        # The least recently seen digest is evicted beyond the limit, then those past the TTL
+        ledger.compact(now=150)
+        self.assertEqual([("aa",), ("cc",)], ledger._execute("SELECT digest FROM digests ORDER BY digest"))
+        ledger.compact(now=165)
+        self.assertEqual([("aa",)], ledger._execute("SELECT digest FROM digests"))
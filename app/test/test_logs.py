@@ -0,0 +1,83 @@
+import logging
+import unittest
+import unittest.mock
+
+from app.logs import BackgroundHandler, Summary
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class BackgroundHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.target = ListHandler()
+        self.log = logging.getLogger("test.logs")
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.addCleanup(setattr, self.log, "propagate", True)
+
+    def test_records_are_written_in_background(self):
+        handler = BackgroundHandler([self.target])
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+        handler.start()
+        args = [1]
+        self.log.info("Published %s", args)
+        args.append(2)
+        handler.stop()
+        self.assertEqual(["Published [1]"], [r.getMessage() for r in self.target.records])
+
+    def test_drops_records_when_queue_is_full(self):
+        handler = BackgroundHandler([self.target], size=2)
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+        for n in range(5):
+            self.log.info("Message %i", n)
+        self.assertEqual(3, handler.dropped)
+        handler.start()
+        handler.stop()
+        self.assertEqual(["Message 0", "Message 1"], [r.getMessage() for r in self.target.records])
+
+    def test_paused_while_forking(self):
+        handler = BackgroundHandler([self.target])
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+        handler.start()
+        with handler.paused():
+            self.assertFalse(handler.running)
+            self.log.info("While paused")
+        self.assertTrue(handler.running)
+        handler.stop()
+        self.assertEqual(["While paused"], [r.getMessage() for r in self.target.records])
+
+    def test_forked_process_writes_itself(self):
+        handler = BackgroundHandler([self.target])
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+        with unittest.mock.patch("os.getpid", return_value=handler.pid + 1):
+            self.log.info("From a worker")
+        self.assertEqual(["From a worker"], [r.getMessage() for r in self.target.records])
+        self.assertTrue(handler.queue.empty())
+
+
+class SummaryTests(unittest.TestCase):
+
+    def test_logs_every_n_events_or_interval(self):
+        log = unittest.mock.Mock()
+        now = [0]
+        summary = Summary(log, every=3, interval=10, clock=lambda: now[0])
+        logged = [summary("Acked %i", n) for n in range(7)]
+        self.assertEqual([True, False, False, True, False, False, True], logged)
+        self.assertEqual([unittest.mock.call("Acked %i", n) for n in (0, 3, 6)], log.info.call_args_list)
+
+        now[0] = 11
+        self.assertTrue(summary("Acked %i", 7))
+        self.assertFalse(summary("Acked %i", 8))
@@ -0,0 +1,38 @@
+import unittest
+
+from app.metrics import Registry
+
+
+class RegistryTests(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter("files_total", "Files", labels=("event",))
+        registry.gauge("inflight", "In flight", func=lambda: 3)
+        histogram = registry.histogram("seconds", "Seconds", labels=("stage",), buckets=(0.1, 1))
+        counter.inc("published")
+        counter.inc("published", amount=2)
+        histogram.observe(0.05, "list")
+        histogram.observe(0.5, "list")
+        histogram.observe(5, "list")
+
+        self.assertEqual([
+            "# HELP files_total Files",
+            "# TYPE files_total counter",
+            'files_total{event="published"} 3',
+            "# HELP inflight In flight",
+            "# TYPE inflight gauge",
+            "inflight 3",
+            "# HELP seconds Seconds",
+            "# TYPE seconds histogram",
+            'seconds_bucket{stage="list",le="0.1"} 1',
+            'seconds_bucket{stage="list",le="1.0"} 2',
+            'seconds_bucket{stage="list",le="+Inf"} 3',
+            'seconds_sum{stage="list"} 5.55',
+            'seconds_count{stage="list"} 3',
+        ], registry.render().splitlines())
+
+    def test_label_values_are_escaped(self):
+        registry = Registry()
+        registry.counter("c", "C", labels=("name",)).inc('a"b')
+        self.assertIn('c{name="a\\"b"} 1', registry.render())
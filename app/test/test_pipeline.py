@@ -0,0 +1,109 @@
+import threading
+import time
+import unittest
+
+import tornado.ioloop
+
+from app.pipeline import Pipeline, Stage, run_on_loop
+
+
+class Context:
+
+    def __init__(self, ok=True):
+        self.ok = ok
+
+    def __enter__(self):
+        return self if self.ok else None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_items_pass_through_stages(self):
+        seen = []
+        pipeline = Pipeline(
+            Stage("split", lambda ctx, item: iter(item)),
+            Stage("double", lambda ctx, item: [item * 2], workers=3),
+            Stage("collect", lambda ctx, item: seen.append(item)),
+            maxsize=1
+        )
+        pipeline.run(["abc", "de"])
+        self.assertEqual(sorted(seen), ["aa", "bb", "cc", "dd", "ee"])
+
+    def test_seeds_join_stage_input(self):
+        seen = []
+        pipeline = Pipeline(
+            Stage("first", lambda ctx, item: [item]),
+            Stage("last", lambda ctx, item: seen.append(item)),
+        )
+        pipeline.run([1, 2], seeds={"last": [0]})
+        self.assertEqual(sorted(seen), [0, 1, 2])
+
+    def test_stage_errors_are_contained(self):
+        seen = []
+
+        def fail_on_odd(ctx, item):
+            if item % 2:
+                raise ValueError(item)
+            return [item]
+
+        pipeline = Pipeline(
+            Stage("filter", fail_on_odd),
+            Stage("collect", lambda ctx, item: seen.append(item)),
+        )
+        pipeline.run(range(6))
+        self.assertEqual(seen, [0, 2, 4])
+
+    def test_failed_context_discards_input(self):
+        seen = []
+        pipeline = Pipeline(
+            Stage("broken", lambda ctx, item: [item], context=lambda: Context(ok=False)),
+            Stage("collect", lambda ctx, item: seen.append(item)),
+        )
+        pipeline.run(range(10))
+        self.assertEqual(seen, [])
+
+    def test_flush_runs_once_after_input(self):
+        seen = []
+        pipeline = Pipeline(
+            Stage("count", lambda ctx, item: (), workers=2, context=Context, flush=lambda ctx: ["flushed"]),
+            Stage("collect", lambda ctx, item: seen.append(item)),
+        )
+        pipeline.run(range(10))
+        self.assertEqual(seen, ["flushed"])
+
+    def test_timer_records_each_item(self):
+        timings = []
+        pipeline = Pipeline(
+            Stage("sleep", lambda ctx, item: time.sleep(item)),
+            timer=lambda seconds, name: timings.append((name, seconds))
+        )
+        pipeline.run([0, 0.05])
+        self.assertEqual(["sleep", "sleep"], [name for name, _ in timings])
+        self.assertGreaterEqual(timings[1][1], 0.05)
+
+
+class RunOnLoopTests(unittest.TestCase):
+
+    def test_call_runs_on_loop_thread(self):
+        loop = tornado.ioloop.IOLoop()
+        result = {}
+
+        def worker():
+            result["thread"] = run_on_loop(loop, threading.get_ident)
+
+            async def coro():
+                return "done"
+
+            result["coro"] = run_on_loop(loop, coro)
+            loop.add_callback(loop.stop)
+
+        thread = threading.Thread(target=worker)
+        loop.add_callback(thread.start)
+        loop.start()
+        thread.join()
+        loop.close()
+        self.assertEqual(result["coro"], "done")
+        self.assertEqual(result["thread"], threading.get_ident())
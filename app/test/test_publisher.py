@@ -0,0 +1,348 @@
+from types import SimpleNamespace
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+
+from app.publisher import ConfirmationTracker, Delivery, DurableTopicPublisher, PublisherPool, RetryBuffer
+from app.spool import Spool
+from app.test.broker import Broker, topic_matches
+
+
+def confirmation(name, tag, multiple=False):
+    return SimpleNamespace(method=SimpleNamespace(NAME=name, delivery_tag=tag, multiple=multiple))
+
+
+class ConfirmationTrackerTests(unittest.TestCase):
+
+    def test_multiple_ack_settles_range(self):
+        tracker = ConfirmationTracker()
+        tracker.start()
+        ids = [tracker.publish() for _ in range(500)]
+        self.assertEqual(500, tracker.unconfirmed)
+        self.assertEqual(ids, tracker.confirm(500, True, multiple=True))
+        self.assertEqual(0, tracker.unconfirmed)
+        self.assertTrue(all(tracker.outcome(i) for i in ids))
+        self.assertEqual(500, tracker.acked)
+
+    def test_ack_and_nack_reported_separately(self):
+        tracker = ConfirmationTracker()
+        tracker.start()
+        ids = [tracker.publish() for _ in range(5)]
+        tracker.confirm(2, False)
+        tracker.confirm(4, True, multiple=True)
+        self.assertEqual([True, False, True, True, None], [tracker.outcome(i) for i in ids])
+        self.assertEqual((3, 1), (tracker.acked, tracker.nacked))
+        self.assertEqual(1, tracker.unconfirmed)
+
+        # Tags already settled are not counted again
+        self.assertEqual([ids[4]], tracker.confirm(5, True, multiple=True))
+        self.assertEqual(4, tracker.acked)
+
+    def test_epochs_do_not_collide(self):
+        tracker = ConfirmationTracker()
+        tracker.start()
+        first = tracker.publish()
+        tracker.start()
+        second = tracker.publish()
+        self.assertEqual(first.tag, second.tag)
+        self.assertNotEqual(first, second)
+        tracker.confirm(1, True)
+        self.assertIsNone(tracker.outcome(first))
+        self.assertTrue(tracker.outcome(second))
+
+    def test_forget(self):
+        tracker = ConfirmationTracker()
+        tracker.start()
+        ids = [tracker.publish() for _ in range(3)]
+        tracker.confirm(3, True)
+        tracker.forget(ids[2])
+        self.assertEqual(0, len(tracker))
+        tracker.confirm(3, True, multiple=True)
+        self.assertEqual(2, len(tracker))
+        self.assertIsNone(tracker.outcome(ids[2]))
+
+    def test_delivery_text(self):
+        self.assertEqual(Delivery(3, 14), Delivery.parse(str(Delivery(3, 14))))
+
+    def test_topic_matches(self):
+        self.assertTrue(topic_matches("JWT", "JWT"))
+        self.assertTrue(topic_matches("seft.#", "seft.a.b"))
+        self.assertTrue(topic_matches("seft.*.b", "seft.a.b"))
+        self.assertFalse(topic_matches("seft.*", "seft.a.b"))
+
+
+class PublisherConfirmationTests(unittest.TestCase):
+
+    def test_on_delivery_confirmation(self):
+        publisher = DurableTopicPublisher("amqp://localhost", "test")
+        publisher.tracker.start()
+        ids = [publisher.tracker.publish() for _ in range(4)]
+        publisher.on_delivery_confirmation(confirmation("Basic.Nack", 1))
+        publisher.on_delivery_confirmation(confirmation("Basic.Ack", 4, multiple=True))
+        self.assertEqual([False, True, True, True], [publisher.tracker.outcome(i) for i in ids])
+
+
+class Channel:
+
+    def __init__(self):
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties, **kwargs):
+        self.published.append(body)
+
+    def confirm_delivery(self, callback):
+        pass
+
+
+class PublisherWindowTests(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = DurableTopicPublisher("amqp://localhost", "test", window=2, window_bytes=10, retries=1)
+        self.publisher._channel = Channel()
+        self.publisher.tracker.start()
+
+    def test_publish_waits_for_window(self):
+        publisher = self.publisher
+
+        async def run():
+            first = await publisher.publish(b"1")
+            second = await publisher.publish(b"2")
+            third = tornado.gen.convert_yielded(publisher.publish(b"3"))
+            await tornado.gen.sleep(0.01)
+            self.assertEqual([b"1", b"2"], publisher._channel.published)
+            self.assertEqual(2, publisher.inflight)
+
+            publisher.on_delivery_confirmation(confirmation("Basic.Nack", 1))
+            self.assertFalse(await first[1])
+            await tornado.gen.sleep(0.01)
+            self.assertEqual([b"1", b"2", b"3"], publisher._channel.published)
+
+            publisher.on_delivery_confirmation(confirmation("Basic.Ack", 3, multiple=True))
+            self.assertTrue(await second[1])
+            self.assertEqual(0, publisher.inflight)
+            self.assertEqual(0, publisher.inflight_bytes)
+            self.assertTrue(await (await third)[1])
+
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+    def test_window_limits_bytes(self):
+        publisher = self.publisher
+        self.assertFalse(publisher.window_full(100))
+
+        async def run():
+            await publisher.publish(b"x" * 8)
+            self.assertTrue(publisher.window_full(3))
+            self.assertFalse(publisher.window_full(2))
+
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+    def test_closed_channel_keeps_inflight(self):
+        publisher = self.publisher
+
+        async def run():
+            msg_id, settled = await publisher.publish(b"1")
+            publisher._connection = SimpleNamespace(close=lambda: None)
+            publisher.on_channel_closed(None, 320, "Forced")
+            self.assertFalse(settled.done())
+            self.assertEqual(1, publisher.inflight)
+
+            # The message is published again on the next channel, under its first msg_id
+            publisher._channel = Channel()
+            publisher.start_publishing()
+            self.assertEqual([b"1"], publisher._channel.published)
+            publisher.on_delivery_confirmation(confirmation("Basic.Ack", 1))
+            self.assertTrue(await settled)
+            self.assertTrue(publisher.tracker.outcome(msg_id))
+            self.assertEqual((0, 0), (publisher.inflight, len(publisher.buffer)))
+
+        tornado.ioloop.IOLoop.current().run_sync(run)
+
+    def test_retry_buffer_keeps_spools(self):
+        buffer = RetryBuffer(memory=10)
+        first, second = Spool(), Spool()
+        first.write(b"x" * 8)
+        second.write(b"y" * 8)
+        buffer.add("a", first.getvalue(), spool=first)
+        self.assertTrue(buffer.full(second.size))
+        # Spools are moved to disk by the caller, not by the buffer
+        second.rollover()
+        buffer.add("b", second.getvalue(), spool=second)
+        self.assertEqual(8, buffer.in_memory)
+        self.assertEqual(b"y" * 8, buffer.get("b"))
+        buffer.pop("a")
+        buffer.pop("b")
+        self.assertEqual((0, 0), (buffer.in_memory, len(buffer)))
+        self.assertRaises(ValueError, first.getvalue)
+
+
+class PublisherBrokerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = tornado.ioloop.IOLoop.current()
+
+    def publisher(self, broker, **kwargs):
+        publisher = DurableTopicPublisher(
+            "amqp://localhost", "test", connection_factory=broker.connect, **kwargs
+        )
+        publisher._connection = publisher.connect()
+        return publisher
+
+    async def until(self, condition):
+        while not condition():
+            await tornado.gen.sleep(0.005)
+
+    def test_declares_topology_and_routes_messages(self):
+        broker = Broker()
+        publisher = self.publisher(broker)
+
+        async def run():
+            await self.until(lambda: publisher.publishing)
+            msg_id, confirmation = await publisher.publish(b"payload", headers={"tx_id": "1"})
+            self.assertTrue(await confirmation)
+            self.assertTrue(publisher.tracker.outcome(msg_id))
+
+        self.loop.run_sync(run, timeout=5)
+        self.assertEqual({"message": "topic"}, broker.exchanges)
+        self.assertEqual([("test", "message", "JWT")], broker.bindings)
+        self.assertEqual([b"payload"], [m.body for m in broker.queues["test"]])
+        self.assertEqual({"tx_id": "1"}, broker.queues["test"][0].properties.headers)
+
+    def test_routes_messages_by_source(self):
+        broker = Broker()
+        publisher = self.publisher(broker, bindings=[("survey", "survey.files"), ("test", "JWT")])
+
+        async def run():
+            await self.until(lambda: publisher.publishing)
+            await (await publisher.publish(b"default"))[1]
+            await (await publisher.publish(b"survey", routing_key="survey.files"))[1]
+
+        self.loop.run_sync(run, timeout=5)
+        self.assertEqual([("test", "message", "JWT"), ("survey", "message", "survey.files")], broker.bindings)
+        self.assertEqual([b"default"], [m.body for m in broker.queues["test"]])
+        self.assertEqual([b"survey"], [m.body for m in broker.queues["survey"]])
+
+    def test_confirms_under_load(self):
+        rejected = {b"13", b"14", b"77"}
+        broker = Broker(ack_latency=0.01, nack=lambda message: message.body in rejected, multiple=True)
+        publisher = self.publisher(broker, window=32)
+
+        async def run():
+            await self.until(lambda: publisher.publishing)
+            results = [await publisher.publish(str(n).encode("ascii")) for n in range(200)]
+            outcomes = [await confirmation for _, confirmation in results]
+            self.assertEqual(
+                [str(n).encode("ascii") not in rejected for n in range(200)], outcomes
+            )
+
+        self.loop.run_sync(run, timeout=10)
+        # Each rejected message is tried three times
+        self.assertEqual((197, 9), (publisher.tracker.acked, publisher.tracker.nacked))
+        self.assertEqual(197, len(broker.messages))
+
+    def test_blocked_connection_pauses_publishing(self):
+        broker = Broker()
+        publisher = self.publisher(broker)
+
+        async def run():
+            await self.until(lambda: publisher.publishing)
+            broker.block()
+            self.assertTrue(publisher.blocked)
+            pending = tornado.gen.convert_yielded(publisher.publish(b"1"))
+            await tornado.gen.sleep(0.02)
+            self.assertFalse(pending.done())
+            broker.unblock()
+            msg_id, confirmation = await pending
+            self.assertTrue(await confirmation)
+
+        self.loop.run_sync(run, timeout=5)
+        self.assertEqual(0, broker.published_while_blocked)
+
+    def test_reconnects_and_replays_after_connection_drop(self):
+        broker = Broker(ack_latency=0.05)
+        publisher = self.publisher(broker)
+        publisher.RECONNECT_DELAY = 0.01
+
+        async def run():
+            await self.until(lambda: publisher.publishing)
+            self.assertTrue(publisher.connected)
+            first, confirmation = await publisher.publish(b"1")
+            broker.refusing = True
+            broker.drop()
+            await tornado.gen.sleep(0.05)
+            self.assertFalse(publisher.connected)
+            self.assertGreater(publisher._reconnects, 1)
+            broker.refusing = False
+
+            # The unconfirmed message is published again once the connection is back
+            self.assertTrue(await confirmation)
+            self.assertTrue(publisher.tracker.outcome(first))
+            self.assertEqual(0, publisher._reconnects)
+            second, confirmation = await publisher.publish(b"2")
+            self.assertTrue(await confirmation)
+            self.assertNotEqual(first.epoch, second.epoch)
+
+        self.loop.run_sync(run, timeout=5)
+        self.assertEqual([b"1", b"2"], [m.body for m in broker.messages])
+
+    def test_nacked_messages_are_retried(self):
+        nacks = {b"1": 1, b"2": 5}
+        broker = Broker(nack=lambda message: nacks[message.body] > 0 and nacks.update(
+            {message.body: nacks[message.body] - 1}
+        ) is None)
+        publisher = self.publisher(broker, retries=3)
+
+        async def run():
+            await self.until(lambda: publisher.publishing)
+            results = [await publisher.publish(body) for body in (b"1", b"2")]
+            self.assertEqual([True, False], [await confirmation for _, confirmation in results])
+            self.assertEqual([True, False], [publisher.tracker.outcome(msg_id) for msg_id, _ in results])
+
+        self.loop.run_sync(run, timeout=5)
+        self.assertEqual([b"1"], [m.body for m in broker.messages])
+        self.assertEqual(2, nacks[b"2"])
+
+
+class PublisherPoolTests(unittest.TestCase):
+
+    def test_spreads_messages_over_channels(self):
+        broker = Broker(ack_latency=0.01)
+        hosts = []
+
+        def connect(parameters, *args, **kwargs):
+            hosts.append(parameters.host)
+            return broker.connect(parameters, *args, **kwargs)
+
+        pool = PublisherPool(
+            ["amqp://node1", "amqp://node2"], "test", channels=3, window=4, connection_factory=connect
+        )
+        pool.connect()
+
+        async def run():
+            while not all(publisher.publishing for publisher in pool.publishers):
+                await tornado.gen.sleep(0.005)
+            self.assertTrue(pool.connected)
+            results = [await pool.publish(str(n).encode("ascii")) for n in range(30)]
+            self.assertTrue(all([await confirmation for _, confirmation in results]))
+            msg_ids = [msg_id for msg_id, _ in results]
+            self.assertEqual(30, len(set(msg_ids)))
+            self.assertTrue(all(pool.tracker.outcome(msg_id) for msg_id in msg_ids))
+            pool.tracker.forget(*msg_ids)
+            self.assertEqual(0, len(pool.tracker))
+
+        tornado.ioloop.IOLoop.current().run_sync(run, timeout=5)
+        self.assertEqual(["node1", "node2", "node1"], hosts)
+        self.assertEqual(1, broker.declarations)
+        self.assertEqual(30, pool.tracker.acked)
+        self.assertTrue(all(publisher.tracker.acked for publisher in pool.publishers))
+        self.assertEqual(30, len(broker.messages))
+
+    def test_declares_again_when_exchange_is_missing(self):
+        pool = PublisherPool("amqp://localhost", "test", channels=2)
+        pool.topology.declared = True
+        publisher = pool.publishers[0]
+        publisher._connection = SimpleNamespace(close=lambda: None)
+        publisher.on_channel_closed(None, 404, "NOT_FOUND - no exchange 'message'")
+        self.assertFalse(pool.topology.declared)
+        self.assertTrue(pool.blocked)
+        self.assertFalse(pool.connected)
@@ -0,0 +1,57 @@
+import time
+import unittest
+
+import tornado.gen
+import tornado.ioloop
+
+from app.scheduler import AdaptiveScheduler
+
+
+class AdaptiveSchedulerTests(unittest.TestCase):
+
+    def test_backoff(self):
+        scheduler = AdaptiveScheduler(None, interval=1, ceiling=5)
+        self.assertEqual([1, 2, 4, 5, 5], [scheduler.backoff(False) for _ in range(5)])
+        self.assertEqual(0, scheduler.backoff(True))
+        self.assertEqual(1, scheduler.backoff(False))
+
+    def test_runs_again_while_busy(self):
+        runs = []
+
+        async def work():
+            runs.append(time.monotonic())
+            if len(runs) == 4:
+                scheduler.stop()
+            return len(runs) < 3
+
+        scheduler = AdaptiveScheduler(work, interval=0.2, ceiling=10)
+
+        async def run():
+            scheduler.running = True
+            await scheduler.run()
+
+        tornado.ioloop.IOLoop.current().run_sync(run, timeout=5)
+        self.assertEqual(4, len(runs))
+        self.assertLess(runs[2] - runs[0], 0.1)
+        self.assertGreaterEqual(runs[3] - runs[2], 0.2)
+
+    def test_trigger_cuts_idle_wait(self):
+        runs = []
+
+        async def work():
+            runs.append(time.monotonic())
+            if len(runs) == 2:
+                scheduler.stop()
+            return False
+
+        scheduler = AdaptiveScheduler(work, interval=30, ceiling=60)
+
+        async def run():
+            scheduler.running = True
+            loop = tornado.ioloop.IOLoop.current()
+            loop.call_later(0.1, scheduler.trigger)
+            await scheduler.run()
+
+        tornado.ioloop.IOLoop.current().run_sync(run, timeout=5)
+        self.assertEqual(2, len(runs))
+        self.assertLess(runs[1] - runs[0], 1)
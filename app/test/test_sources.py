@@ -0,0 +1,53 @@
+import json
+import unittest
+
+from app.sources import Source, load_sources, split_key, weighted_round_robin
+
+FTP_PARAMS = {
+    "user": "ons", "password": "ons", "host": "127.0.0.1", "port": 2021, "working_directory": "/"
+}
+
+
+class SourceTests(unittest.TestCase):
+
+    def test_single_source(self):
+        sources = load_sources(None, FTP_PARAMS)
+        self.assertEqual([""], [source.name for source in sources])
+        self.assertEqual("a.xls", sources[0].key("a.xls"))
+        self.assertIsNone(sources[0].routing_key)
+        self.assertEqual(("", "a.xls"), split_key("a.xls"))
+
+    def test_load_sources(self):
+        sources = load_sources(json.dumps([
+            {"name": "north", "directory": "north", "weight": 3},
+            {"name": "south", "host": "10.0.0.2", "port": "21", "queue": "Seft.South"},
+        ]), FTP_PARAMS, pool_size=1)
+        north, south = sources
+        self.assertEqual(("north", 3, None), (north.name, north.weight, north.routing_key))
+        self.assertEqual("north", north.pool.params["working_directory"])
+        self.assertEqual(("10.0.0.2", 21), (south.pool.params["host"], south.pool.params["port"]))
+        self.assertEqual(("Seft.South", "Seft.South"), (south.queue, south.routing_key))
+        self.assertEqual("south/a.xls", south.key("a.xls"))
+        self.assertEqual(("south", "a.xls"), split_key(south.key("a.xls")))
+
+    def test_names_must_be_unique(self):
+        text = json.dumps([{"name": "a"}, {"name": "a", "directory": "other"}])
+        self.assertRaises(ValueError, load_sources, text, FTP_PARAMS)
+        self.assertRaises(ValueError, load_sources, "[]", FTP_PARAMS)
+        self.assertRaises(ValueError, load_sources, json.dumps([{"directory": "/"}, {"directory": "/b"}]), FTP_PARAMS)
+
+    def test_default_names(self):
+        text = json.dumps([{"directory": "/data/north"}, {"directory": "/data/south/"}, {"directory": "east"}])
+        self.assertEqual(["north", "south", "east"], [source.name for source in load_sources(text, FTP_PARAMS)])
+
+    def test_weighted_round_robin(self):
+        busy = Source("busy", FTP_PARAMS, weight=2)
+        quiet = Source("quiet", FTP_PARAMS)
+        batches = list(weighted_round_robin([
+            (busy, ["b1", "b2", "b3", "b4", "b5"]), (quiet, ["q1", "q2"])
+        ]))
+        self.assertEqual([
+            (busy, ["b1", "b2"]), (quiet, ["q1"]),
+            (busy, ["b3", "b4"]), (quiet, ["q2"]),
+            (busy, ["b5"]),
+        ], batches)
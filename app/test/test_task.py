@@ -1,17 +1,42 @@
+import base64
 import concurrent.futures
+import datetime
+import ftplib
+import functools
+import hashlib
+import json
 import multiprocessing
+import os
+import threading
 import time
 import unittest
+import unittest.mock
 
 import tornado.concurrent
+import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.testing
+import tornado.web
 
-from app.main import Task
+from app.ledger import Ledger
+from app.main import Task, make_app
+from app.publisher import Job, PublisherPool
+from app.spool import Spool
+from app.test.broker import Broker
+from app.test.decrypter import Decrypter
 from app.test.localserver import serve
+from app.test.test_encryption import read_key
 from app.test.test_ftp import NeedsTemporaryDirectory
 from app.test.test_ftp import ServerTests
 
 
+class HealthCheckStub(tornado.web.RequestHandler):
+
+    def get(self):
+        self.write({"status": "ok"})
+
+
 class TaskTests(NeedsTemporaryDirectory, unittest.TestCase):
 
     @staticmethod
@@ -26,14 +51,24 @@ class TaskTests(NeedsTemporaryDirectory, unittest.TestCase):
             kwargs=ServerTests.params
         )
         server.start()
+        self.addCleanup(server.terminate)
         time.sleep(5)
 
-        task = Task(None, {})
+        # Stands in for the RabbitMQ management API
+        sock, port = tornado.testing.bind_unused_port()
+        http_server = tornado.httpserver.HTTPServer(tornado.web.Application([
+            ("/api/healthchecks/node", HealthCheckStub),
+        ]))
+        http_server.add_sockets([sock])
+        self.addCleanup(http_server.stop)
+
+        with unittest.mock.patch.dict("os.environ", {"SEFT_LEDGER_PATH": ":memory:"}):
+            task = Task(None, {})
         self.assertIsNone(task.ftp_check)
         self.assertIsNone(task.rabbit_check)
         task.check_services(
             ftp_params=ServerTests.params,
-            rabbit_url="https://pypi.python.org"
+            rabbit_url="http://127.0.0.1:{0}/api/healthchecks/node".format(port)
         )
         self.assertIsInstance(task.ftp_check, concurrent.futures.Future)
         self.assertIsInstance(task.rabbit_check, tornado.concurrent.Future)
@@ -47,4 +82,359 @@ class TaskTests(NeedsTemporaryDirectory, unittest.TestCase):
 
         self.assertTrue(task.ftp_check.done())
         self.assertTrue(task.ftp_check.result())
-        server.terminate()
+
+    def transfer(self, directories, port=2121, prepare=None, **env):
+        """Runs two transfer cycles against the local FTP server and an in-process broker
+
+        :param directories:  Files to create in each directory under the server root
+        :param prepare:  Optionally called with the Task and the Broker before the transfer
+        :return: The Task, the Broker and the number of FTP logins
+        """
+        for directory, files in directories.items():
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+            for filename, content in files.items():
+                with open(os.path.join(self.root, directory, filename), "wb") as file:
+                    file.write(content)
+        server = multiprocessing.Process(target=serve, args=(self.root,), kwargs=dict(ServerTests.params, port=port))
+        server.start()
+        self.addCleanup(server.terminate)
+        time.sleep(5)
+
+        env = dict({
+            "SEFT_LEDGER_PATH": ":memory:", "SEFT_FTP_USER": "testuser", "SEFT_FTP_PASS": "password",
+            "SEFT_FTP_PORT": str(port), "SEFT_PUBLISHER_FTP_FOLDER": ".", "SEFT_FTP_LISTING": "nlst",
+        }, **env)
+        with unittest.mock.patch.dict("os.environ", env):
+            task = Task(None, {})
+        broker = Broker(ack_latency=0.01)
+        task.publisher = PublisherPool(
+            "amqp://localhost", "test", connection_factory=broker.connect,
+            bindings=[(source.queue, source.routing_key) for source in task.sources if source.queue]
+        )
+        task.publisher.connect()
+        if prepare is not None:
+            prepare(task, broker)
+
+        def remaining():
+            return [name for directory in directories for name in os.listdir(os.path.join(self.root, directory))]
+
+        async def run():
+            while not task.publisher.publishing:
+                await tornado.gen.sleep(0.005)
+            for _ in range(2):
+                await task.transfer_files()
+                # Files are deleted once confirmed, and forgotten by the publisher then
+                while remaining() and (task.publisher.inflight or len(task.publisher.tracker)):
+                    if time.monotonic() > deadline:
+                        break
+                    await tornado.gen.sleep(0.05)
+
+        deadline = time.monotonic() + 20
+        login = unittest.mock.patch.object(ftplib.FTP, "login", autospec=True, side_effect=ftplib.FTP.login)
+        with login as login:
+            tornado.ioloop.IOLoop.current().run_sync(run, timeout=30)
+        self.assertEqual([], remaining())
+        return task, broker, login.call_count
+
+    @staticmethod
+    def contents(messages):
+        decrypter = Decrypter(
+            read_key("sdc-sdx-outbound-signing-public-v1.pem"),
+            read_key("sdc-ras-outbound-encryption-private-v1.pem"),
+            None
+        )
+        published = [decrypter.decrypt(message.body.decode("ascii")) for message in messages]
+        return sorted((data["filename"], base64.standard_b64decode(data["file"])) for data in published)
+
+    def test_transfer_files(self):
+        files = {"{0}.xls".format(n): os.urandom(1000 + n) for n in range(12)}
+        task, broker, logins = self.transfer({".": files})
+
+        # Each file is published once, confirmed and deleted
+        self.assertEqual(sorted(files.items()), self.contents(broker.queues["test"]))
+        self.assertEqual([Ledger.DELETED] * 12, [task.ledger.state(filename) for filename in sorted(files)])
+        self.assertEqual(12, broker.acked)
+        # Sessions are pooled across files and cycles: a lister, the download workers and a deleter at most
+        self.assertLessEqual(logins, task.download_workers + 2)
+
+    def test_transfer_files_in_parts(self):
+        files = {"{0}.xls".format(n): os.urandom(2500 + n) for n in range(4)}
+        digests = {hashlib.sha256(content).hexdigest(): filename for filename, content in files.items()}
+        settled = []
+        failed = []
+
+        def parts(broker, filename):
+            return sorted(
+                message.properties.headers["part"] for message in broker.queues["test"]
+                if digests[message.properties.headers["digest"]] == filename
+            )
+
+        def prepare(task, broker):
+            publish = task.publisher.publish
+            confirm = task.ledger.confirm
+            delete = task.ledger.delete
+
+            async def fail_once(message, headers=None, spool=None, **kwargs):
+                # The second part of one file fails the first time it is published
+                if digests[headers["digest"]] == "1.xls" and headers["part"] == 1 and not failed:
+                    failed.append(headers)
+                    spool.close()
+                    return None, None
+                return await publish(message, headers=headers, spool=spool, **kwargs)
+
+            def confirm_parts(filename, msg_id=None):
+                settled.append(("confirmed", filename, parts(broker, filename)))
+                return confirm(filename, msg_id)
+
+            def delete_parts(filename):
+                settled.append(("deleted", filename, parts(broker, filename)))
+                return delete(filename)
+
+            task.publisher.publish = fail_once
+            task.ledger.confirm = confirm_parts
+            task.ledger.delete = delete_parts
+
+        task, broker, unused_logins = self.transfer({".": files}, prepare=prepare, SEFT_CHUNK_SIZE="1000")
+
+        self.assertEqual([Ledger.DELETED] * 4, [task.ledger.state(filename) for filename in sorted(files)])
+        # Files are only confirmed and deleted once the broker has every part
+        self.assertEqual(8, len(settled))
+        for state, filename, routed in settled:
+            self.assertEqual([0, 1, 2], sorted(set(routed)), (state, filename))
+        # The remaining parts of a file are skipped after a part fails, and the whole file is published again
+        self.assertEqual([0, 0, 1, 2], parts(broker, "1.xls"))
+        self.assertEqual([0, 1, 2], parts(broker, "2.xls"))
+        # The deliveries of the abandoned part are forgotten along with the rest
+        self.assertEqual(0, len(task.publisher.tracker))
+
+    def test_transfer_from_sources_on_one_host(self):
+        directories = {
+            name: {"{0}{1}.xls".format(name, n): os.urandom(1000 + n) for n in range(6)}
+            for name in ("north", "south", "east")
+        }
+        sources = json.dumps([{"directory": name, "queue": "Seft." + name} for name in directories])
+        started = time.monotonic()
+        # Fewer sessions are allowed than the sources and download workers would hold
+        task, broker, unused_logins = self.transfer(
+            directories, port=2126, SEFT_SOURCES=sources, SEFT_FTP_HOST_CONNECTIONS="3"
+        )
+        # Without waiting for sessions to time out
+        self.assertLess(time.monotonic() - started, 15)
+        for name, files in directories.items():
+            self.assertEqual(sorted(files.items()), self.contents(broker.queues["Seft." + name]))
+        self.assertEqual(18, broker.acked)
+
+
+class TransferServiceTests(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        with unittest.mock.patch.dict("os.environ", {"SEFT_LEDGER_PATH": ":memory:"}):
+            self.task = Task(None, {})
+        return make_app(self.task)
+
+    def test_trigger_without_scheduler(self):
+        response = self.fetch("/transfer", method="POST", body="")
+        self.assertEqual(503, response.code)
+
+    def test_trigger(self):
+        self.task.scheduler = unittest.mock.Mock()
+        response = self.fetch("/transfer", method="POST", body="")
+        self.assertEqual(202, response.code)
+        self.assertEqual({"status": "triggered"}, json.loads(response.body.decode("utf-8")))
+        self.task.scheduler.trigger.assert_called_once_with()
+
+    def test_metrics(self):
+        self.task.files_total.inc("published")
+        self.task.stage_seconds.observe(0.2, "encode")
+        response = self.fetch("/metrics")
+        self.assertEqual(200, response.code)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        lines = response.body.decode("utf-8").splitlines()
+        self.assertIn('seft_files_total{event="published"} 1', lines)
+        self.assertIn('seft_stage_seconds_bucket{stage="encode",le="0.25"} 1', lines)
+        self.assertIn("seft_ledger_files 0", lines)
+        self.assertIn("seft_inflight_messages 0", lines)
+
+    def test_healthcheck(self):
+        self.task.health_ttl = 60
+        self.task.check_ftp = unittest.mock.Mock()
+        self.task.check_rabbit = unittest.mock.Mock()
+        response = self.fetch("/healthcheck")
+        self.assertEqual(200, response.code)
+        self.assertEqual(
+            {"status": False, "dependencies": {"rabbitmq": False, "ftp": False}},
+            json.loads(response.body.decode("utf-8"))
+        )
+        # RabbitMQ is not probed while the publisher is disconnected
+        self.task.check_rabbit.assert_not_called()
+        self.task.check_ftp.assert_called_once_with([self.task.sources[0].pool])
+
+        # Live state is reported without probing again
+        self.task.sources[0].pool.record(True)
+        channel = self.task.publisher.publishers[0]
+        channel.publishing = True
+        channel._connection = channel._channel = unittest.mock.Mock(is_open=True)
+        channel.activity = time.monotonic()
+        self.task.check_ftp.reset_mock()
+        self.assertEqual({"rabbitmq": True, "ftp": True}, self.task.health()["dependencies"])
+        self.task.check_ftp.assert_not_called()
+        self.task.check_rabbit.assert_not_called()
+
+        # A failed probe holds until the next one, however active the broker is
+        self.task.rabbit_health, self.task.rabbit_checked = False, time.monotonic() - 61
+        self.assertFalse(self.task.health()["dependencies"]["rabbitmq"])
+        self.task.check_rabbit.assert_called_once_with()
+
+    def test_skips_duplicates(self):
+        task = self.task
+        source = task.sources[0]
+        task.delete_duplicates = True
+        task.submit_delete = unittest.mock.Mock()
+
+        def download(*files):
+            jobs = []
+            for filename, content in files:
+                spool = Spool()
+                spool.write(content)
+                jobs.append(Job(datetime.datetime.utcnow(), filename, spool))
+            session = unittest.mock.MagicMock()
+            session.__enter__.return_value.get.return_value = jobs
+            task.downloaded = {}
+            with unittest.mock.patch.object(source.pool, "session", return_value=session):
+                return [job.filename for job in task.download_files(None, (source, [f for f, _ in files]))]
+
+        digest = Spool()
+        digest.write(b"abc")
+        task.ledger.publish("a.xls", "1.1", size=3, digest=digest.digest)
+
+        # Copies of a file being published, or published by this run, are skipped
+        self.assertEqual(["c.xls"], download(("b.xls", b"abc"), ("c.xls", b"xyz"), ("d.xls", b"xyz")))
+        self.assertEqual(2, task.counts["duplicates"])
+        self.assertIsNone(task.ledger.state("b.xls"))
+        task.submit_delete.assert_not_called()
+
+        # Once the first copy is confirmed, the others are recorded and deleted
+        task.ledger.confirm("a.xls")
+        self.assertEqual(["a.xls"], download(("a.xls", b"abc"), ("b.xls", b"abc")))
+        self.assertEqual(Ledger.DUPLICATE, task.ledger.state("b.xls"))
+        task.submit_delete.assert_called_once_with("b.xls", None)
+
+    def test_skips_duplicates_within_a_source(self):
+        sources = json.dumps([{"name": "north", "queue": "qa"}, {"name": "south", "queue": "qb"}])
+        with unittest.mock.patch.dict("os.environ", {"SEFT_LEDGER_PATH": ":memory:", "SEFT_SOURCES": sources}):
+            task = Task(None, {})
+        north, south = task.sources
+        spool = Spool()
+        spool.write(b"abc")
+        task.ledger.publish("north/a.xls", "1.1", size=3, digest=spool.digest, source="north")
+        task.ledger.confirm("north/a.xls")
+
+        def download(source, filename):
+            spool = Spool()
+            spool.write(b"abc")
+            session = unittest.mock.MagicMock()
+            session.__enter__.return_value.get.return_value = [Job(datetime.datetime.utcnow(), filename, spool)]
+            with unittest.mock.patch.object(source.pool, "session", return_value=session):
+                return [job.filename for job in task.download_files(None, (source, [filename]))]
+
+        # A copy from another source goes to that source's consumers
+        self.assertEqual(["b.xls"], download(south, "b.xls"))
+        self.assertIsNone(task.ledger.state("south/b.xls"))
+        self.assertEqual([], download(north, "c.xls"))
+        self.assertEqual(Ledger.DUPLICATE, task.ledger.state("north/c.xls"))
+
+    def test_keeps_listed_duplicates(self):
+        task = self.task
+        source = task.sources[0]
+        task.ledger.duplicate("a.xls", size=3)
+        task.ledger._execute("UPDATE files SET updated = updated - ?", task.ledger.retention)
+        self.assertFalse(task.is_unpublished(source, "a.xls", 3, time.time()))
+        # Seeing the copy on the server holds off compaction
+        self.assertEqual(0, task.ledger.compact())
+        self.assertEqual(Ledger.DUPLICATE, task.ledger.state("a.xls"))
+        self.assertEqual(1, task.ledger.compact(now=time.time() + task.ledger.retention + 1))
+
+    def test_confirms_latest_version(self):
+        task = self.task
+        task.submit_delete = unittest.mock.Mock()
+        task.ledger.publish("a.xls", "1.1", size=3)
+        task.ledger.publish("a.xls", "1.2", size=4)
+        task.loop = self.io_loop
+        threads = set()
+        confirm = task.ledger.confirm
+
+        def confirm_off_loop(*args):
+            threads.add(threading.current_thread())
+            return confirm(*args)
+
+        def confirmed(msg_id, outcomes):
+            future = tornado.concurrent.Future()
+            future.set_result(outcomes)
+            with unittest.mock.patch.object(task.ledger, "confirm", side_effect=confirm_off_loop):
+                self.io_loop.run_sync(functools.partial(task.on_confirmed, "a.xls", msg_id, future))
+
+        # Messages of the version published before do not settle the file
+        confirmed("1.1", [True])
+        confirmed("1.1", [False])
+        self.assertEqual(("1.2", Ledger.PUBLISHED), (task.ledger.get("a.xls").msg_id, task.ledger.state("a.xls")))
+        task.submit_delete.assert_not_called()
+        confirmed("1.2", [True])
+        self.assertEqual(Ledger.CONFIRMED, task.ledger.state("a.xls"))
+        task.submit_delete.assert_called_once_with("a.xls", "1.2")
+        # The ledger is written to on its own thread, not the IOLoop's
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(1, len(threads))
+
+    def test_finds_changed_files(self):
+        task = self.task
+        source = task.sources[0]
+        task.ledger.publish("a.xls", "1.1", size=3, modify="20240101120000")
+        task.ledger.publish("b.xls", "1.2", size=3)
+        started = time.time()
+        self.assertFalse(task.is_unpublished(source, "a.xls", 3, started, "20240101120000"))
+        # A replacement of the same size is published again
+        self.assertTrue(task.is_unpublished(source, "a.xls", 3, started, "20240101130000"))
+        self.assertTrue(task.is_unpublished(source, "a.xls", 4, started, "20240101120000"))
+        # Facts which are not known are not compared
+        self.assertFalse(task.is_unpublished(source, "a.xls", None, started, None))
+        self.assertFalse(task.is_unpublished(source, "b.xls", 3, started, "20240101130000"))
+
+    def test_claims_a_batch(self):
+        task = self.task
+        task.listing = "nlst"
+        task.claim_batch = 4
+        source = task.sources[0]
+        active = unittest.mock.Mock(claim_directory=".claims", filenames=["{0}.xls".format(n) for n in range(10)])
+        active.reclaim.return_value = 0
+        active.claimed.return_value = ["old.xls"]
+        active.claim.return_value = True
+        session = unittest.mock.MagicMock()
+        session.__enter__.return_value = active
+        with unittest.mock.patch.object(source.pool, "session", return_value=session):
+            filenames, held = task.list_source(source, time.time())
+        # Files claimed before count towards the batch, and the rest are left for other replicas
+        self.assertEqual(["0.xls", "1.xls", "2.xls", "old.xls"], filenames)
+        self.assertEqual(3, active.claim.call_count)
+
+    def test_recent(self):
+        for n in range(3):
+            self.task.ledger.publish("{0}.xls".format(n), "1.{0}".format(n), size=n)
+        self.task.ledger.confirm("1.xls")
+
+        response = self.fetch("/recent?limit=2")
+        self.assertEqual(200, response.code)
+        page = json.loads(response.body.decode("utf-8"))
+        self.assertEqual(["0.xls", "1.xls"], [f["filename"] for f in page["files"]])
+        self.assertEqual({"published", "confirmed"}, {f["state"] for f in page["files"]})
+        self.assertEqual("1.1", page["files"][1]["msg_id"])
+
+        page = json.loads(self.fetch("/recent?cursor=" + page["next"]).body.decode("utf-8"))
+        self.assertEqual((["2.xls"], None), ([f["filename"] for f in page["files"]], page["next"]))
+
+        page = json.loads(self.fetch("/recent?state=confirmed").body.decode("utf-8"))
+        self.assertEqual(["1.xls"], [f["filename"] for f in page["files"]])
+        page = json.loads(self.fetch("/recent?min_age=60").body.decode("utf-8"))
+        self.assertEqual([], page["files"])
+
+        self.assertEqual(400, self.fetch("/recent?state=lost").code)
+        self.assertEqual(400, self.fetch("/recent?cursor=x").code)